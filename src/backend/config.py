@@ -1,9 +1,103 @@
 # config.py
 import os
 import os.path
+import tempfile
 
 # Use the DATABASE_PATH environment variable if set; otherwise use the default production file.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_PATH = os.environ.get("DATABASE_PATH", os.path.join(BASE_DIR, "data", "data.db"))
 DB_GET_PASSWORD = os.environ.get("DB_GET_PASSWORD", "BWQ7CZ9ue3va")
+TAGS_PATH = os.environ.get("TAGS_PATH", os.path.join(BASE_DIR, "data", "tags.json"))
 
+# Sticky user sharding (see router.py): with SHARD_COUNT > 1, each worker only serves the
+# users models/sharding.py assigns to its SHARD_INDEX and refuses the rest. router.py
+# starts the workers on unix sockets in SHARD_SOCKET_DIR and sets both for each of them.
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0"))
+SHARD_SOCKET_DIR = os.environ.get("SHARD_SOCKET_DIR", os.path.join(tempfile.gettempdir(), "backend-shards"))
+
+# Open the database and load the nonprofit catalog while the server starts (FastAPI
+# lifespan) rather than in the first request; off leaves everything to first use.
+WARM_UP = os.environ.get("WARM_UP", "1") not in ("0", "false", "False")
+
+
+# Candidate retrieval for User.refreshQueue: "exact" scores the whole catalog,
+# "ivf" uses the approximate index in models/ann.py (persisted next to the database),
+# "postings" uses the exact tag inverted index in models/postings.py.
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "exact")
+ANN_INDEX_PATH = os.environ.get(
+    "ANN_INDEX_PATH",
+    None if DATABASE_PATH == ":memory:" else os.path.join(os.path.dirname(DATABASE_PATH), "ann_index.npz"),
+)
+ANN_NLIST = int(os.environ.get("ANN_NLIST", "0")) or None  # 0 picks 4 * sqrt(catalog size)
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", "16"))
+
+# Multi-worker deployments: the nonprofit catalog is published in this directory as
+# memory-mapped .npy snapshots that every worker maps instead of loading its own copy
+# (see models/sharedcatalog.py). Workers pick up a snapshot published by another worker
+# within SHARED_CATALOG_POLL seconds. Empty keeps a private catalog per process.
+SHARED_CATALOG_DIR = os.environ.get("SHARED_CATALOG_DIR", "")
+SHARED_CATALOG_POLL = float(os.environ.get("SHARED_CATALOG_POLL", "0.5"))
+
+# Memory-mapped copy of every user vector for offline scoring jobs (see models/uservectors.py
+# and utils/sync_user_vectors.py), kept next to the database by default.
+USER_VECTORS_DIR = os.environ.get(
+    "USER_VECTORS_DIR",
+    "" if DATABASE_PATH == ":memory:" else os.path.join(os.path.dirname(DATABASE_PATH), "user_vectors"),
+)
+
+# Nightly pre-ranking (utils/prerank_users.py): each user's PRERANK_TOP_N best nonprofits,
+# ranked PRERANK_CHUNK users per matrix product, seed their queue when they log on.
+PRERANK_TOP_N = int(os.environ.get("PRERANK_TOP_N", "30"))
+PRERANK_CHUNK = int(os.environ.get("PRERANK_CHUNK", "1024"))
+
+# Write-behind persistence of user vectors: dirty users are flushed at most
+# USER_FLUSH_INTERVAL seconds after a reaction, or once USER_FLUSH_BATCH are waiting.
+USER_FLUSH_INTERVAL = float(os.environ.get("USER_FLUSH_INTERVAL", "5"))
+USER_FLUSH_BATCH = int(os.environ.get("USER_FLUSH_BATCH", "256"))
+
+# Logged-on user cache: users idle for SESSION_IDLE_TTL seconds are logged out,
+# and the least recently active are evicted beyond SESSION_MAX_USERS.
+SESSION_MAX_USERS = int(os.environ.get("SESSION_MAX_USERS", "10000"))
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", "3600"))
+
+# Background queue refills (see models/queuerefill.py): a served user whose upcoming queue
+# is below QUEUE_LOW_WATER is topped up off the request path, up to QUEUE_REFILL_BATCH
+# users per scoring pass, most recently active first.
+QUEUE_LOW_WATER = int(os.environ.get("QUEUE_LOW_WATER", "10"))
+QUEUE_REFILL_BATCH = int(os.environ.get("QUEUE_REFILL_BATCH", "64"))
+
+# /metrics instrumentation (see models/metrics.py); off turns every timer into a no-op.
+# PROFILER_INTERVAL is the sampling period of the /profiler stack sampler, in seconds.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") not in ("0", "false", "False")
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", "0.05"))
+
+# Thread pools behind the async handlers: SQLite reads (each thread has its own
+# connection) and CPU-bound scoring. Writes always run on one dedicated thread.
+DB_READER_THREADS = int(os.environ.get("DB_READER_THREADS", "4"))
+SCORING_THREADS = int(os.environ.get("SCORING_THREADS", str(os.cpu_count() or 1)))
+
+# SQLite connection tuning (see models/connectionpool.py). cache_size is in KiB when negative.
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", str(-64 * 1024)))
+SQLITE_STATEMENT_CACHE = int(os.environ.get("SQLITE_STATEMENT_CACHE", "256"))
+# NORMAL only syncs the WAL at checkpoints; FULL syncs every commit (see LEDGER_COMMIT_*).
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+
+# Popularity counters behind the "trending" and "gem" events (see models/popularity.py):
+# engagement halves every POPULARITY_HALF_LIFE seconds, each pool holds POPULARITY_POOL_SIZE
+# nonprofits, and a gem has been shown fewer than GEM_MAX_EXPOSURE (decayed) times.
+POPULARITY_HALF_LIFE = float(os.environ.get("POPULARITY_HALF_LIFE", str(24 * 3600)))
+POPULARITY_POOL_SIZE = int(os.environ.get("POPULARITY_POOL_SIZE", "50"))
+GEM_MAX_EXPOSURE = float(os.environ.get("GEM_MAX_EXPOSURE", "50"))
+
+# Group commit for /addLedger: payments arriving while a commit is running are written
+# together in the next transaction (up to LEDGER_COMMIT_BATCH). A LEDGER_COMMIT_DELAY of a
+# few milliseconds holds each batch open longer, which only pays off when every commit
+# is synced (SQLITE_SYNCHRONOUS=FULL) and clients are many.
+LEDGER_COMMIT_DELAY = float(os.environ.get("LEDGER_COMMIT_DELAY", "0"))
+LEDGER_COMMIT_BATCH = int(os.environ.get("LEDGER_COMMIT_BATCH", "512"))
+
+# Rows copied per transaction when models/migrations.py rewrites coin_ledger; other
+# writers get the write lock between batches.
+LEDGER_MIGRATION_BATCH = int(os.environ.get("LEDGER_MIGRATION_BATCH", "5000"))
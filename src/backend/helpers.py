@@ -1,5 +1,6 @@
 import numpy as np
 from models.nonprofit import NonProfit
+from models.popularity import popularity
 
 # -----------------
 #   Helper Functions
@@ -43,6 +44,20 @@ def cosine_similarity(vec1, vec2):
         return 0.0
     return dot_prod / (norm1 * norm2)
 
+def top_k_rows(rows, scores, k):
+    """
+    The k rows with the highest scores, best first. Ties are broken by row
+    number, like a stable descending sort over the catalog would.
+    """
+    if len(rows) > k:
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = scores > kth
+        tied = np.flatnonzero(scores == kth)
+        tied = tied[np.argsort(rows[tied], kind="stable")][:k - int(above.sum())]
+        keep = np.concatenate([np.flatnonzero(above), tied])
+        rows, scores = rows[keep], scores[keep]
+    return rows[np.lexsort((rows, -scores))]
+
 # -----------------
 #   Reaction Function
 # -----------------
@@ -50,12 +65,14 @@ def react(n: int, user, nonProfit: NonProfit, amount=0.0):
     match n:
         case 0:
             user.like(nonProfit)
+            popularity.record(nonProfit.id, likes=1)
         case 1:
             user.dislike(nonProfit)
         case 2:
             user.ignore(nonProfit)
         case 3:
             user.donate(nonProfit, amount)
+            popularity.record(nonProfit.id, donations=1)
         case _:
             raise Exception("Invalid Reaction")
 
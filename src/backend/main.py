@@ -1,116 +1,254 @@
 # main.py (or your API entrypoint)
+import asyncio
 import time
 from collections import deque
-import json
-import os
+from contextlib import asynccontextmanager
+import zlib
 
 # Third-party packages
-from fastapi import FastAPI
-from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, Query
+from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-from models.user import User
-from models.sqlite_db import SQLiteDatabase
-from models.coinledger import CoinLedger
+from models.user import User, refreshQueues
+from models.events import EVENTS
+from models.appcontext import context
+from models.writebehind import WriteBehindFlusher
+from models.sessioncache import SessionCache
+from models.dbexecutor import DatabaseExecutor
+from models.groupcommit import GroupCommitter
+from models.queuerefill import QueueRefiller
+from models.metrics import metrics, profiler, timed
+from models.sharding import HashRing
 from helpers import react
 
-from config import DB_GET_PASSWORD, DATABASE_PATH
+from config import DB_GET_PASSWORD, WARM_UP, USER_FLUSH_INTERVAL, USER_FLUSH_BATCH
+from config import SESSION_MAX_USERS, SESSION_IDLE_TTL, DB_READER_THREADS, SCORING_THREADS
+from config import LEDGER_COMMIT_DELAY, LEDGER_COMMIT_BATCH, QUEUE_LOW_WATER, QUEUE_REFILL_BATCH
+from config import SHARD_COUNT, SHARD_INDEX
 
 # -----------------
 #    Global Data
 # -----------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Open the database and load the catalog before serving, so the first request
+    # doesn't pay for it (with WARM_UP off they happen on first use instead).
+    if WARM_UP:
+        await asyncio.to_thread(context.warm_up)
+    yield
+    exitApp()
+
+
+app = FastAPI(lifespan=lifespan)
 updateQueue = deque()
-userCache = deque()
-CachedUsers = {}
 
-Events = {
-    0: "basic",
-    1: "disrupt",
-    2: "return",
-    3: "gem",
-    4: "trending",
-    5: "repeat"
-}
+# Event id -> name, from the registry in models/events.py
+Events = {event_id: name for event_id, (name, _) in EVENTS.items()}
+
+# The database, ledger and tag table live in models/appcontext.py and are opened on
+# first use (or by the lifespan warm-up below), shared with models/user.py.
+# Blocking work for the async handlers: one SQLite writer thread, a reader pool, a scoring pool.
+dbExecutor = DatabaseExecutor(DB_READER_THREADS, SCORING_THREADS)
+
+
+def __getattr__(name):
+    # main.database / main.ledger / main.ledgerAnalytics, kept for scripts and tools
+    if name in ("database", "ledger"):
+        return getattr(context, name)
+    if name == "ledgerAnalytics":
+        return context.ledger_analytics
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def persistUsers(rows):
+    dbExecutor.write_sync(context.database.upsert_users, rows)
+
+
+# Writes reacted-to users back in batches instead of only at logout.
+flusher = WriteBehindFlusher(persistUsers, USER_FLUSH_INTERVAL, USER_FLUSH_BATCH)
+
+
+def loadUser(userID: str):
+    # A user logged out moments ago may not be flushed yet; reuse that copy.
+    user = flusher.pending(userID)
+    if user is None:
+        vector = context.database.get_user(userID)
+        if vector is not None:
+            user = User(userID, vector=vector)
+            # First pages from the nightly pre-ranking (utils/prerank_users.py), if still current
+            user.seedQueue(context.database.get_user_recommendations(userID))
+        else:
+            user = User(userID, new=True)
+    return user
+
+
+# Logged-on users; whoever is evicted gets written back through the flusher.
+CachedUsers = SessionCache(loadUser, flusher.mark, SESSION_MAX_USERS, SESSION_IDLE_TTL)
+# Tops up the queues of recently served users so /nextN rarely has to score inline.
+queueRefiller = QueueRefiller(refreshQueues, QUEUE_LOW_WATER, QUEUE_REFILL_BATCH)
+
 
-json_path = os.path.join(os.path.dirname(__file__), "data", "tags.json")
-with open(json_path, "r") as f:
-    Tags = json.load(f)
+# Owner of each user when several workers share the load (see router.py)
+shardRing = HashRing(SHARD_COUNT)
 
-# Instantiate the global database using SQLite
-database = SQLiteDatabase(DATABASE_PATH)
+
+def foreignUsers(userIDs):
+    """The userIDs another shard owns; a worker holding them too would fork their state."""
+    if SHARD_COUNT == 1:
+        return []
+    return [userID for userID in userIDs if shardRing.owner(userID) != SHARD_INDEX]
+
+
+def misdirected(userIDs):
+    # 421 Misdirected Request: the router sends each user to its owner, so this means a client bypassed it
+    owners = ", ".join(f"{userID} -> {shardRing.owner(userID)}" for userID in userIDs)
+    return PlainTextResponse(f"FAIL: Users belong to other shards ({owners})", status_code=421)
+
+
+def handlerTimer(endpoint):
+    return timed("handler_seconds", "Time spent in each API handler", endpoint=endpoint)
+
+
+def sessionTimer(op):
+    return timed("session_seconds", "User log on / log off", op=op)
+
+
+# Read from the live objects on each scrape (tests swap them)
+for stat in ("hits", "misses", "evictions", "expirations"):
+    metrics.callback(f"session_cache_{stat}_total", f"CachedUsers {stat}",
+                     lambda stat=stat: CachedUsers.stats()[stat], kind="counter")
+metrics.callback("session_cache_hit_ratio", "CachedUsers hits / lookups", lambda: CachedUsers.stats()["hit_ratio"])
+metrics.callback("session_cache_users", "Users in CachedUsers", lambda: len(CachedUsers))
+metrics.callback("queue_refills_total", "Users whose queue was refilled in the background",
+                 lambda: queueRefiller.refills, kind="counter")
+metrics.callback("queue_refill_pending", "Users waiting for a background refill", lambda: len(queueRefiller.pending))
+metrics.callback("ledger_group_commits_total", "Transactions written by the /addLedger group committer",
+                 lambda: ledgerCommits.batches, kind="counter")
+metrics.callback("ledger_group_commit_payments_total", "Payments written by the /addLedger group committer",
+                 lambda: ledgerCommits.items, kind="counter")
 
 
 # ---------------------
 #   API Endpoints
 # ---------------------
 @app.get("/nextN")
-def nextCharity(userID: str, n: int = 3):
-    checkLogOut()
-    if userID not in CachedUsers:
-        logOn(userID)
-    return {"array": CachedUsers[userID].getNextN(n)}
+@handlerTimer("nextN")
+async def nextCharity(userID: str, n: int = 3):
+    if foreign := foreignUsers([userID]):
+        return misdirected(foreign)
+    user = await dbExecutor.read(CachedUsers.get, userID)
+    sending = await dbExecutor.compute(user.getNextN, n)
+    queueRefiller.request(user)
+    return {"array": sending}
+
+
+def nextNBatch(users, n):
+    # Score everyone who needs a refill together instead of one scan per user.
+    refreshQueues([user for user in users if len(user.upcomingQueue) < n])
+    return {user.id: user.getNextN(n) for user in users}
+
+
+@app.get("/nextNBatch")
+@handlerTimer("nextNBatch")
+async def nextCharityBatch(userIDs: list[str] = Query(...), n: int = 3):
+    if foreign := foreignUsers(userIDs):
+        return misdirected(foreign)
+    users = await dbExecutor.read(lambda: [CachedUsers.get(userID) for userID in dict.fromkeys(userIDs)])
+    arrays = await dbExecutor.compute(nextNBatch, users, n)
+    for user in users:
+        queueRefiller.request(user)
+    return {"arrays": arrays}
 
 
 @app.get("/reaction")
-def reaction(userID: str, reactionNum: int, nonprofitID: str, amount: float = 0.0):
-    checkLogOut()
-    if userID not in CachedUsers:
-        logOn(userID)
+@handlerTimer("reaction")
+async def reaction(userID: str, reactionNum: int, nonprofitID: str, amount: float = 0.0):
     if reactionNum > 3 or reactionNum < 0:
         return PlainTextResponse("FAIL: Invalid reaction number")
-    user = CachedUsers[userID]
+    if foreign := foreignUsers([userID]):
+        return misdirected(foreign)
+    user = await dbExecutor.read(CachedUsers.get, userID)
     # Use the new get_nonprofit method from SQLiteDatabase
-    nonprofit = database.get_nonprofit(nonprofitID)
+    nonprofit = await dbExecutor.read(context.database.get_nonprofit, nonprofitID)
     if nonprofit is None:
         return PlainTextResponse("FAIL: Nonprofit not found")
+    # Off the loop: the user's lock may be held by a refresh on the scoring pool.
     if reactionNum == 3:
-        react(3, user, nonprofit, amount)
+        await dbExecutor.compute(react, 3, user, nonprofit, amount)
     else:
-        react(reactionNum, user, nonprofit)
+        await dbExecutor.compute(react, reactionNum, user, nonprofit)
+    flusher.mark(user)
     return PlainTextResponse("success")
 
+
+def commitPayments(payments):
+    return dbExecutor.write_sync(context.ledger.add_many, payments)
+
+
+# Concurrent /addLedger calls share one transaction (see config.LEDGER_COMMIT_*).
+ledgerCommits = GroupCommitter(commitPayments, LEDGER_COMMIT_BATCH, LEDGER_COMMIT_DELAY)
+
+
 @app.get("/addLedger")
-def addLedger(userID: str, amount: int, nonprofitID: str):
-    ledger = CoinLedger(DATABASE_PATH)
-    tx_id = ledger.add(userID, amount, nonprofitID)
+@handlerTimer("addLedger")
+async def addLedger(userID: str, amount: int, nonprofitID: str):
+    tx_id = await asyncio.wrap_future(ledgerCommits.submit((userID, amount, nonprofitID)))
     return {"tx_id": tx_id}
 
+
+class LedgerPayment(BaseModel):
+    userID: str
+    amount: float
+    nonprofitID: str
+
+
+# Adds many payments in one transaction; tx_ids are in the order of the request body
+@app.post("/addLedgerBatch")
+@handlerTimer("addLedgerBatch")
+async def addLedgerBatch(payments: list[LedgerPayment]):
+    tx_ids = await dbExecutor.write(context.ledger.add_many, [(p.userID, p.amount, p.nonprofitID) for p in payments])
+    return {"tx_ids": tx_ids}
+
 @app.get("/removeLedger")
-def removeLedger(tx_id: str):
-    ledger = CoinLedger(DATABASE_PATH)
-    ledger.remove(tx_id)
+@handlerTimer("removeLedger")
+async def removeLedger(tx_id: str):
+    await dbExecutor.write(context.ledger.remove, tx_id)
     return PlainTextResponse("success")
 
-def logOn(userID: str):
-    vector = database.get_user(userID)
-    if vector is not None:
-        user = User(userID, vector=vector)
-    else:
-        user = User(userID, new=True)
-    CachedUsers[userID] = user
-    userCache.append((userID, time.time()))
-    return PlainTextResponse("success")
+# Ledger totals, from the summary tables kept alongside coin_ledger
+@app.get("/ledgerTotal")
+@handlerTimer("ledgerTotal")
+async def ledgerTotal(userID: str = None, nonprofitID: str = None):
+    if (userID is None) == (nonprofitID is None):
+        return PlainTextResponse("FAIL: Pass exactly one of userID and nonprofitID")
+    if userID is not None:
+        return await dbExecutor.read(context.ledger_analytics.user_total, userID)
+    return await dbExecutor.read(context.ledger_analytics.nonprofit_total, nonprofitID)
+
 
+@app.get("/ledgerDaily")
+@handlerTimer("ledgerDaily")
+async def ledgerDaily(start: str, end: str, nonprofitID: str = None):
+    return await dbExecutor.read(context.ledger_analytics.daily, start, end, nonprofitID)
 
-def checkLogOut():
-    while time.time() - userCache[0][1] > 3600:
-        user = userCache.popleft()[0]
-        logOut(user)
 
+@app.get("/topNonprofits")
+@handlerTimer("topNonprofits")
+async def topNonprofits(limit: int = 10):
+    return await dbExecutor.read(context.ledger_analytics.top_nonprofits, limit)
 
+@sessionTimer("logOn")
+def logOn(userID: str):
+    # Have a first page queued by the time the user asks for it.
+    queueRefiller.request(CachedUsers.get(userID))
+    return PlainTextResponse("success")
+
+
+@sessionTimer("logOut")
 def logOut(userID: str):
-    if userID not in CachedUsers:
-        return
-    user = CachedUsers[userID]
-    new_vector = user.getFullVector()
-    # Check if the user already exists in the database.
-    if database.get_user(userID) is None:
-        # If not, add the user.
-        database.add_user(userID, new_vector)
-    else:
-        # Otherwise, update the user's vector.
-        database.update_user_vector(userID, new_vector)
-    del CachedUsers[userID]
+    # Eviction hands the user to the flusher, which upserts their final vector.
+    CachedUsers.evict(userID)
     return PlainTextResponse("success")
 
 
@@ -118,23 +256,60 @@ lastUpdate = time.time()
 
 
 @app.get("/queueUpdate")
-def queueUpdate(nonprofitID: str, primaryTags: list[int], secondaryTags: list[int]):
+@handlerTimer("queueUpdate")
+async def queueUpdate(nonprofitID: str, primaryTags: list[int], secondaryTags: list[int]):
     updateQueue.append(nonprofitID)
     if time.time() - lastUpdate > 7200:
         # Placeholder for periodic update logic.
         pass
     return PlainTextResponse("success")
 
-# Gets the entire database
+async def streamExport(chunks, compress):
+    """Pulls each chunk of a database export on the read pool, gzipping it on the way out if asked to."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    try:
+        while (chunk := await dbExecutor.read(next, chunks, None)) is not None:
+            data = chunk.encode()
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        await dbExecutor.read(chunks.close)
+
+
+# Streams the entire database as one JSON document
 @app.get("/getDatabase")
-def getDatabase(password: str):
+async def getDatabase(password: str, gzip: bool = False):
+    if password != DB_GET_PASSWORD:
+        return PlainTextResponse("FAIL: Incorrect password")
+    headers = {"Content-Encoding": "gzip"} if gzip else None
+    return StreamingResponse(streamExport(context.database.iter_json(), gzip), media_type="application/json", headers=headers)
+
+
+@app.get("/metrics")
+async def metricsEndpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Sampling profiler: enable=true starts a fresh profile, enable=false stops it;
+# every call returns the stacks sampled so far (collapsed, for flamegraph tools).
+@app.get("/profiler")
+async def profilerEndpoint(password: str, enable: bool = None):
     if password != DB_GET_PASSWORD:
         return PlainTextResponse("FAIL: Incorrect password")
-    return database.get_json()
+    if enable:
+        profiler.reset()
+        profiler.start()
+    elif enable is not None:
+        profiler.stop()
+    return PlainTextResponse(profiler.collapsed())
 
 
 @app.get("/test")
-def test():
+async def test():
     return {"message": "Hello World"}
 
 
@@ -142,9 +317,14 @@ def test():
 #   Main Methods
 # -----------------
 def run():
-    global database
-    database = SQLiteDatabase(DATABASE_PATH)
+    context.warm_up()
 
 
 def exitApp():
-    database.close()
+    queueRefiller.close()
+    profiler.stop()
+    CachedUsers.clear()
+    flusher.drain()
+    ledgerCommits.close()
+    dbExecutor.shutdown()
+    context.close()
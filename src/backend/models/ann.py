@@ -0,0 +1,183 @@
+import os
+import numpy as np
+from helpers import top_k_rows
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest neighbour index over the rows of a
+    NonprofitIndex matrix.
+
+    Rows are clustered with spherical k-means; a search only scores the rows
+    in the `nprobe` lists whose centroids are closest to the query. `nlist`
+    and `nprobe` are the recall/latency knobs: more lists make each list
+    shorter, more probes raise recall at the cost of scoring more rows.
+    """
+
+    def __init__(self, nlist=None, nprobe=16, iterations=10, train_size=100_000, seed=0, path=None):
+        self.path = path     # where the clustering is persisted, if anywhere
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+        self.lists = []      # list number -> list of matrix rows
+        self.assign = {}     # matrix row -> list number
+        self._arrays = {}    # list number -> cached np.array of self.lists[n]
+
+    # -----------------
+    #   Building
+    # -----------------
+    def train(self, matrix):
+        """Runs spherical k-means on (a sample of) the normalized catalog rows."""
+        rng = np.random.default_rng(self.seed)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(matrix))))
+        nlist = min(nlist, max(1, len(matrix)))
+        sample = matrix
+        if len(matrix) > self.train_size:
+            sample = matrix[rng.choice(len(matrix), self.train_size, replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            labels = self._nearest(sample, centroids)
+            sums = np.zeros_like(centroids)
+            for dim in range(sample.shape[1]):
+                sums[:, dim] = np.bincount(labels, weights=sample[:, dim], minlength=nlist)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Reseed empty clusters with random rows so every list stays usable.
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+        self.centroids = centroids
+
+    @property
+    def ready(self):
+        return self.centroids is not None
+
+    def build(self, matrix, ids):
+        """
+        Indexes every row of `matrix` (whose nonprofit ids are `ids`).
+
+        Reuses the clustering persisted at `path` when there is one, so a
+        restart doesn't retrain; otherwise trains and persists a new one.
+        """
+        self.centroids = None
+        if len(matrix) == 0:
+            self.lists, self.assign, self._arrays = [], {}, {}
+            return
+        assignments = None
+        if self.path and os.path.exists(self.path):
+            try:
+                assignments = self.load(self.path, {i: row for row, i in enumerate(ids)})
+            except (OSError, KeyError, ValueError):
+                self.centroids, assignments = None, None
+            if self.centroids is not None and self.centroids.shape[1] != matrix.shape[1]:
+                self.centroids, assignments = None, None
+        trained = self.centroids is None
+        if trained:
+            self.train(matrix)
+        self.fill(matrix, assignments)
+        if trained and self.path:
+            self.save(self.path, ids)
+
+    def fill(self, matrix, assignments=None):
+        """
+        Fills the inverted lists for every row of `matrix`.
+
+        `assignments` optionally maps rows to already-known list numbers (from
+        a persisted index); all other rows are assigned to their nearest list.
+        """
+        assignments = assignments or {}
+        self.lists = [[] for _ in range(len(self.centroids))]
+        self.assign = {}
+        self._arrays = {}
+        missing = [row for row in range(len(matrix)) if row not in assignments]
+        for row, label in assignments.items():
+            self._insert(row, int(label))
+        if missing:
+            labels = self._nearest(matrix[missing], self.centroids)
+            for row, label in zip(missing, labels):
+                self._insert(row, int(label))
+
+    @staticmethod
+    def _nearest(vectors, centroids, chunk=65_536):
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            labels[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+        return labels
+
+    def _insert(self, row, label):
+        self.lists[label].append(row)
+        self.assign[row] = label
+        self._arrays.pop(label, None)
+
+    # -----------------
+    #   Incremental updates
+    # -----------------
+    def add(self, row, vec):
+        """Assigns a newly appended matrix row to its nearest list."""
+        self._insert(row, int(np.argmax(self.centroids @ vec)))
+
+    def update(self, row, vec, old_vec=None):
+        """Moves an existing row whose vector changed to its new nearest list."""
+        old = self.assign.get(row)
+        if old is not None:
+            self.lists[old].remove(row)
+            self._arrays.pop(old, None)
+        self.add(row, vec)
+
+    # -----------------
+    #   Search
+    # -----------------
+    def _rows(self, label):
+        if label not in self._arrays:
+            self._arrays[label] = np.asarray(self.lists[label], dtype=np.int64)
+        return self._arrays[label]
+
+    def search(self, index, query_vec, k, exclude=()):
+        """
+        Top-k nonprofit ids for an already normalized `query_vec`.
+
+        Starts with `nprobe` lists and keeps widening the probe while excluded
+        ids leave fewer than k candidates, so it only comes back short when the
+        whole catalog has been excluded.
+        """
+        if len(index) == 0:
+            return []
+        _, excluded = index.rows_of(exclude)
+        order = np.argsort(-(self.centroids @ query_vec), kind="stable")
+        nprobe = min(self.nprobe, len(order))
+        while True:
+            rows = np.concatenate([self._rows(label) for label in order[:nprobe]])
+            if len(excluded):
+                rows = rows[~np.isin(rows, excluded)]
+            if len(rows) >= k or nprobe == len(order):
+                break
+            nprobe = min(nprobe * 2, len(order))
+        if len(rows) == 0:
+            return []
+        return index.ids[top_k_rows(rows, index.matrix[rows] @ query_vec, k)].tolist()
+
+    # -----------------
+    #   Persistence
+    # -----------------
+    def save(self, path, ids):
+        """Writes the centroids and each nonprofit id's list number to `path`."""
+        labels = np.array([self.assign[row] for row in range(len(ids))], dtype=np.int32)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, ids=np.asarray(ids, dtype=str), labels=labels)
+        os.replace(tmp_path, path)
+
+    def load(self, path, rows):
+        """
+        Restores centroids from `path` and returns the row -> list assignments
+        it recorded for the ids still present in `rows` (id -> matrix row).
+        """
+        with np.load(path) as data:
+            self.centroids = data["centroids"].astype(np.float32)
+            saved_ids = data["ids"].tolist()
+            labels = data["labels"].tolist()
+        return {rows[i]: label for i, label in zip(saved_ids, labels) if i in rows}
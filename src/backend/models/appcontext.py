@@ -0,0 +1,105 @@
+"""
+The process-wide resources of the backend, created on first use.
+
+Importing main.py or models/user.py no longer opens anything: the database,
+the ledger and the tag table are built the first time `context.<name>` is
+read, once per process, and every module gets the same instance. Before,
+main.py and models/user.py each opened their own SQLiteDatabase (under
+":memory:", two unrelated databases) and tags.json was parsed twice.
+
+The server reads them ahead of the first request through `warm_up()`, which
+main.py runs from its FastAPI lifespan. Tests swap a resource with
+monkeypatch.setattr(context, "database", ...).
+"""
+
+import json
+import threading
+
+from config import DATABASE_PATH, TAGS_PATH
+from models.coinledger import CoinLedger
+from models.ledgeranalytics import LedgerAnalytics
+from models.nonprofitindex import nonprofit_index
+from models.sqlite_db import SQLiteDatabase
+
+_missing = object()
+
+
+class resource:
+    """
+    Like functools.cached_property, but the first read happens under the
+    context's lock, so threads racing to use a resource build only one. The
+    built value is stored on the instance, so later reads are plain
+    attribute lookups.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+        self.__doc__ = factory.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, context, owner=None):
+        if context is None:
+            return self
+        with context.lock:
+            value = context.__dict__.get(self.name, _missing)
+            if value is _missing:
+                value = context.__dict__[self.name] = self.factory(context)
+        return value
+
+
+class AppContext:
+    def __init__(self, database_path=DATABASE_PATH, tags_path=TAGS_PATH):
+        self.database_path = database_path
+        self.tags_path = tags_path
+        # Reentrant: the ledger is built from the database
+        self.lock = threading.RLock()
+
+    @resource
+    def tags(self):
+        """tags.json: tag id (as a string) -> tag name."""
+        with open(self.tags_path, "r") as f:
+            return json.load(f)
+
+    @resource
+    def database(self):
+        """The SQLiteDatabase every module reads and writes through, migrated on open."""
+        return SQLiteDatabase(self.database_path)
+
+    @resource
+    def ledger(self):
+        """CoinLedger on the database's connection pool."""
+        return CoinLedger(self.database_path, pool=self.database.pool)
+
+    @resource
+    def ledger_analytics(self):
+        return LedgerAnalytics(self.ledger)
+
+    def created(self):
+        """Names of the resources built so far."""
+        return [name for name, value in vars(type(self)).items()
+                if isinstance(value, resource) and name in self.__dict__]
+
+    def warm_up(self):
+        """
+        Builds every resource and loads the nonprofit catalog into memory, so
+        the first request finds them ready. Returns the loaded index.
+        """
+        self.tags
+        self.ledger_analytics
+        return nonprofit_index.ensure(self.database)
+
+    def close(self):
+        """Closes the database and forgets every resource; the next read opens them again."""
+        with self.lock:
+            database = self.__dict__.get("database")
+            for name in self.created():
+                del self.__dict__[name]
+        if database is not None:
+            database.close()
+
+
+# The context of this process
+context = AppContext()
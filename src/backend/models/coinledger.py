@@ -1,26 +1,32 @@
-import sqlite3
 import datetime
 import hashlib
+import itertools
+
+from models.connectionpool import acquire_pool, release_pool, retain_pool
+from models.popularity import popularity
+from models.ledgeranalytics import apply_to_summaries
+from models.migrations import TABLES, migrate
+from models.metrics import timed
+
+def ledger_timer(op):
+    return timed("ledger_write_seconds", "CoinLedger writes, including summary updates", op=op)
 
 class CoinLedger:
-    def __init__(self, db_path='data.db'):
-        """Initializes the ledger and creates the table if it doesn't exist."""
-        self.conn = sqlite3.connect(db_path)
-        self.create_table()
+    sequence = itertools.count()
+
+    def __init__(self, db_path='data.db', pool=None):
+        """
+        Attaches to the shared connection pool for db_path, or to `pool` (e.g.
+        an SQLiteDatabase's, which for ":memory:" is the only way to reach the
+        same database), and migrates its schema once per pool.
+        """
+        self.pool = acquire_pool(db_path) if pool is None else retain_pool(pool)
+        self.pool.setup_once("schema", migrate)
 
-    def create_table(self):
-        """Creates the coin_ledger table with required columns."""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS coin_ledger (
-                transactionID TEXT PRIMARY KEY,
-                timestamp TEXT,
-                userID TEXT,
-                amount REAL,
-                nonprofitID TEXT
-            )
-        ''')
-        self.conn.commit()
+    @staticmethod
+    def create_table(conn):
+        """Creates the coin_ledger table with required columns (defined in migrations.TABLES)."""
+        conn.execute(TABLES["coin_ledger"])
 
     def add(self, userID, amount, nonprofitID):
         """
@@ -34,23 +40,44 @@ class CoinLedger:
         Returns:
             str: The generated transactionID.
         """
-        # Generate a timestamp in UTC
-        timestamp = datetime.datetime.now().isoformat()
+        return self.add_many([(userID, amount, nonprofitID)])[0]
+
+    @ledger_timer("add_many")
+    def add_many(self, payments):
+        """
+        Adds several payments in a single transaction (see GroupCommitter).
+
+        Parameters:
+            payments (list): (userID, amount, nonprofitID) tuples.
+
+        Returns:
+            list: The generated transactionIDs, in the same order.
+        """
+        rows = []
+        for userID, amount, nonprofitID in payments:
+            # Generate a timestamp in UTC
+            timestamp = datetime.datetime.now().isoformat()
 
-        # Create a transactionID by hashing the timestamp and transaction details
-        transaction_data = f"{timestamp}-{userID}-{amount}-{nonprofitID}"
-        transactionID = hashlib.sha256(transaction_data.encode('utf-8')).hexdigest()
+            # Create a transactionID by hashing the timestamp and transaction details; the
+            # sequence number keeps identical payments made in the same microsecond apart
+            transaction_data = f"{timestamp}-{userID}-{amount}-{nonprofitID}-{next(self.sequence)}"
+            transactionID = hashlib.sha256(transaction_data.encode('utf-8')).hexdigest()
+            rows.append((transactionID, timestamp, userID, amount, nonprofitID))
 
-        # Insert the new transaction into the database
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO coin_ledger (transactionID, timestamp, userID, amount, nonprofitID)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (transactionID, timestamp, userID, amount, nonprofitID))
-        self.conn.commit()
+        # Insert the new transactions into the database, with their summary totals
+        with self.pool.write() as conn:
+            conn.executemany('''
+                INSERT INTO coin_ledger (transactionID, timestamp, userID, amount, nonprofitID)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            apply_to_summaries(conn, [row[1:] for row in rows])
 
-        return transactionID
+        # Feed the trending counters (removals aren't subtracted; they decay away)
+        for _, _, _, amount, nonprofitID in rows:
+            popularity.record(nonprofitID, amount=amount)
+        return [row[0] for row in rows]
 
+    @ledger_timer("remove")
     def remove(self, transactionID):
         """
         Removes a transaction from the ledger, e.g., in case of refund or cancellation.
@@ -58,12 +85,15 @@ class CoinLedger:
         Parameters:
             transactionID (str): The ID of the transaction to be removed.
         """
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            DELETE FROM coin_ledger WHERE transactionID = ?
-        ''', (transactionID,))
-        self.conn.commit()
+        with self.pool.write() as conn:
+            removed = conn.execute('''
+                SELECT timestamp, userID, amount, nonprofitID FROM coin_ledger WHERE transactionID = ?
+            ''', (transactionID,)).fetchall()
+            conn.execute('''
+                DELETE FROM coin_ledger WHERE transactionID = ?
+            ''', (transactionID,))
+            apply_to_summaries(conn, removed, sign=-1)
 
     def __del__(self):
-        """Closes the database connection when the instance is destroyed."""
-        self.conn.close()
+        """Releases the shared connection pool when the instance is destroyed."""
+        release_pool(self.pool)
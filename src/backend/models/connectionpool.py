@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config import SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, SQLITE_STATEMENT_CACHE, SQLITE_SYNCHRONOUS, METRICS_ENABLED
+from models.metrics import metrics
+
+write_wait = metrics.timer("sqlite_write_lock_wait_seconds", "Time spent waiting for the SQLite writer")
+write_hold = metrics.timer("sqlite_write_transaction_seconds", "SQLite write transactions, from lock to commit")
+
+
+class ConnectionPool:
+    """
+    The SQLite connections for one database file.
+
+    - one writer connection, used under `write_lock` so writes are serialized;
+    - one reader connection per thread (see `reader`);
+    - every connection runs in WAL mode with config.SQLITE_SYNCHRONOUS
+      (NORMAL by default) plus the mmap/cache pragmas from config, so readers
+      never block the writer and a commit doesn't fsync the database file.
+
+    sqlite3 keeps a per-connection cache of prepared statements keyed by SQL
+    text; long-lived connections with a large `cached_statements` mean the
+    fixed statements of SQLiteDatabase and CoinLedger are prepared once.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.memory = db_file == ":memory:"
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
+        self.readers = []
+        self.setup_done = set()
+        self.setup_lock = threading.Lock()
+        self.refs = 0
+        self.writer = self._connect()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+        if not self.memory:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+            conn.execute(f"PRAGMA mmap_size={int(SQLITE_MMAP_SIZE)}")
+        conn.execute(f"PRAGMA cache_size={int(SQLITE_CACHE_SIZE)}")
+        return conn
+
+    def reader(self):
+        """
+        Connection for reads on the calling thread. An in-memory database
+        only exists on the writer connection, so it is shared there.
+        """
+        if self.memory:
+            return self.writer
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+            with self.write_lock:
+                self.readers.append(conn)
+        return conn
+
+    @contextmanager
+    def write(self):
+        """
+        Serialized access to the writer connection. Commits when the block
+        succeeds, rolls back if it raises.
+        """
+        start = time.perf_counter()
+        with self.write_lock:
+            locked = time.perf_counter()
+            try:
+                yield self.writer
+            except BaseException:
+                self.writer.rollback()
+                raise
+            self.writer.commit()
+            if METRICS_ENABLED:
+                write_wait.observe(locked - start)
+                write_hold.observe(time.perf_counter() - locked)
+
+    @contextmanager
+    def snapshot(self):
+        """
+        A connection of its own holding one read transaction, for long scans
+        such as exports: every query inside sees the same committed state, and
+        WAL lets writers carry on meanwhile. In-memory databases only have the
+        writer connection, which is used as is.
+        """
+        if self.memory:
+            yield self.writer
+            return
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN")
+            yield conn
+        finally:
+            conn.rollback()
+            conn.close()
+
+    def setup_once(self, key, fn):
+        """
+        Runs `fn(pool)` the first time `key` is seen for this pool (e.g.
+        migrations.migrate); later callers wait until it has finished. `fn`
+        takes the write lock itself, through `write`, as often as it needs,
+        so other threads can still write between its transactions.
+        """
+        with self.setup_lock:
+            if key not in self.setup_done:
+                fn(self)
+                self.setup_done.add(key)
+
+    def close(self):
+        with self.write_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+            self.writer.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def acquire_pool(db_file):
+    """
+    The shared pool for `db_file`; pair every call with release_pool. Each
+    ":memory:" acquisition is its own database, as with sqlite3.connect.
+    """
+    with _pools_lock:
+        if db_file == ":memory:":
+            pool = ConnectionPool(db_file)
+        else:
+            key = os.path.abspath(db_file)
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(db_file)
+        pool.refs += 1
+        return pool
+
+
+def retain_pool(pool):
+    """Takes another reference to a pool already acquired, e.g. to share an in-memory database."""
+    with _pools_lock:
+        pool.refs += 1
+        return pool
+
+
+def release_pool(pool):
+    """Drops one reference to `pool`, closing it once nobody uses it."""
+    with _pools_lock:
+        pool.refs -= 1
+        if pool.refs > 0:
+            return
+        if not pool.memory:
+            _pools.pop(os.path.abspath(pool.db_file), None)
+    pool.close()
@@ -0,0 +1,43 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DatabaseExecutor:
+    """
+    Keeps blocking work off the event loop of the async FastAPI handlers.
+
+    - writes run on a single dedicated thread, so SQLite only ever sees one
+      writer and write transactions never interleave;
+    - reads run on a small pool whose threads each get their own connection
+      (see SQLiteDatabase.reader);
+    - CPU-bound scoring runs on its own pool so a burst of refreshQueue
+      calls can't starve database reads, and vice versa.
+    """
+
+    def __init__(self, readers=4, scorers=None):
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sqlite-reader")
+        self.scorers = ThreadPoolExecutor(max_workers=scorers, thread_name_prefix="scoring")
+
+    @staticmethod
+    async def _run(pool, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+
+    async def read(self, fn, *args, **kwargs):
+        return await self._run(self.readers, fn, *args, **kwargs)
+
+    async def write(self, fn, *args, **kwargs):
+        return await self._run(self.writer, fn, *args, **kwargs)
+
+    async def compute(self, fn, *args, **kwargs):
+        return await self._run(self.scorers, fn, *args, **kwargs)
+
+    def write_sync(self, fn, *args, **kwargs):
+        """Runs `fn` on the writer thread from synchronous code (e.g. the user flusher) and waits for it."""
+        return self.writer.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self):
+        for pool in (self.scorers, self.readers, self.writer):
+            pool.shutdown(wait=True)
@@ -0,0 +1,110 @@
+"""
+Recommendation events: each one turns a user's UserTagTable into the
+comp-tags query ({tag: weight}) that refreshQueue scores the catalog with.
+
+Events are looked up in EVENTS by the id User.chooseEvent returns. New ones
+are added with @register_event; nothing in User needs to change. Builders
+read the user's cached tag ranking and must not modify the table.
+
+An event can also register a candidate pool with @register_pool: its
+results are then picked from that short list of nonprofit ids (ranked by
+the event's query) instead of the whole catalog.
+"""
+
+from models.popularity import popularity
+
+# event id -> (name, builder); builder(tags) returns a comp-tags dict
+EVENTS = {}
+# event id -> source(); source() returns candidate nonprofit ids
+POOLS = {}
+
+COMP_TAGS = 20  # tags per query, as in UserTagTable.getCompTags
+
+
+def register_event(event_id, name):
+    def decorator(builder):
+        EVENTS[event_id] = (name, builder)
+        return builder
+    return decorator
+
+
+def register_pool(event_id):
+    def decorator(source):
+        POOLS[event_id] = source
+        return source
+    return decorator
+
+
+def event_pool(event):
+    """The candidate ids of `event`, or None when it searches the whole catalog."""
+    source = POOLS.get(event)
+    return source() if source is not None else None
+
+
+def event_comp_tags(tags, event):
+    """The query for `event`; unknown ids fall back to the basic query."""
+    entry = EVENTS.get(event)
+    if entry is None:
+        return tags.getCompTags()
+    return entry[1](tags)
+
+
+def swapped_comp_tags(tags, swaps, k=COMP_TAGS):
+    """
+    What getCompTags would return after exchanging the weights of each (a, b)
+    pair in `swaps`, in order, without copying the table: only the swapped
+    tags get new weights, so the rest of the answer is the head of the
+    cached ranking.
+    """
+    weights = tags.weights
+    overlay = {}
+    for a, b in swaps:
+        overlay[a], overlay[b] = overlay.get(b, float(weights[b])), overlay.get(a, float(weights[a]))
+    rank = tags.rank()[:k + len(overlay)].tolist()
+    candidates = [(float(weights[tag]), tag) for tag in rank if tag not in overlay]
+    candidates += [(val, tag) for tag, val in overlay.items() if val != 0 and tag in tags]
+    candidates.sort()
+    return {tag: val for val, tag in candidates[:k]}
+
+
+# -----------------
+#   Events
+# -----------------
+@register_event(0, "basic")
+def basic(tags):
+    return tags.getCompTags()
+
+
+@register_event(1, "disrupt")
+def disrupt(tags):
+    # The three lowest-ranked tags trade weights with the three highest.
+    rank = tags.rank()
+    pairs = min(3, len(rank) // 2)
+    return swapped_comp_tags(tags, [(int(rank[i]), int(rank[-1 - i])) for i in range(pairs)])
+
+
+@register_event(2, "return")
+def return_(tags):
+    # Bring back the longest-zeroed tag with the weight of the lowest-ranked one.
+    if not tags.zeroTags or not len(tags.rank()):
+        return tags.getCompTags()
+    return swapped_comp_tags(tags, [(int(tags.rank()[0]), tags.zeroTags[0])])
+
+
+# gem and trending rank their pool by the user's usual query.
+register_event(3, "gem")(basic)
+register_event(4, "trending")(basic)
+
+
+@register_pool(3)
+def gem_pool():
+    return popularity.gem_ids()
+
+
+@register_pool(4)
+def trending_pool():
+    return popularity.trending_ids()
+
+
+# Placeholder until it has a candidate pool of its own.
+register_event(5, "repeat")(basic)
@@ -0,0 +1,80 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GroupCommitter:
+    """
+    Turns many concurrent single-item writes into few transactions.
+
+    `submit(item)` queues an item and returns a Future. A background thread
+    hands everything queued to `commit(items)` in one call, which must write
+    them in a single transaction and return one result per item, in order;
+    each Future then resolves to its own result (or to the exception the
+    commit raised). Once a first item is waiting, the thread holds the batch
+    open for up to `max_delay` seconds, or until `max_batch` items, so a
+    burst of requests shares one commit instead of queueing for many.
+    """
+
+    def __init__(self, commit, max_batch=512, max_delay=0.002):
+        self.commit = commit
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []  # (item, Future) in submission order
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, item):
+        future = Future()
+        with self.cond:
+            if self.stopping:
+                raise RuntimeError("GroupCommitter is closed")
+            self.pending.append((item, future))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self.thread.start()
+            if len(self.pending) == 1 or len(self.pending) >= self.max_batch:
+                self.cond.notify()
+        return future
+
+    def _take(self):
+        """Waits for a batch to be ready and removes it from the queue; [] once closed and empty."""
+        with self.cond:
+            while not self.pending and not self.stopping:
+                self.cond.wait()
+            deadline = time.monotonic() + self.max_delay
+            while not self.stopping and len(self.pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            try:
+                results = self.commit([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self, timeout=None):
+        """Commits whatever is queued and stops the thread."""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
@@ -0,0 +1,69 @@
+# Summary tables: (table, key columns, SQL giving the key from a coin_ledger row,
+# the same key from (timestamp, userID, nonprofitID) in Python). They are created
+# and backfilled by migrations.create_ledger_summaries.
+SUMMARIES = (
+    ("ledger_nonprofit_totals", ("nonprofitID",), "nonprofitID",
+     lambda timestamp, userID, nonprofitID: (nonprofitID,)),
+    ("ledger_user_totals", ("userID",), "userID",
+     lambda timestamp, userID, nonprofitID: (userID,)),
+    ("ledger_daily_totals", ("day",), "substr(timestamp, 1, 10)",
+     lambda timestamp, userID, nonprofitID: (timestamp[:10],)),
+    ("ledger_daily_nonprofit_totals", ("nonprofitID", "day"), "nonprofitID, substr(timestamp, 1, 10)",
+     lambda timestamp, userID, nonprofitID: (nonprofitID, timestamp[:10])),
+)
+
+
+def apply_to_summaries(conn, rows, sign=1):
+    """
+    Adds (sign=1) or subtracts (sign=-1) coin_ledger rows, given as
+    (timestamp, userID, amount, nonprofitID), to every summary table. Run it
+    in the same transaction as the insert or delete it accounts for.
+    """
+    for table, keys, _, key_of in SUMMARIES:
+        conn.executemany(f'''
+            INSERT INTO {table} ({", ".join(keys)}, total, count) VALUES ({", ".join("?" for _ in keys)}, ?, ?)
+            ON CONFLICT ({", ".join(keys)}) DO UPDATE SET total = total + excluded.total, count = count + excluded.count
+        ''', [(*key_of(timestamp, userID, nonprofitID), sign * amount, sign) for timestamp, userID, amount, nonprofitID in rows])
+
+
+class LedgerAnalytics:
+    """
+    Read side of the ledger summaries kept by `ledger` (a CoinLedger). Every
+    query is a primary-key or index lookup on a summary table, so none of
+    them scans coin_ledger.
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.pool = ledger.pool
+
+    def _totals(self, row):
+        total, count = row if row is not None else (0.0, 0)
+        return {"total": total, "count": count}
+
+    def nonprofit_total(self, nonprofitID):
+        c = self.pool.reader().execute(
+            "SELECT total, count FROM ledger_nonprofit_totals WHERE nonprofitID = ?", (nonprofitID,))
+        return self._totals(c.fetchone())
+
+    def user_total(self, userID):
+        c = self.pool.reader().execute("SELECT total, count FROM ledger_user_totals WHERE userID = ?", (userID,))
+        return self._totals(c.fetchone())
+
+    def top_nonprofits(self, limit=10):
+        c = self.pool.reader().execute(
+            "SELECT nonprofitID, total, count FROM ledger_nonprofit_totals ORDER BY total DESC LIMIT ?", (limit,))
+        return [{"nonprofitID": nonprofitID, "total": total, "count": count} for nonprofitID, total, count in c]
+
+    def daily(self, start, end, nonprofitID=None):
+        """Per-day totals for days start..end inclusive (YYYY-MM-DD), for one nonprofit or everyone."""
+        if nonprofitID is None:
+            c = self.pool.reader().execute(
+                "SELECT day, total, count FROM ledger_daily_totals WHERE day BETWEEN ? AND ? ORDER BY day",
+                (start, end))
+        else:
+            c = self.pool.reader().execute(
+                "SELECT day, total, count FROM ledger_daily_nonprofit_totals "
+                "WHERE nonprofitID = ? AND day BETWEEN ? AND ? ORDER BY day", (nonprofitID, start, end))
+        days = [{"day": day, "total": total, "count": count} for day, total, count in c]
+        return {"days": days, "total": sum(d["total"] for d in days), "count": sum(d["count"] for d in days)}
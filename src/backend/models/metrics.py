@@ -0,0 +1,236 @@
+"""
+In-process metrics in the Prometheus text format, plus a sampling profiler.
+
+Hot paths are wrapped with @timed(name, help, label=value), which records a
+call count, total seconds and a latency histogram per label set. Each call
+costs two perf_counter reads and a deque append, about half a microsecond.
+With config.METRICS_ENABLED off, @timed returns the function unchanged, so
+disabled metrics cost nothing at all.
+
+Values owned elsewhere (e.g. SessionCache.stats()) are registered with
+`callback` and read only when /metrics is scraped.
+"""
+
+import collections
+import functools
+import inspect
+import sys
+import threading
+import time
+
+import numpy as np
+from config import METRICS_ENABLED, PROFILER_INTERVAL
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name + "_total" + _labels(labels), self.value
+
+
+class Timer:
+    """
+    Call count, total seconds and a cumulative histogram of durations.
+
+    observe() only appends to a deque (atomic under the GIL, no lock); the
+    durations are folded into the histogram with numpy once FOLD_EVERY are
+    waiting, and on every scrape.
+    """
+
+    FOLD_EVERY = 4096
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = np.zeros(len(BUCKETS) + 1, dtype=np.int64)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        self.pending.append(seconds)
+        if len(self.pending) >= self.FOLD_EVERY:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            count = len(self.pending)
+            if not count:
+                return
+            popleft = self.pending.popleft
+            durations = np.fromiter((popleft() for _ in range(count)), dtype=np.float64, count=count)
+            self.count += count
+            self.sum += float(durations.sum())
+            self.buckets += np.bincount(np.searchsorted(BUCKETS, durations), minlength=len(self.buckets))
+
+    def samples(self, name, labels):
+        self.fold()
+        cumulative = 0
+        for bound, hits in zip(BUCKETS + ("+Inf",), self.buckets.tolist()):
+            cumulative += hits
+            yield f"{name}_bucket" + _labels({**labels, "le": bound}), cumulative
+        yield f"{name}_sum" + _labels(labels), self.sum
+        yield f"{name}_count" + _labels(labels), self.count
+
+
+class Metrics:
+    TYPES = {Counter: "counter", Timer: "histogram"}
+
+    def __init__(self):
+        self.families = {}   # name -> (type, help, {label items: metric or callback})
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, help, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, (self.TYPES[kind], help, {}))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = kind()
+            return metric
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def timer(self, name, help="", **labels):
+        return self._get(Timer, name, help, labels)
+
+    def callback(self, name, help, fn, kind="gauge", **labels):
+        """Reports fn() as `name` on every scrape; kind is "gauge" or "counter"."""
+        with self.lock:
+            self.families.setdefault(name, (kind, help, {}))[2][tuple(sorted(labels.items()))] = fn
+
+    def render(self):
+        """Everything registered, in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            families = [(name, kind, help, list(series.items())) for name, (kind, help, series) in self.families.items()]
+        for name, kind, help, series in sorted(families):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in series:
+                if callable(metric):
+                    lines.append(f"{name}{_labels(dict(key))} {float(metric())}")
+                else:
+                    lines.extend(f"{sample} {value}" for sample, value in metric.samples(name, dict(key)))
+        return "\n".join(lines) + "\n"
+
+
+# The process-wide registry behind /metrics
+metrics = Metrics()
+
+
+def timed(name, help="", **labels):
+    """Decorator recording every call of a function (or coroutine function) in metrics.timer(name, **labels)."""
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return fn
+        timer = metrics.timer(name, help, **labels)
+        # Timer.observe inlined, with everything it touches bound here
+        pending, fold, fold_every, perf_counter = timer.pending, timer.fold, timer.FOLD_EVERY, time.perf_counter
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def timed_coroutine(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    pending.append(perf_counter() - start)
+                    if len(pending) >= fold_every:
+                        fold()
+            return timed_coroutine
+
+        @functools.wraps(fn)
+        def timed_call(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                pending.append(perf_counter() - start)
+                if len(pending) >= fold_every:
+                    fold()
+        return timed_call
+    return decorator
+
+
+# -----------------
+#   Sampling profiler
+# -----------------
+class SamplingProfiler:
+    """
+    Samples the stack of every other thread each `interval` seconds while
+    running and counts identical stacks. `collapsed()` returns them as
+    "outer;inner;leaf count" lines, the input format of flamegraph tools.
+    Stacks are counted as tuples of code objects and only turned into names
+    by collapsed(); a sample of 25 threads, ~30 frames deep, takes ~0.3 ms,
+    so at the default 50 ms the profiler thread uses under 1% of a core.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def reset(self):
+        self.stacks.clear()
+        self.samples = 0
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        names = {}
+
+        def name(code):
+            if code not in names:
+                names[code] = f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+            return names[code]
+
+        return "".join(f"{';'.join(map(name, reversed(stack)))} {count}\n"
+                       for stack, count in self.stacks.most_common())
+
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
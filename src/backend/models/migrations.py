@@ -0,0 +1,348 @@
+"""
+Schema of the backend database and the migrations that bring older files up
+to date. Every table is defined here; SQLiteDatabase and CoinLedger only
+call `migrate(pool)` (through ConnectionPool.setup_once) before using them.
+
+The version a database is at lives in `PRAGMA user_version`. Each entry of
+MIGRATIONS moves it up by one and runs once per file:
+
+- a plain function runs in a single transaction;
+- a generator function runs one transaction per `yield`, so a big table is
+  rewritten in batches and other writers get the write lock in between. Its
+  progress is stored in the database, so an interrupted run resumes where it
+  stopped. The code after the last `yield` commits together with the new
+  user_version.
+
+Each transaction starts with BEGIN IMMEDIATE and re-reads user_version, so
+two processes opening the same file never apply a migration twice.
+"""
+
+import hashlib
+import inspect
+import json
+import logging
+
+from config import LEDGER_MIGRATION_BATCH, TAGS_PATH
+from models.ledgeranalytics import SUMMARIES
+
+logger = logging.getLogger(__name__)
+
+TABLES = {
+    # User vectors, float32 blobs (see sqlite_db.vector_to_blob). revision orders the
+    # writes, kept by the USER_REVISION_TRIGGERS, for models/uservectors.py to sync from
+    "users": '''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            vector BLOB,
+            revision INTEGER
+        )
+    ''',
+    # Tags packed one byte per tag id (see sqlite_db.pack_tags), plus the normalized
+    # float32 vector the in-memory index loads without recomputing it
+    "nonprofits": '''
+        CREATE TABLE IF NOT EXISTS nonprofits (
+            id TEXT PRIMARY KEY,
+            primary_tags BLOB,
+            secondary_tags BLOB,
+            vector BLOB
+        )
+    ''',
+    # One row per payment; transactionID is the sha256 CoinLedger.add_many generates
+    "coin_ledger": '''
+        CREATE TABLE IF NOT EXISTS coin_ledger (
+            transactionID TEXT PRIMARY KEY,
+            timestamp TEXT,
+            userID TEXT,
+            amount REAL,
+            nonprofitID TEXT
+        )
+    ''',
+    # Top nonprofits per user from utils/prerank_users.py: a JSON list of ids, ranked for the
+    # user's vector as of `revision` of the users table (see uservectors.UserVectorStore)
+    "user_recommendations": '''
+        CREATE TABLE IF NOT EXISTS user_recommendations (
+            userID TEXT PRIMARY KEY,
+            nonprofits TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            computed_at TEXT NOT NULL
+        )
+    ''',
+}
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS coin_ledger_user ON coin_ledger (userID, timestamp)",
+    "CREATE INDEX IF NOT EXISTS coin_ledger_nonprofit ON coin_ledger (nonprofitID, timestamp)",
+    "CREATE INDEX IF NOT EXISTS coin_ledger_timestamp ON coin_ledger (timestamp)",
+)
+
+# Every insert, and every update of a vector, gives the row the next revision. Writers
+# hold SQLite's write lock until they commit, so revisions become visible in order: a
+# reader that has seen revision r has seen every write up to r.
+USER_REVISION_TRIGGERS = tuple(f'''
+    CREATE TRIGGER IF NOT EXISTS users_revision_{event} AFTER {clause} ON users BEGIN
+        UPDATE users SET revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM users) WHERE rowid = NEW.rowid;
+    END
+''' for event, clause in (("insert", "INSERT"), ("update", "UPDATE OF vector")))
+
+# version -> (name, step), filled in by @migration
+MIGRATIONS = {}
+
+
+def migration(version, name):
+    def decorator(step):
+        MIGRATIONS[version] = (name, step)
+        return step
+    return decorator
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def latest_version():
+    return max(MIGRATIONS)
+
+
+def _begin(conn):
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def migrate(pool):
+    """
+    Applies every pending migration to the pool's database. Returns the
+    versions applied by this call.
+    """
+    applied = []
+    for version in sorted(MIGRATIONS):
+        _, step = MIGRATIONS[version]
+        batches = None
+        while True:
+            with pool.write() as conn:
+                _begin(conn)
+                if schema_version(conn) >= version:
+                    break
+                if batches is None and inspect.isgeneratorfunction(step):
+                    batches = step(conn)
+                if batches is None:
+                    step(conn)
+                else:
+                    try:
+                        next(batches)
+                        continue
+                    except StopIteration:
+                        pass
+                # user_version can't be a bound parameter
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                applied.append(version)
+                break
+        if batches is not None:
+            batches.close()
+    return applied
+
+
+# -----------------
+#   Migrations
+# -----------------
+@migration(1, "create tables")
+def create_tables(conn):
+    # Tables that already exist keep their old layout here; the next migrations convert them
+    for ddl in TABLES.values():
+        conn.execute(ddl)
+
+
+def legacy_tags_decoder(tags_path=TAGS_PATH):
+    """
+    Decoder of the legacy text tag columns for convert_nonprofits: a JSON list
+    of tag ids (what SQLiteDatabase used to write) or comma-separated tag
+    names (what add_charities_from_json.py used to write), names mapped to
+    ids with tags.json. Raises ValueError on text it can't decode.
+    """
+    with open(tags_path, "r") as f:
+        tag_ids = {name.lower(): int(tag_id) for tag_id, name in json.load(f).items()}
+
+    def decode(text):
+        text = text.strip()
+        if not text:
+            return []
+        if text.startswith("["):
+            return json.loads(text)
+        try:
+            return [tag_ids[name.strip().lower()] for name in text.split(",")]
+        except KeyError as e:
+            raise ValueError(f"Unknown tag name {e.args[0]!r}") from None
+    return decode
+
+
+def convert_nonprofits(conn, decode=None, batch_size=1000):
+    """
+    Rewrites nonprofits rows still stored as text (or missing their vector)
+    to packed tags plus the precomputed vector, yielding after each
+    batch_size rows. `decode` turns a legacy text column into a list of tag
+    ids (legacy_tags_decoder() by default). Rows it can't decode are logged
+    and left as they are; they stay out of the catalog until fixed and
+    converted again. Rows already converted aren't selected again, so
+    stopping between batches and starting over is safe.
+    """
+    # sqlite_db imports this module, so its codecs are imported here
+    from models.sqlite_db import pack_tags, unpack_tags, vector_to_blob
+    from models.nonprofitindex import nonprofit_index
+
+    if decode is None:
+        decode = legacy_tags_decoder()
+    if "vector" not in _columns(conn, "nonprofits"):
+        conn.execute("ALTER TABLE nonprofits ADD COLUMN vector BLOB")
+    # Paged by id, so rows left unconverted aren't selected again by the next batch
+    last = ""
+    while True:
+        rows = conn.execute(
+            "SELECT id, primary_tags, secondary_tags FROM nonprofits "
+            "WHERE (vector IS NULL OR typeof(primary_tags) = 'text' OR typeof(secondary_tags) = 'text') "
+            "AND id > ? ORDER BY id LIMIT ?", (last, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        updates = []
+        for id_val, primary, secondary in rows:
+            try:
+                primary = decode(primary) if isinstance(primary, str) else unpack_tags(primary)
+                secondary = decode(secondary) if isinstance(secondary, str) else unpack_tags(secondary)
+                packed = pack_tags(primary), pack_tags(secondary)
+            except ValueError as e:
+                logger.warning("Nonprofit %s left unconverted, can't decode its tags: %s", id_val, e)
+                continue
+            vector = vector_to_blob(nonprofit_index.vector(primary, secondary))
+            updates.append((*packed, vector, id_val))
+        conn.executemany("UPDATE nonprofits SET primary_tags=?, secondary_tags=?, vector=? WHERE id=?", updates)
+        yield len(updates)
+
+
+@migration(2, "pack nonprofit tags")
+def pack_nonprofit_tags(conn):
+    yield from convert_nonprofits(conn)
+
+
+def legacy_transaction_id(id_val, timestamp, userID, amount, nonprofitID):
+    """transactionID given to a row of the old `id INTEGER` ledger; the same row always gets the same one."""
+    return hashlib.sha256(f"{timestamp}-{userID}-{amount}-{nonprofitID}-legacy-{id_val}".encode("utf-8")).hexdigest()
+
+
+@migration(3, "unify coin_ledger")
+def unify_coin_ledger(conn, batch_size=None):
+    """
+    SQLiteDatabase used to create coin_ledger with `id INTEGER PRIMARY KEY`,
+    CoinLedger with `transactionID TEXT PRIMARY KEY`; whichever ran first on
+    a file won. Old-layout ledgers are copied into the CoinLedger layout
+    batch by batch while the app keeps writing to the old table, then
+    swapped in. coin_ledger_copied maps each copied id to its new
+    transactionID, so rows added or removed during the copy are caught up
+    in the final transaction.
+    """
+    batch_size = batch_size or LEDGER_MIGRATION_BATCH
+    if "transactionID" in _columns(conn, "coin_ledger"):
+        return
+    conn.execute(TABLES["coin_ledger"].replace("EXISTS coin_ledger", "EXISTS coin_ledger_unified"))
+    conn.execute("CREATE TABLE IF NOT EXISTS coin_ledger_copied (id INTEGER PRIMARY KEY, transactionID TEXT)")
+    while True:
+        last = conn.execute("SELECT COALESCE(MAX(id), 0) FROM coin_ledger_copied").fetchone()[0]
+        rows = conn.execute(
+            "SELECT id, timestamp, userID, amount, nonprofitID FROM coin_ledger WHERE id > ? ORDER BY id LIMIT ?",
+            (last, batch_size)).fetchall()
+        if not rows:
+            break
+        ids = [legacy_transaction_id(*row) for row in rows]
+        conn.executemany(
+            "INSERT INTO coin_ledger_unified (transactionID, timestamp, userID, amount, nonprofitID) "
+            "VALUES (?, ?, ?, ?, ?)", [(tid, *row[1:]) for tid, row in zip(ids, rows)])
+        conn.executemany("INSERT INTO coin_ledger_copied (id, transactionID) VALUES (?, ?)",
+                         [(row[0], tid) for tid, row in zip(ids, rows)])
+        yield len(rows)
+    # Everything up to the last id is copied; drop copies of rows deleted since, then swap
+    conn.execute('''
+        DELETE FROM coin_ledger_unified WHERE transactionID IN (
+            SELECT transactionID FROM coin_ledger_copied WHERE id NOT IN (SELECT id FROM coin_ledger)
+        )
+    ''')
+    conn.execute("DROP TABLE coin_ledger")
+    conn.execute("ALTER TABLE coin_ledger_unified RENAME TO coin_ledger")
+    conn.execute("DROP TABLE coin_ledger_copied")
+
+
+@migration(4, "ledger summaries")
+def create_ledger_summaries(conn, batch_size=None):
+    """
+    Indexes coin_ledger (one index per transaction) and fills the summary
+    tables of ledgeranalytics from the rows already in the ledger, one rowid
+    range per transaction. ledger_summaries_backfill holds the last rowid
+    summed; rows added past it before the final transaction are summed
+    there. Removals only go through CoinLedger.remove, which waits for the
+    migration, so nothing already summed disappears meanwhile.
+    """
+    batch_size = batch_size or LEDGER_MIGRATION_BATCH
+    for ddl in INDEXES:
+        conn.execute(ddl)
+        yield 0
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ledger_summaries_backfill'").fetchone():
+        for table, keys, _, _ in SUMMARIES:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {", ".join(f"{key} TEXT" for key in keys)},
+                    total REAL NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY ({", ".join(keys)})
+                )
+            ''')
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("CREATE TABLE ledger_summaries_backfill (last INTEGER NOT NULL)")
+        conn.execute("INSERT INTO ledger_summaries_backfill (last) VALUES (0)")
+        yield 0
+    while True:
+        last = conn.execute("SELECT last FROM ledger_summaries_backfill").fetchone()[0]
+        end = conn.execute("SELECT MAX(rowid) FROM (SELECT rowid FROM coin_ledger WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                           (last, batch_size)).fetchone()[0]
+        if end is None:
+            break
+        for table, keys, expression, _ in SUMMARIES:
+            conn.execute(f'''
+                INSERT INTO {table} ({", ".join(keys)}, total, count)
+                SELECT {expression}, SUM(amount), COUNT(*) FROM coin_ledger
+                WHERE rowid > ? AND rowid <= ? GROUP BY {expression}
+                ON CONFLICT ({", ".join(keys)}) DO UPDATE SET total = total + excluded.total, count = count + excluded.count
+            ''', (last, end))
+        conn.execute("UPDATE ledger_summaries_backfill SET last = ?", (end,))
+        yield end - last
+    conn.execute("DROP TABLE ledger_summaries_backfill")
+    conn.execute("CREATE INDEX IF NOT EXISTS ledger_nonprofit_totals_total ON ledger_nonprofit_totals (total)")
+
+
+@migration(5, "user revisions")
+def add_user_revisions(conn, batch_size=5000):
+    """
+    Numbers the existing users by rowid, batch_size rows per transaction,
+    then installs the triggers that number every later write. The index on
+    revision comes first, so each batch finds where the last one stopped.
+    """
+    if "revision" not in _columns(conn, "users"):
+        conn.execute("ALTER TABLE users ADD COLUMN revision INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS users_revision ON users (revision)")
+    yield 0
+    while True:
+        # Rows inserted between batches have higher rowids, so the walk reaches them too
+        last = conn.execute("SELECT COALESCE(MAX(revision), 0) FROM users").fetchone()[0]
+        c = conn.execute("UPDATE users SET revision = rowid WHERE rowid IN "
+                         "(SELECT rowid FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?)", (last, batch_size))
+        if c.rowcount == 0:
+            break
+        yield c.rowcount
+    for ddl in USER_REVISION_TRIGGERS:
+        conn.execute(ddl)
+
+
+@migration(6, "user recommendations")
+def create_user_recommendations(conn):
+    conn.execute(TABLES["user_recommendations"])
@@ -0,0 +1,330 @@
+import threading
+from contextlib import contextmanager
+import numpy as np
+from helpers import compute_nonprofit_vector, top_k_rows
+from models.ann import IVFIndex
+from models.postings import TagPostings
+from models.sharedcatalog import SharedCatalog, SharedRows
+from config import RETRIEVAL_BACKEND, ANN_INDEX_PATH, ANN_NLIST, ANN_NPROBE, SHARED_CATALOG_DIR, SHARED_CATALOG_POLL
+from models.metrics import timed
+
+VECTOR_SIZE = 100
+
+
+def make_backend(name):
+    """Builds the candidate-retrieval backend named in config.RETRIEVAL_BACKEND."""
+    if name == "exact":
+        return None
+    if name == "ivf":
+        return IVFIndex(nlist=ANN_NLIST, nprobe=ANN_NPROBE, path=ANN_INDEX_PATH)
+    if name == "postings":
+        return TagPostings()
+    raise ValueError(f"Unknown retrieval backend {name}")
+
+
+def make_shared_catalog(directory):
+    """The SharedCatalog in config.SHARED_CATALOG_DIR, or None to keep the catalog private to the process."""
+    return SharedCatalog(directory, SHARED_CATALOG_POLL) if directory else None
+
+
+def scoring_timer(op):
+    return timed("nonprofit_scoring_seconds", "Cosine scoring of user queries against the catalog", op=op)
+
+
+class NonprofitIndex:
+    """
+    Process-wide, in-memory copy of the nonprofit catalog.
+
+    Holds every nonprofit vector (built with compute_nonprofit_vector) as the
+    rows of an L2-normalized float32 matrix, so cosine similarity against a
+    user query becomes a single matrix-vector product. When a `backend` such
+    as IVFIndex or TagPostings is set, searches go through it instead of
+    scoring every row.
+
+    With `shared` (a SharedCatalog), matrix, ids and rows are the read-only
+    mapped arrays of the published snapshot that every worker uses, instead
+    of a private copy. Adding or updating a nonprofit publishes a new
+    version, a copy of the catalog; other workers switch to it on their
+    next ensure() after polling. Inside batch(), the changes are published
+    together when the block ends. Backends are still built per process.
+    """
+
+    def __init__(self, total_tags=VECTOR_SIZE, backend=None, shared=None):
+        self.total_tags = total_tags
+        self.backend = backend
+        self.shared = shared
+        self.version = None  # of the shared snapshot mapped
+        self._buffer = np.zeros((0, total_tags), dtype=np.float32)
+        self._id_buffer = np.empty(0, dtype=object)
+        self.matrix = self._buffer
+        self.ids = self._id_buffer
+        self.rows = {}  # nonprofit id -> row in matrix
+        self.source = None
+        self.stale = True
+        self.lock = threading.RLock()
+        self.pending = None  # nonprofit id -> vector of the shared changes held back by batch()
+
+    def invalidate(self):
+        """Marks the index as stale so the next lookup reloads the catalog."""
+        self.stale = True
+
+    def vector(self, primary_tags, secondary_tags):
+        vec = compute_nonprofit_vector({"primary": primary_tags, "secondary": secondary_tags}, self.total_tags)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    @timed("nonprofit_index_load_seconds", "Full reloads of the in-memory catalog")
+    def load(self, database):
+        if self.shared is not None:
+            self._load_shared(database)
+            return
+        # Stored vectors are already normalized (see SQLiteDatabase.add_nonprofit).
+        self._id_buffer, self._buffer = database.get_nonprofit_matrix()
+        self.matrix = self._buffer
+        self.ids = self._id_buffer
+        self.rows = {nonprofit_id: row for row, nonprofit_id in enumerate(self.ids)}
+        self.source = database
+        self.stale = False
+        if self.backend is not None:
+            self.backend.build(self.matrix, self.ids)
+
+    def ensure(self, database):
+        """Loads the catalog from `database` if it is stale or was built from another database."""
+        if self.stale or self.source is not database:
+            with self.lock:
+                if self.stale or self.source is not database:
+                    self.load(database)
+        elif self.shared is not None and self.shared.outdated(self.version):
+            with self.lock:
+                snapshot = self.shared.attach()
+                if snapshot is not None and snapshot.version != self.version:
+                    self._attach(snapshot)
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _backend_ready(self):
+        return self.backend is not None and self.backend.ready
+
+    def rows_of(self, nonprofit_ids):
+        """(the ids of `nonprofit_ids` in the catalog, their matrix rows), in the order given."""
+        rows = self.rows
+        if isinstance(rows, SharedRows):
+            return rows.lookup(nonprofit_ids)
+        found = [nonprofit_id for nonprofit_id in nonprofit_ids if nonprofit_id in rows]
+        return found, np.fromiter((rows[nonprofit_id] for nonprofit_id in found), dtype=np.int64, count=len(found))
+
+    # -----------------
+    #   Shared snapshots
+    # -----------------
+    def _load_shared(self, database):
+        """
+        Maps the published snapshot. It is (re)published from `database`
+        first when there is none yet, or when this index was invalidated or
+        moved to another database, whose rows the snapshot may not match.
+        """
+        republish = self.source is not None and (self.stale or self.source is not database)
+        with self.shared.lock():
+            snapshot = None if republish else self.shared.attach()
+            if snapshot is None:
+                self.shared.publish(*database.get_nonprofit_matrix())
+                snapshot = self.shared.attach()
+        self._attach(snapshot)
+        self.source = database
+        self.stale = False
+
+    def _attach(self, snapshot, rebuild=True):
+        self._id_buffer, self._buffer = snapshot.ids, snapshot.matrix
+        # ids first: a concurrent search must never see a matrix row without its id.
+        self.ids = snapshot.ids
+        self.rows = snapshot.rows
+        self.matrix = snapshot.matrix
+        self.version = snapshot.version
+        if rebuild and self.backend is not None:
+            self.backend.build(self.matrix, self.ids)
+
+    def _publish(self, changes):
+        """
+        Publishes the latest snapshot with `changes` (nonprofit id -> vector)
+        applied as the next version and maps it: ids it has get their row
+        rewritten, the others are appended, with one copy of the catalog
+        however many changes there are. The latest snapshot may be another
+        worker's; when it was this index's own, the backend is given just
+        the changes instead of being rebuilt. With no snapshot to start from
+        the index is invalidated instead, to republish from the database.
+        """
+        with self.shared.lock():
+            latest = self.shared.attach()
+            if latest is None:
+                self.invalidate()
+                return
+            ids = list(changes)
+            vectors = np.array([changes[nonprofit_id] for nonprofit_id in ids], dtype=np.float32).reshape(len(ids), -1)
+            found, rows = latest.rows.lookup(ids)
+            updated = np.isin(ids, found)
+            size = len(latest.ids)
+            added = [nonprofit_id for nonprofit_id, is_update in zip(ids, updated) if not is_update]
+            matrix = np.empty((size + len(added), self.total_tags), dtype=np.float32)
+            matrix[:size] = latest.matrix
+            old_vectors = matrix[rows].copy()
+            # lookup() gives the found ids in the order of `ids`
+            matrix[rows] = vectors[updated]
+            matrix[size:] = vectors[~updated]
+            self.shared.publish(np.append(latest.ids, added), matrix)
+            snapshot = self.shared.attach()
+        own = latest.version == self.version
+        self._attach(snapshot, rebuild=not own)
+        if own and self._backend_ready():
+            for row, vec, old_vec in zip(rows.tolist(), vectors[updated], old_vectors):
+                self.backend.update(row, vec, old_vec)
+            for row, vec in enumerate(vectors[~updated], start=size):
+                self.backend.add(row, vec)
+
+    def _change_shared(self, nonprofit_id, vec):
+        if self.pending is not None:
+            self.pending[nonprofit_id] = vec
+        else:
+            self._publish({nonprofit_id: vec})
+
+    @contextmanager
+    def batch(self):
+        """
+        Holds back the adds and updates of a shared catalog made in the block
+        and publishes them as one version at its end, e.g. around a loop of
+        add_nonprofit calls. Other threads' changes wait for the block; its
+        own changes aren't searchable until it ends. Without a shared catalog
+        changes apply as usual.
+        """
+        with self.lock:
+            if self.pending is not None:
+                # Nested: the outermost block publishes
+                yield self
+                return
+            self.pending = {}
+            try:
+                yield self
+            finally:
+                pending, self.pending = self.pending, None
+                if pending and not self.stale:
+                    self._publish(pending)
+
+    # -----------------
+    #   Incremental updates
+    # -----------------
+    def add(self, database, nonprofit_id, primary_tags, secondary_tags):
+        """Appends a nonprofit just written to `database`; falls back to invalidating if the index isn't built from it."""
+        with self.lock:
+            self._add(database, nonprofit_id, primary_tags, secondary_tags)
+
+    def _add(self, database, nonprofit_id, primary_tags, secondary_tags):
+        if self.stale or self.source is not database or (self.backend is not None and not self._backend_ready()):
+            self.invalidate()
+            return
+        if self.shared is not None:
+            self._change_shared(nonprofit_id, self.vector(primary_tags, secondary_tags))
+            return
+        row = len(self.ids)
+        if row == len(self._buffer):
+            # Grow geometrically so a run of inserts doesn't copy the catalog each time.
+            capacity = max(16, 2 * row)
+            buffer = np.zeros((capacity, self.total_tags), dtype=np.float32)
+            buffer[:row] = self.matrix
+            id_buffer = np.empty(capacity, dtype=object)
+            id_buffer[:row] = self.ids
+            self._buffer, self._id_buffer = buffer, id_buffer
+        vec = self.vector(primary_tags, secondary_tags)
+        self._buffer[row] = vec
+        self._id_buffer[row] = nonprofit_id
+        # ids first: a concurrent search must never see a matrix row without its id.
+        self.ids = self._id_buffer[:row + 1]
+        self.matrix = self._buffer[:row + 1]
+        self.rows[nonprofit_id] = row
+        if self.backend is not None:
+            self.backend.add(row, vec)
+
+    def update(self, database, nonprofit_id, primary_tags, secondary_tags):
+        """Rewrites the row of a nonprofit whose tags just changed in `database`."""
+        with self.lock:
+            self._update(database, nonprofit_id, primary_tags, secondary_tags)
+
+    def _update(self, database, nonprofit_id, primary_tags, secondary_tags):
+        if self.shared is not None and not self.stale and self.source is database:
+            # A row missing from this worker's snapshot is appended by the publish
+            self._change_shared(nonprofit_id, self.vector(primary_tags, secondary_tags))
+            return
+        if self.stale or self.source is not database or nonprofit_id not in self.rows:
+            self.invalidate()
+            return
+        row = self.rows[nonprofit_id]
+        vec = self.vector(primary_tags, secondary_tags)
+        old_vec = self._buffer[row].copy()
+        self._buffer[row] = vec
+        if self._backend_ready():
+            self.backend.update(row, vec, old_vec)
+
+    # -----------------
+    #   Scoring
+    # -----------------
+    def normalize_query(self, query_vec):
+        query_vec = np.asarray(query_vec, dtype=np.float32)
+        norm = np.linalg.norm(query_vec)
+        if norm == 0:
+            return np.zeros(self.total_tags, dtype=np.float32)
+        return query_vec / norm
+
+    @scoring_timer("score")
+    def score(self, query_vec):
+        """Cosine similarity of `query_vec` against every nonprofit, in row order."""
+        return self.matrix @ self.normalize_query(query_vec)
+
+    @scoring_timer("score_batch")
+    def score_batch(self, query_matrix):
+        """Scores a stack of query vectors in one GEMM; row i holds the scores of query i."""
+        query_matrix = np.asarray(query_matrix, dtype=np.float32)
+        norms = np.linalg.norm(query_matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (query_matrix / norms) @ self.matrix.T
+
+    def mask(self, scores, exclude):
+        """Sets the score of every nonprofit id in `exclude` to -inf (in place)."""
+        _, rows = self.rows_of(exclude)
+        if len(rows):
+            scores[rows] = -np.inf
+        return scores
+
+    def top_k(self, scores, k):
+        """Returns the ids of the k best finite scores, best first."""
+        candidates = np.flatnonzero(np.isfinite(scores))
+        return self.ids[top_k_rows(candidates, scores[candidates], k)].tolist()
+
+    def exact_search(self, query_vec, k, exclude=()):
+        """Top-k from scoring the whole catalog; the reference approximate backends are measured against."""
+        return self.top_k(self.mask(self.score(query_vec), exclude), k)
+
+    @scoring_timer("search")
+    def search(self, query_vec, k, exclude=()):
+        """Top-k nonprofit ids for `query_vec`, skipping any id in `exclude`."""
+        if self._backend_ready():
+            return self.backend.search(self, self.normalize_query(query_vec), k, exclude)
+        return self.exact_search(query_vec, k, exclude)
+
+    @scoring_timer("search_among")
+    def search_among(self, query_vec, candidates, k, exclude=()):
+        """Top-k of the nonprofit ids in `candidates` only (e.g. a trending pool), skipping any id in `exclude`."""
+        _, rows = self.rows_of([i for i in candidates if i not in exclude])
+        if not len(rows):
+            return []
+        return self.ids[top_k_rows(rows, self.matrix[rows] @ self.normalize_query(query_vec), k)].tolist()
+
+    @scoring_timer("search_batch")
+    def search_batch(self, query_matrix, k, excludes):
+        """search() for a stack of queries; the exact path scores all of them in one GEMM."""
+        if self._backend_ready():
+            return [self.search(query, k, exclude) for query, exclude in zip(query_matrix, excludes)]
+        scores = self.score_batch(query_matrix)
+        return [self.top_k(self.mask(row, exclude), k) for row, exclude in zip(scores, excludes)]
+
+
+# The shared, process-wide index.
+nonprofit_index = NonprofitIndex(backend=make_backend(RETRIEVAL_BACKEND), shared=make_shared_catalog(SHARED_CATALOG_DIR))
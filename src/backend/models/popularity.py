@@ -0,0 +1,165 @@
+import math
+import threading
+import time
+
+import numpy as np
+from config import POPULARITY_HALF_LIFE, POPULARITY_POOL_SIZE, GEM_MAX_EXPOSURE
+
+
+class Popularity:
+    """
+    Exponentially decayed engagement counters per nonprofit, plus the
+    "trending" and "gem" candidate pools built from them.
+
+    Counters live in float arrays indexed by a slot per nonprofit id. Rather
+    than decaying every counter on each tick, values are stored relative to
+    `epoch`: an event at time t adds exp(rate * (t - epoch)), and a stored
+    value v is worth v * exp(-rate * (now - epoch)). Decay then never changes
+    the order of two stored values, so the trending pool (the pool_size
+    highest scores, which only ever grow) is kept exact by checking just the
+    nonprofit that changed. Gem scores are ratios that can also fall, so
+    that pool is updated the same way and rebuilt from the arrays every
+    `rebuild_every` updates to pick up anything it missed.
+    """
+
+    LIKE_WEIGHT = 1.0
+    DONATION_WEIGHT = 3.0
+    AMOUNT_WEIGHT = 0.1  # per coin recorded in the ledger
+    GEM_PRIOR = 10.0     # exposures added to every gem ratio, so a single like isn't a gem
+
+    def __init__(self, half_life=86400.0, pool_size=50, gem_max_exposure=50.0, rebuild_every=1000, clock=time.monotonic):
+        self.rate = math.log(2) / half_life
+        self.pool_size = pool_size
+        self.gem_max_exposure = gem_max_exposure
+        self.rebuild_every = rebuild_every
+        self.clock = clock
+        self.epoch = clock()
+        self.slots = {}  # nonprofit id -> slot
+        self.ids = []    # slot -> nonprofit id
+        self.likes = np.zeros(16)
+        self.donations = np.zeros(16)
+        self.amounts = np.zeros(16)
+        self.exposure = np.zeros(16)
+        self.trending = {}  # slot -> stored trending score, for the top pool_size
+        self.gems = {}      # slot -> gem score when last updated
+        self.updates = 0
+        self.lock = threading.Lock()
+
+    def _slot(self, nonprofit_id):
+        slot = self.slots.get(nonprofit_id)
+        if slot is None:
+            slot = self.slots[nonprofit_id] = len(self.ids)
+            self.ids.append(nonprofit_id)
+            if slot == len(self.likes):
+                for name in ("likes", "donations", "amounts", "exposure"):
+                    grown = np.zeros(2 * slot)
+                    grown[:slot] = getattr(self, name)
+                    setattr(self, name, grown)
+        return slot
+
+    def _boost(self):
+        """What one event is worth in stored units right now; moves the epoch forward before it overflows."""
+        now = self.clock()
+        boost = math.exp(self.rate * (now - self.epoch))
+        if boost > 1e100:
+            for counters in (self.likes, self.donations, self.amounts, self.exposure):
+                counters /= boost
+            self.trending = {slot: score / boost for slot, score in self.trending.items()}
+            self.epoch, boost = now, 1.0
+        return boost
+
+    def _gem_score(self, slots, boost):
+        """likes + donations per exposure (decay cancels out of the ratio); -inf when not a gem."""
+        engagement = self.likes[slots] + self.donations[slots]
+        exposure = self.exposure[slots]
+        score = engagement / (exposure + self.GEM_PRIOR * boost)
+        return np.where((engagement > 0) & (exposure < self.gem_max_exposure * boost), score, -np.inf)
+
+    @staticmethod
+    def _offer(pool, slot, score, size):
+        """Keeps `pool` the `size` best slots after `slot`'s score changed."""
+        if slot in pool or len(pool) < size:
+            pool[slot] = score
+            return
+        weakest = min(pool, key=pool.get)
+        if score > pool[weakest]:
+            del pool[weakest]
+            pool[slot] = score
+
+    # -----------------
+    #   Recording
+    # -----------------
+    def record(self, nonprofit_id, likes=0, donations=0, amount=0.0, exposure=0):
+        with self.lock:
+            boost = self._boost()
+            slot = self._slot(nonprofit_id)
+            self.likes[slot] += likes * boost
+            self.donations[slot] += donations * boost
+            self.amounts[slot] += amount * boost
+            self.exposure[slot] += exposure * boost
+            self._reoffer([slot], boost)
+
+    def record_many(self, nonprofit_ids, likes=0, donations=0, amount=0.0, exposure=0):
+        """Adds the same events to each nonprofit in `nonprofit_ids` (e.g. a page of /nextN results)."""
+        with self.lock:
+            boost = self._boost()
+            slots = np.fromiter((self._slot(i) for i in nonprofit_ids), dtype=np.int64)
+            if not len(slots):
+                return
+            np.add.at(self.likes, slots, likes * boost)
+            np.add.at(self.donations, slots, donations * boost)
+            np.add.at(self.amounts, slots, amount * boost)
+            np.add.at(self.exposure, slots, exposure * boost)
+            self._reoffer(dict.fromkeys(slots.tolist()), boost)
+
+    def _reoffer(self, slots, boost):
+        for slot in slots:
+            trending = (self.LIKE_WEIGHT * self.likes[slot] + self.DONATION_WEIGHT * self.donations[slot]
+                        + self.AMOUNT_WEIGHT * self.amounts[slot])
+            if trending > 0:
+                self._offer(self.trending, slot, float(trending), self.pool_size)
+            engagement = self.likes[slot] + self.donations[slot]
+            exposure = self.exposure[slot]
+            if engagement > 0 and exposure < self.gem_max_exposure * boost:
+                self._offer(self.gems, slot, float(engagement / (exposure + self.GEM_PRIOR * boost)), self.pool_size)
+            else:
+                self.gems.pop(slot, None)
+        self.updates += 1
+        if self.updates % self.rebuild_every == 0:
+            self._rebuild_gems(boost)
+
+    def _rebuild_gems(self, boost):
+        scores = self._gem_score(np.arange(len(self.ids)), boost)
+        candidates = np.flatnonzero(np.isfinite(scores))
+        if len(candidates) > self.pool_size:
+            candidates = candidates[np.argpartition(-scores[candidates], self.pool_size - 1)[:self.pool_size]]
+        self.gems = {int(slot): float(scores[slot]) for slot in candidates}
+
+    # -----------------
+    #   Pools
+    # -----------------
+    def _ranked(self, pool):
+        with self.lock:
+            return [self.ids[slot] for slot in sorted(pool, key=pool.get, reverse=True)]
+
+    def trending_ids(self):
+        """The pool_size nonprofits with the most decayed engagement, best first."""
+        return self._ranked(self.trending)
+
+    def gem_ids(self):
+        """Well-liked nonprofits that few users have been shown yet, best first."""
+        return self._ranked(self.gems)
+
+    def counters(self, nonprofit_id):
+        """The current decayed counters of one nonprofit."""
+        with self.lock:
+            slot = self.slots.get(nonprofit_id)
+            if slot is None:
+                return {"likes": 0.0, "donations": 0.0, "amount": 0.0, "exposure": 0.0}
+            decay = math.exp(-self.rate * (self.clock() - self.epoch))
+            return {"likes": self.likes[slot] * decay, "donations": self.donations[slot] * decay,
+                    "amount": self.amounts[slot] * decay, "exposure": self.exposure[slot] * decay}
+
+
+# The shared, process-wide counters.
+popularity = Popularity(POPULARITY_HALF_LIFE, POPULARITY_POOL_SIZE, GEM_MAX_EXPOSURE)
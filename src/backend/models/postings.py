@@ -0,0 +1,126 @@
+import numpy as np
+from helpers import top_k_rows
+
+
+class TagPostings:
+    """
+    Inverted index from tag id to the nonprofits carrying that tag.
+
+    A nonprofit vector has ~23 nonzero entries (3 primary, 20 secondary), so
+    each tag's postings are split into two impact tiers: the "high" tier holds
+    the rows for which the tag is one of their heaviest weights (the primary
+    tags), the "low" tier the rest. A search accumulates only the high-tier
+    postings of the query's active tags, then uses the largest low-tier weight
+    of each tag as an upper bound (max-score) to prune every row that can no
+    longer reach the top k. Survivors are rescored exactly, so results match
+    exact search while the work scales with the postings the query touches.
+    """
+
+    def __init__(self, total_tags=100, tier_ratio=0.5):
+        self.total_tags = total_tags
+        self.tier_ratio = tier_ratio  # weight >= ratio * row max -> high tier
+        self.ready = False
+        # (tag, tier) -> (rows, weights) arrays. Writers (under NonprofitIndex.lock) replace a
+        # whole entry, never modify one, so searches on other threads only ever read.
+        self.tiers = {}
+        self.low_max = np.zeros(total_tags, dtype=np.float32)
+
+    # -----------------
+    #   Building
+    # -----------------
+    def build(self, matrix, ids=None):
+        rows, tags = np.nonzero(matrix)
+        weights = matrix[rows, tags]
+        low = weights < self.tier_ratio * matrix.max(axis=1)[rows]
+        self.low_max = np.zeros(self.total_tags, dtype=np.float32)
+        np.maximum.at(self.low_max, tags[low], weights[low])
+        # Group the nonzeros by (tag, tier), each group in row order.
+        keys = tags * 2 + low
+        order = np.lexsort((rows, keys))
+        rows, weights, keys = rows[order], weights[order], keys[order]
+        bounds = np.searchsorted(keys, np.arange(2 * self.total_tags + 1))
+        self.tiers = {}
+        for tag in range(self.total_tags):
+            for offset, tier in enumerate(("high", "low")):
+                start, end = bounds[2 * tag + offset], bounds[2 * tag + offset + 1]
+                self.tiers[(tag, tier)] = (rows[start:end], weights[start:end])
+        self.ready = True
+
+    # -----------------
+    #   Incremental updates
+    # -----------------
+    def _split(self, vec):
+        tags = np.flatnonzero(vec)
+        if len(tags) == 0:
+            return []
+        row_max = vec[tags].max()
+        return [(tag, "high" if vec[tag] >= self.tier_ratio * row_max else "low") for tag in tags.tolist()]
+
+    def add(self, row, vec):
+        for tag, tier in self._split(vec):
+            rows, weights = self._postings(tag, tier)
+            self.tiers[(tag, tier)] = (np.append(rows, np.int64(row)), np.append(weights, np.float32(vec[tag])))
+            if tier == "low":
+                self.low_max[tag] = max(self.low_max[tag], vec[tag])
+
+    def update(self, row, vec, old_vec):
+        for key in self._split(old_vec):
+            rows, weights = self._postings(*key)
+            keep = rows != row
+            self.tiers[key] = (rows[keep], weights[keep])
+        # low_max is left as is: a stale, larger bound only prunes less.
+        self.add(row, vec)
+
+    # -----------------
+    #   Search
+    # -----------------
+    def _postings(self, tag, tier):
+        return self.tiers.get((tag, tier), (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+
+    def _gather(self, tags, query_vec, tiers, catalog_size):
+        """Sums query_vec[tag] * weight over the given tiers' postings; returns (rows, sums)."""
+        rows, contributions = [], []
+        for tag in tags:
+            for tier in tiers:
+                tag_rows, tag_weights = self._postings(tag, tier)
+                rows.append(tag_rows)
+                contributions.append(tag_weights * query_vec[tag])
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows = np.concatenate(rows)
+        contributions = np.concatenate(contributions)
+        if 8 * len(rows) >= catalog_size:
+            # Dense enough that a scratch accumulator beats sorting the postings.
+            sums = np.bincount(rows, weights=contributions, minlength=catalog_size)
+            unique = np.flatnonzero(sums)
+            return unique, sums[unique]
+        unique, inverse = np.unique(rows, return_inverse=True)
+        return unique, np.bincount(inverse, weights=contributions, minlength=len(unique))
+
+    def search(self, index, query_vec, k, exclude=()):
+        """Top-k nonprofit ids for an already normalized `query_vec`; same result as exact search."""
+        tags = np.flatnonzero(query_vec > 0).tolist()
+        _, excluded = index.rows_of(exclude)
+
+        candidates, partial = self._gather(tags, query_vec, ("high",), len(index))
+        if len(excluded):
+            keep = ~np.isin(candidates, excluded)
+            candidates, partial = candidates[keep], partial[keep]
+        bound = float(np.dot(self.low_max[tags], query_vec[tags])) if tags else 0.0
+        threshold = np.partition(partial, len(partial) - k)[len(partial) - k] if len(partial) >= k else 0.0
+        if len(partial) >= k and bound < threshold:
+            # Rows with no high-tier hit score at most `bound`, so only
+            # high-tier candidates that can still reach the k-th best survive.
+            survivors = candidates[partial + bound >= threshold]
+        else:
+            survivors, _ = self._gather(tags, query_vec, ("high", "low"), len(index))
+            if len(excluded):
+                survivors = survivors[~np.isin(survivors, excluded)]
+
+        scores = index.matrix[survivors] @ query_vec
+        positive = scores > 0
+        if positive.sum() < k:
+            # Too few rows share a tag with the query; the rest tie at zero and
+            # exact search breaks that tie by catalog order.
+            return index.exact_search(query_vec, k, exclude)
+        return index.ids[top_k_rows(survivors[positive], scores[positive], k)].tolist()
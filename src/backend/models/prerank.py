@@ -0,0 +1,81 @@
+"""
+Offline pre-ranking: the top nonprofits of every stored user for the basic
+event, computed in chunks of users with one matrix product per chunk.
+utils/prerank_users.py runs it over the user vector store (see
+models/uservectors.py) in a process pool and writes user_recommendations;
+loadUser seeds a returning user's upcomingQueue from there, so their first
+pages need no catalog search.
+"""
+
+import numpy as np
+
+from helpers import top_k_rows
+from models.events import COMP_TAGS
+from models.sqlite_db import SQLiteDatabase
+from models.uservectors import UserVectorStore
+
+
+def basic_queries(weights, k=COMP_TAGS):
+    """
+    The basic-event query vector of each row of stored tag weights, i.e.
+    compute_query_vectory(UserTagTable(vector=row).getCompTags()) for all
+    rows at once: the k nonzero weights ranked lowest by (weight, tag), zero
+    elsewhere.
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    # A stable sort keeps equal weights in tag order, as UserTagTable.rank does
+    ranked = np.argsort(np.where(weights != 0, weights, np.inf), axis=1, kind="stable")[:, :k]
+    queries = np.zeros_like(weights)
+    np.put_along_axis(queries, ranked, np.take_along_axis(weights, ranked, axis=1), axis=1)
+    return queries
+
+
+def rank_users(weights, catalog_ids, catalog_matrix, n):
+    """
+    The n best nonprofit ids for each row of tag weights, best first, by
+    cosine against the catalog's unit rows like NonprofitIndex.search_batch.
+    Equal scores rank in catalog order, so the result is what search_batch()
+    returns on the exact backend.
+    """
+    queries = basic_queries(weights)
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    scores = (queries / norms) @ catalog_matrix.T
+    size = scores.shape[1]
+    n = min(n, size)
+    if n == 0:
+        return [[] for _ in range(len(scores))]
+    # Partitioning the scores as they are: negating them first costs a copy of the chunk
+    top = np.argpartition(scores, size - n, axis=1)[:, size - n:] if n < size else np.tile(np.arange(n), (len(scores), 1))
+    # argpartition picks any of the nonprofits tied at the cut; the rare rows with ties
+    # left out are redone the way search_batch() breaks them
+    picked = np.take_along_axis(scores, top, axis=1)
+    cut = picked.min(axis=1, keepdims=True)
+    for row in np.flatnonzero((scores == cut).sum(axis=1) > (picked == cut).sum(axis=1)):
+        top[row] = top_k_rows(np.arange(size), scores[row], n)
+        picked[row] = scores[row, top[row]]
+    # Best first; equal scores in catalog order
+    order = np.lexsort((top, -picked), axis=1)
+    return catalog_ids[np.take_along_axis(top, order, axis=1)].tolist()
+
+
+# ---------------------
+#   Pool workers
+# ---------------------
+# Each process of the pool loads the catalog once and maps the store
+worker = {}
+
+
+def init_worker(database_path, store_directory):
+    database = SQLiteDatabase(database_path)
+    worker["catalog"] = database.get_nonprofit_matrix()
+    database.close()
+    worker["store"] = UserVectorStore(store_directory)
+
+
+def rank_rows(task):
+    """(user ids, rankings) of the store's rows [start, stop); task is (start, stop, n)."""
+    start, stop, n = task
+    store = worker["store"]
+    ids, matrix = worker["catalog"]
+    return store.ids[start:stop].tolist(), rank_users(store.matrix[start:stop], ids, matrix, n)
@@ -0,0 +1,98 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class QueueRefiller:
+    """
+    Tops up users' upcoming queues in the background, so getNextN finds
+    them filled instead of scanning the catalog inline.
+
+    `request(user)` is called after a user is served; if their queue is
+    below `low_water` they are put on the refill list, or moved to its
+    end if already there. A daemon thread repeatedly takes up to
+    `max_batch` users from that end, i.e. the most recently active first,
+    and hands them to `refresh(users)` (models.user.refreshQueues scores
+    them in one pass). Users still below the mark afterwards go back on
+    the list, unless their refresh found nothing new.
+    """
+
+    def __init__(self, refresh, low_water=10, max_batch=64):
+        self.refresh = refresh
+        self.low_water = low_water
+        self.max_batch = max_batch
+        self.pending = OrderedDict()  # userID -> User, least recently requested first
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.busy = False  # a batch is being refreshed
+        self.batches = 0
+        self.refills = 0
+
+    def request(self, user):
+        if len(user.upcomingQueue) >= self.low_water:
+            return
+        with self.cond:
+            if self.stopping:
+                return
+            self.pending[user.id] = user
+            self.pending.move_to_end(user.id)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="queue-refill", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def _take(self):
+        """The most recently requested users still below the mark; [] once closed."""
+        with self.cond:
+            while True:
+                while not self.pending and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return []
+                batch = []
+                while self.pending and len(batch) < self.max_batch:
+                    _, user = self.pending.popitem(last=True)
+                    if len(user.upcomingQueue) < self.low_water:
+                        batch.append(user)
+                if batch:
+                    self.busy = True
+                    return batch
+                self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            users = self._take()
+            if not users:
+                return
+            before = [len(user.upcomingQueue) for user in users]
+            try:
+                self.refresh(users)
+                self.batches += 1
+                self.refills += len(users)
+                for user, length in zip(users, before):
+                    if length < len(user.upcomingQueue) < self.low_water:
+                        self.request(user)
+            except Exception:
+                logger.exception("Failed to refill %d queues", len(users))
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Blocks until nothing is waiting for a refill (for tests and benchmarks)."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    def close(self, timeout=None):
+        """Drops pending refills and stops the thread."""
+        with self.cond:
+            self.stopping = True
+            self.pending.clear()
+            self.cond.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class SessionCache:
+    """
+    Bounded LRU cache of logged-on users with an idle timeout.
+
+    `get` returns the cached User, loading it with `loader(userID)` on a miss.
+    Every access moves the user to the most-recently-used end, so the front of
+    the OrderedDict is always the longest-idle user: expiring idle users and
+    evicting for capacity both pop from the front in O(1). Every user that
+    leaves the cache is handed to `on_evict(user)` so it can be persisted.
+
+    The lock only guards the bookkeeping: loader and on_evict run outside it,
+    so a miss (a SQLite read) doesn't hold up hits for other users. Concurrent
+    misses for one user share a single load, and a user on their way out is
+    reused as is until on_evict has taken them, so a reload never reads the
+    database before their last state is handed over.
+    """
+
+    def __init__(self, loader, on_evict, max_users=10_000, idle_ttl=3600.0, clock=time.monotonic):
+        self.loader = loader
+        self.on_evict = on_evict
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # userID -> (User, last access time)
+        self.loading = {}             # userID -> Future of the load in progress
+        self.evicting = {}            # userID -> User popped but not yet handed to on_evict
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __contains__(self, userID):
+        return userID in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, userID):
+        """Returns the user, loading them on a miss, and marks them as just active."""
+        now = self.clock()
+        with self.lock:
+            evicted = self._expire(now)
+            entry = self.entries.get(userID)
+            if entry is not None:
+                self.hits += 1
+                self.entries[userID] = (entry[0], now)
+                self.entries.move_to_end(userID)
+            else:
+                self.misses += 1
+                pending = self.loading.get(userID)
+                if pending is None and userID in self.evicting:
+                    # on_evict still gets them; what it persists is this same object
+                    evicted += self._insert(userID, self.evicting[userID], now)
+                    entry = self.entries[userID]
+                elif pending is None:
+                    load = self.loading[userID] = Future()
+        self._hand_off(evicted)
+        if entry is not None:
+            return entry[0]
+        if pending is not None:
+            return pending.result()
+        try:
+            user = self.loader(userID)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[userID]
+            load.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[userID]
+            evicted = self._insert(userID, user, self.clock())
+        load.set_result(user)
+        self._hand_off(evicted)
+        return user
+
+    def _insert(self, userID, user, now):
+        """Caches a user; returns the (userID, User) pairs evicted for capacity. Call with the lock held."""
+        self.entries[userID] = (user, now)
+        evicted = []
+        while len(self.entries) > self.max_users:
+            evicted.append(self._pop_oldest())
+            self.evictions += 1
+        return evicted
+
+    def peek(self, userID):
+        """The cached user, or None, without loading or refreshing their activity."""
+        entry = self.entries.get(userID)
+        return entry[0] if entry is not None else None
+
+    def evict(self, userID):
+        """Removes a user now (e.g. on logout) and hands them to on_evict."""
+        with self.lock:
+            entry = self.entries.pop(userID, None)
+            if entry is not None:
+                self.evicting[userID] = entry[0]
+                self.evictions += 1
+        if entry is not None:
+            self._hand_off([(userID, entry[0])])
+        return entry is not None
+
+    def expire(self, now=None):
+        """Evicts every user idle for longer than idle_ttl."""
+        now = self.clock() if now is None else now
+        with self.lock:
+            evicted = self._expire(now)
+        self._hand_off(evicted)
+
+    def _expire(self, now):
+        evicted = []
+        while self.entries:
+            _, (_, last_access) = next(iter(self.entries.items()))
+            if now - last_access <= self.idle_ttl:
+                break
+            evicted.append(self._pop_oldest())
+            self.expirations += 1
+        return evicted
+
+    def _pop_oldest(self):
+        userID, (user, _) = self.entries.popitem(last=False)
+        self.evicting[userID] = user
+        return userID, user
+
+    def _hand_off(self, evicted):
+        """on_evict for the (userID, User) pairs popped from the cache, outside the lock."""
+        for userID, user in evicted:
+            try:
+                self.on_evict(user)
+            finally:
+                with self.lock:
+                    if self.evicting.get(userID) is user:
+                        del self.evicting[userID]
+
+    def clear(self):
+        """Evicts everyone, e.g. on shutdown."""
+        with self.lock:
+            evicted = []
+            while self.entries:
+                evicted.append(self._pop_oldest())
+                self.evictions += 1
+        self._hand_off(evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
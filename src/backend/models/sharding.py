@@ -0,0 +1,47 @@
+"""
+Which worker process owns a user.
+
+Logged-on users live in each worker's CachedUsers, so every request for a
+user has to reach the same worker; otherwise two workers hold diverging
+copies of their UserTagTable and whichever flushes last wins. HashRing maps
+a userID to its owner shard with consistent hashing: each shard has
+`replicas` points on a 64-bit ring, and a user belongs to the first point at
+or after the hash of their id. Changing the number of shards only moves the
+users on the points that changed, about 1/N of them, instead of nearly all
+of them as `hash % N` would.
+
+The hash is blake2b rather than hash(), which is salted per process, so
+the router and every worker agree on the owner.
+"""
+
+import bisect
+import hashlib
+
+
+def stable_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, shards, replicas=64):
+        if shards < 1:
+            raise ValueError("A ring needs at least one shard")
+        self.shards = shards
+        points = sorted((stable_hash(f"shard-{shard}-{replica}"), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self.points = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    def owner(self, userID):
+        """Index of the shard that owns `userID`."""
+        if self.shards == 1:
+            return 0
+        i = bisect.bisect_left(self.points, stable_hash(userID))
+        return self.owners[i % len(self.points)]
+
+    def split(self, userIDs):
+        """userIDs grouped by owner: {shard: [userID, ...]}, each group in the order given."""
+        groups = {}
+        for userID in userIDs:
+            groups.setdefault(self.owner(userID), []).append(userID)
+        return groups
@@ -0,0 +1,156 @@
+"""
+The nonprofit catalog published once for every worker process on a host.
+
+A snapshot is three .npy files in the catalog directory, all written by
+np.save and mapped read-only with np.load(mmap_mode="r"):
+
+    matrix-<version>.npy   float32 (n, VECTOR_SIZE), row i is nonprofit ids[i]
+    ids-<version>.npy      the ids, fixed-width unicode, in row order
+    order-<version>.npy    argsort of the ids, for binary-search lookups
+
+The page cache holds one copy however many workers map them. CURRENT names
+the version to use and is replaced with os.replace after the files are
+complete, so a reader sees the old snapshot or the new one, never half of
+one. Publishers take an flock on the directory's lock file, so each new
+version starts from the latest one. The two previous versions are kept for
+workers still switching over; on POSIX, removing a file a worker still maps
+doesn't affect that mapping.
+"""
+
+import fcntl
+import os
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import numpy as np
+
+KEEP_VERSIONS = 3
+
+
+class SharedRows(Mapping):
+    """
+    nonprofit id -> matrix row of a snapshot, by binary search over its ids
+    in `order`, so no worker builds a dict with an entry per nonprofit.
+    lookup() resolves many ids in one vectorized search.
+    """
+
+    def __init__(self, ids, order):
+        self.ids = ids
+        self.order = order
+
+    def __getitem__(self, nonprofit_id):
+        pos = int(np.searchsorted(self.ids, nonprofit_id, sorter=self.order))
+        if pos < len(self.order):
+            row = int(self.order[pos])
+            if self.ids[row] == nonprofit_id:
+                return row
+        raise KeyError(nonprofit_id)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, nonprofit_ids):
+        """(ids found, their rows) for a list of ids, in the order given."""
+        nonprofit_ids = list(nonprofit_ids)
+        if not nonprofit_ids or not len(self.order):
+            return [], np.empty(0, dtype=np.int64)
+        keys = np.asarray(nonprofit_ids, dtype=str)
+        pos = np.searchsorted(self.ids, keys, sorter=self.order)
+        rows = self.order[np.minimum(pos, len(self.order) - 1)].astype(np.int64)
+        found = np.flatnonzero(self.ids[rows] == keys)
+        return [nonprofit_ids[i] for i in found.tolist()], rows[found]
+
+
+class Snapshot:
+    """One mapped version of the catalog."""
+
+    def __init__(self, version, ids, matrix, order):
+        self.version = version
+        self.ids = ids
+        self.matrix = matrix
+        self.rows = SharedRows(ids, order)
+
+
+class SharedCatalog:
+    """
+    The snapshots in `directory`. Workers notice a version published by
+    another process within `poll_interval` seconds (see outdated()).
+    """
+
+    def __init__(self, directory, poll_interval=0.5):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+        self.current_path = os.path.join(directory, "CURRENT")
+        self.next_poll = 0.0
+
+    def _path(self, kind, version):
+        return os.path.join(self.directory, f"{kind}-{version:08d}.npy")
+
+    @contextmanager
+    def lock(self):
+        """Exclusive across processes; hold it to read the latest version and publish the next."""
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def current_version(self):
+        """The published version, or None before the first publish."""
+        try:
+            with open(self.current_path, "rb") as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def outdated(self, version):
+        """
+        Whether a version other than `version` is current. Reads CURRENT at
+        most once per poll_interval and answers False in between, since
+        ensure() asks on every search.
+        """
+        now = time.monotonic()
+        if now < self.next_poll:
+            return False
+        self.next_poll = now + self.poll_interval
+        return self.current_version() != version
+
+    def attach(self):
+        """Maps the current snapshot; None if nothing is published yet."""
+        while True:
+            version = self.current_version()
+            if version is None:
+                return None
+            try:
+                ids, matrix, order = (np.load(self._path(kind, version), mmap_mode="r") for kind in ("ids", "matrix", "order"))
+            except FileNotFoundError:
+                # Pruned by publishes in between; CURRENT has moved on
+                continue
+            # Plain ndarray views, so results computed from them aren't memmaps
+            return Snapshot(version, ids.view(np.ndarray), matrix.view(np.ndarray), order.view(np.ndarray))
+
+    def publish(self, ids, matrix):
+        """Writes (ids, matrix) as the next version and makes it current. Call with lock() held."""
+        version = (self.current_version() or 0) + 1
+        ids = np.asarray(ids, dtype=str)
+        arrays = {"ids": ids, "matrix": np.ascontiguousarray(matrix, dtype=np.float32),
+                  "order": np.argsort(ids, kind="stable").astype(np.int64)}
+        for kind, array in arrays.items():
+            path = self._path(kind, version)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(path + ".tmp", path)
+        with open(self.current_path + ".tmp", "w") as f:
+            f.write(str(version))
+        os.replace(self.current_path + ".tmp", self.current_path)
+        for name in os.listdir(self.directory):
+            kind, _, rest = name.partition("-")
+            if kind in arrays and rest.endswith(".npy") and rest[:-4].isdigit() and int(rest[:-4]) <= version - KEEP_VERSIONS:
+                os.remove(os.path.join(self.directory, name))
+        return version
@@ -1,11 +1,19 @@
 import sqlite3
 import numpy as np
 import json
+import datetime
 from models.nonprofit import NonProfit  # your NonProfit class
 from helpers import recover_nonprofit_tags  # helper that recovers primary/secondary tags
+from models.nonprofitindex import nonprofit_index
+from models.connectionpool import acquire_pool, release_pool
+from models.migrations import migrate
+from models.metrics import timed
 
 VECTOR_SIZE = 100
 
+def db_timer(op):
+    return timed("sqlite_call_seconds", "SQLiteDatabase calls (one statement or transaction each)", op=op)
+
 def vector_to_blob(vector: np.ndarray) -> bytes:
     vector = np.asarray(vector, dtype=np.float32).reshape(VECTOR_SIZE)
     return vector.tobytes()
@@ -13,59 +21,52 @@ def vector_to_blob(vector: np.ndarray) -> bytes:
 def blob_to_vector(blob: bytes) -> np.ndarray:
     return np.frombuffer(blob, dtype=np.float32)
 
+def pack_tags(tags) -> bytes:
+    """Tag ids as one byte each, order kept (primary tags are listed most important first)."""
+    tags = np.asarray(tags, dtype=np.int64)
+    if tags.size and (tags.min() < 0 or tags.max() > 255):
+        raise ValueError(f"Tag ids must be in 0..255, got {tags.tolist()}")
+    return tags.astype(np.uint8).tobytes()
+
+def unpack_tags(blob) -> list:
+    """Inverse of pack_tags. Rows not yet migrated still hold JSON text, which is decoded as before."""
+    if isinstance(blob, str):
+        return json.loads(blob)
+    return np.frombuffer(blob, dtype=np.uint8).tolist()
+
 class SQLiteDatabase:
     def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.db_file = db_file
+        self.pool = acquire_pool(db_file)
         self.ensure_tables()
 
+    def reader(self):
+        """Connection to run reads on; one per thread for file databases (see ConnectionPool)."""
+        return self.pool.reader()
+
     def ensure_tables(self):
-        c = self.conn.cursor()
-        # Create the users table (using a BLOB for the vector)
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                vector BLOB
-            )
-        ''')
-        # Create the nonprofits table with id, primary_tags, and secondary_tags stored as JSON text
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS nonprofits (
-                id TEXT PRIMARY KEY,
-                primary_tags TEXT,
-                secondary_tags TEXT
-            )
-        ''')
-        # Create the coin_ledger table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS coin_ledger (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT,
-                userID TEXT,
-                amount REAL,
-                nonprofitID TEXT
-            )
-        ''')
-        self.conn.commit()
+        self.pool.setup_once("schema", migrate)
 
+    @db_timer("add_vector")
     def add_vector(self, table: str, id_val: str, vector: np.ndarray):
         blob = vector_to_blob(vector)
-        c = self.conn.cursor()
-        try:
-            c.execute(f"INSERT INTO {table} (id, vector) VALUES (?, ?)", (id_val, blob))
-        except sqlite3.IntegrityError:
-            raise ValueError(f"ID {id_val} already exists in table {table}")
-        self.conn.commit()
+        with self.pool.write() as conn:
+            try:
+                conn.execute(f"INSERT INTO {table} (id, vector) VALUES (?, ?)", (id_val, blob))
+            except sqlite3.IntegrityError:
+                raise ValueError(f"ID {id_val} already exists in table {table}")
 
+    @db_timer("update_vector")
     def update_vector(self, table: str, id_val: str, new_vector: np.ndarray):
         blob = vector_to_blob(new_vector)
-        c = self.conn.cursor()
-        c.execute(f"UPDATE {table} SET vector=? WHERE id=?", (blob, id_val))
-        if c.rowcount == 0:
-            raise ValueError(f"ID {id_val} not found in table {table}")
-        self.conn.commit()
+        with self.pool.write() as conn:
+            c = conn.execute(f"UPDATE {table} SET vector=? WHERE id=?", (blob, id_val))
+            if c.rowcount == 0:
+                raise ValueError(f"ID {id_val} not found in table {table}")
 
+    @db_timer("get_vector")
     def get_vector(self, table: str, id_val: str) -> np.ndarray:
-        c = self.conn.cursor()
+        c = self.reader().cursor()
         c.execute(f"SELECT vector FROM {table} WHERE id=?", (id_val,))
         row = c.fetchone()
         if row is None:
@@ -82,90 +83,155 @@ class SQLiteDatabase:
     def get_user(self, id_val: str) -> np.ndarray:
         return self.get_vector("users", id_val)
 
-    # Nonprofit convenience methods (using JSON for tag lists)
+    @db_timer("upsert_users")
+    def upsert_users(self, rows):
+        """Inserts or updates many (id, vector) pairs in a single transaction."""
+        with self.pool.write() as conn:
+            conn.executemany(
+                "INSERT INTO users (id, vector) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET vector=excluded.vector",
+                ((id_val, vector_to_blob(vector)) for id_val, vector in rows),
+            )
+
+    def iter_user_vectors(self, since=0, chunk_size=10000):
+        """
+        Users written after revision `since` (see migrations.USER_REVISION_TRIGGERS),
+        as (ids, matrix, revision) chunks of up to chunk_size rows, all from one
+        read snapshot and in revision order; revision is the last one in the
+        chunk. A user without a vector gets a row of zeros.
+        """
+        empty = bytes(4 * VECTOR_SIZE)
+        with self.pool.snapshot() as conn:
+            c = conn.execute("SELECT id, vector, revision FROM users WHERE revision > ? ORDER BY revision", (since,))
+            while rows := c.fetchmany(chunk_size):
+                matrix = np.frombuffer(b"".join(row[1] or empty for row in rows), dtype=np.float32)
+                yield [row[0] for row in rows], matrix.reshape(len(rows), VECTOR_SIZE), rows[-1][2]
+
+    @db_timer("put_user_recommendations")
+    def put_user_recommendations(self, rows, revision):
+        """Stores many (userID, [nonprofit ids]) rankings, computed from the users as of `revision`, in one transaction."""
+        computed_at = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.pool.write() as conn:
+            conn.executemany(
+                "INSERT INTO user_recommendations (userID, nonprofits, revision, computed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(userID) DO UPDATE SET nonprofits=excluded.nonprofits, revision=excluded.revision, "
+                "computed_at=excluded.computed_at",
+                ((userID, json.dumps(ranked), revision, computed_at) for userID, ranked in rows),
+            )
+
+    @db_timer("get_user_recommendations")
+    def get_user_recommendations(self, userID):
+        """The user's stored ranking, or [] if there is none or the user's vector changed after it was computed."""
+        row = self.reader().execute(
+            "SELECT r.nonprofits FROM user_recommendations r JOIN users u ON u.id = r.userID "
+            "WHERE r.userID = ? AND u.revision <= r.revision", (userID,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    # Nonprofit convenience methods (tags packed with pack_tags)
+    @db_timer("add_nonprofit")
     def add_nonprofit(self, id_val: str, primary_tags: list, secondary_tags: list):
-        primary_json = json.dumps(primary_tags)
-        secondary_json = json.dumps(secondary_tags)
-        c = self.conn.cursor()
-        try:
-            c.execute("INSERT INTO nonprofits (id, primary_tags, secondary_tags) VALUES (?, ?, ?)",
-                      (id_val, primary_json, secondary_json))
-        except sqlite3.IntegrityError:
-            raise ValueError(f"ID {id_val} already exists in table nonprofits")
-        self.conn.commit()
+        vector = vector_to_blob(nonprofit_index.vector(primary_tags, secondary_tags))
+        with self.pool.write() as conn:
+            try:
+                conn.execute("INSERT INTO nonprofits (id, primary_tags, secondary_tags, vector) VALUES (?, ?, ?, ?)",
+                             (id_val, pack_tags(primary_tags), pack_tags(secondary_tags), vector))
+            except sqlite3.IntegrityError:
+                raise ValueError(f"ID {id_val} already exists in table nonprofits")
+        nonprofit_index.add(self, id_val, primary_tags, secondary_tags)
+
+    @db_timer("add_nonprofits")
+    def add_nonprofits(self, rows):
+        """
+        Inserts many (id, primary_tags, secondary_tags) in a single transaction,
+        e.g. when loading a catalog. The in-memory index reloads on next use.
+        """
+        with self.pool.write() as conn:
+            conn.executemany(
+                "INSERT INTO nonprofits (id, primary_tags, secondary_tags, vector) VALUES (?, ?, ?, ?)",
+                ((id_val, pack_tags(primary), pack_tags(secondary),
+                  vector_to_blob(nonprofit_index.vector(primary, secondary))) for id_val, primary, secondary in rows),
+            )
+        nonprofit_index.invalidate()
 
+    @db_timer("update_nonprofit_tags")
     def update_nonprofit_tags(self, id_val: str, primary_tags: list, secondary_tags: list):
-        primary_json = json.dumps(primary_tags)
-        secondary_json = json.dumps(secondary_tags)
-        c = self.conn.cursor()
-        c.execute("UPDATE nonprofits SET primary_tags=?, secondary_tags=? WHERE id=?",
-                  (primary_json, secondary_json, id_val))
-        if c.rowcount == 0:
-            raise ValueError(f"ID {id_val} not found in table nonprofits")
-        self.conn.commit()
-
+        vector = vector_to_blob(nonprofit_index.vector(primary_tags, secondary_tags))
+        with self.pool.write() as conn:
+            c = conn.execute("UPDATE nonprofits SET primary_tags=?, secondary_tags=?, vector=? WHERE id=?",
+                             (pack_tags(primary_tags), pack_tags(secondary_tags), vector, id_val))
+            if c.rowcount == 0:
+                raise ValueError(f"ID {id_val} not found in table nonprofits")
+        nonprofit_index.update(self, id_val, primary_tags, secondary_tags)
+
+    @db_timer("get_nonprofit")
     def get_nonprofit(self, id_val: str):
-        c = self.conn.cursor()
+        c = self.reader().cursor()
         c.execute("SELECT primary_tags, secondary_tags FROM nonprofits WHERE id=?", (id_val,))
         row = c.fetchone()
         if row is None:
             return None
-        primary = json.loads(row[0])
-        secondary = json.loads(row[1])
-        return NonProfit(id_val, primary, secondary)
+        return NonProfit(id_val, unpack_tags(row[0]), unpack_tags(row[1]))
 
+    @db_timer("get_all_nonprofits")
     def get_all_nonprofits(self):
-        c = self.conn.cursor()
+        c = self.reader().cursor()
         c.execute("SELECT id, primary_tags, secondary_tags FROM nonprofits")
-        results = []
-        for row in c.fetchall():
-            nonprofit_id = row[0]
-            primary_tags = json.loads(row[1])
-            secondary_tags = json.loads(row[2])
-            results.append((nonprofit_id, primary_tags, secondary_tags))
-        return results
+        return [(row[0], unpack_tags(row[1]), unpack_tags(row[2])) for row in c.fetchall()]
+
+    @db_timer("get_nonprofit_matrix")
+    def get_nonprofit_matrix(self):
+        """
+        (ids, matrix) of the whole catalog straight from the stored vectors:
+        one query and one frombuffer, no per-row tag decoding. Row i of the
+        float32 matrix is the normalized vector of ids[i]. Rows the migration
+        couldn't convert have no vector and are left out.
+        """
+        c = self.reader().cursor()
+        c.execute("SELECT id, vector FROM nonprofits WHERE vector IS NOT NULL")
+        rows = c.fetchall()
+        ids = np.empty(len(rows), dtype=object)
+        ids[:] = [row[0] for row in rows]
+        matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32)
+        return ids, matrix.reshape(len(rows), VECTOR_SIZE).copy()
+
+    # Each exported table: its key in the export, the query, and row -> (id, entry)
+    EXPORT_TABLES = (
+        ("users", "SELECT id, vector FROM users",
+         lambda row: (row[0], blob_to_vector(row[1]).tolist() if row[1] else None)),
+        ("nonprofits", "SELECT id, primary_tags, secondary_tags FROM nonprofits",
+         lambda row: (row[0], {"primary_tags": unpack_tags(row[1]), "secondary_tags": unpack_tags(row[2])})),
+        ("coin_ledger", "SELECT transactionID, timestamp, userID, amount, nonprofitID FROM coin_ledger",
+         lambda row: (row[0], {"timestamp": row[1], "userID": row[2], "amount": row[3], "nonprofitID": row[4]})),
+    )
 
     def get_json(self):
         """
         Return a JSON representation of the database,
         containing the users, nonprofits, and coin_ledger tables.
+        Builds everything in memory; use iter_json for large databases.
+        """
+        c = self.reader().cursor()
+        return {name: dict(map(entry, c.execute(query).fetchall())) for name, query, entry in self.EXPORT_TABLES}
+
+    def iter_json(self, chunk_size=1000):
+        """
+        The same document as get_json, as a stream of JSON text chunks. Rows
+        are fetched chunk_size at a time from one read snapshot, so memory
+        use doesn't grow with the size of the database.
         """
-        c = self.conn.cursor()
-        # Build users dictionary: id -> vector list
-        c.execute("SELECT * FROM users")
-        users = {}
-        for row in c.fetchall():
-            user_id = row[0]
-            vector_blob = row[1]
-            vector_list = blob_to_vector(vector_blob).tolist() if vector_blob else None
-            users[user_id] = vector_list
-
-        # Build nonprofits dictionary: id -> {primary_tags, secondary_tags}
-        c.execute("SELECT * FROM nonprofits")
-        nonprofits = {}
-        for row in c.fetchall():
-            nonprofit_id = row[0]
-            primary_tags = json.loads(row[1])
-            secondary_tags = json.loads(row[2])
-            nonprofits[nonprofit_id] = {
-                "primary_tags": primary_tags,
-                "secondary_tags": secondary_tags
-            }
-
-        # Build coin_ledger dictionary: id -> {timestamp, userID, amount, nonprofitID}
-        c.execute("SELECT * FROM coin_ledger")
-        coin_ledger = {}
-        for row in c.fetchall():
-            coin_id = row[0]
-            coin_ledger[coin_id] = {
-                "timestamp": row[1],
-                "userID": row[2],
-                "amount": row[3],
-                "nonprofitID": row[4]
-            }
-
-        return {"users": users, "nonprofits": nonprofits, "coin_ledger": coin_ledger}
+        with self.pool.snapshot() as conn:
+            yield "{"
+            for position, (name, query, entry) in enumerate(self.EXPORT_TABLES):
+                yield f'{", " if position else ""}{json.dumps(name)}: {{'
+                c = conn.execute(query)
+                separator = ""
+                while rows := c.fetchmany(chunk_size):
+                    yield separator + ", ".join(f"{json.dumps(str(key))}: {json.dumps(value)}"
+                                                for key, value in map(entry, rows))
+                    separator = ", "
+                yield "}"
+            yield "}"
 
     def close(self):
-        self.conn.close()
+        release_pool(self.pool)
 
@@ -3,15 +3,29 @@ import os
 import sys
 from collections import deque
 import random
+import threading
+
+import numpy as np
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from models.usertagtable import UserTagTable
-from models.sqlite_db import SQLiteDatabase
-from helpers import compute_query_vectory, cosine_similarity
-from config import DATABASE_PATH  # import the central configuration
+from models.events import POOLS, event_comp_tags, event_pool
+from models.popularity import popularity
+from models.appcontext import context
+from models.nonprofitindex import nonprofit_index
+from models.metrics import timed
+from helpers import compute_query_vectory
+
+
+def __getattr__(name):
+    # models.user.database, kept for scripts: the shared handle of models/appcontext.py
+    if name == "database":
+        return context.database
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
-# Create the global database using the configured path.
-database = SQLiteDatabase(DATABASE_PATH)
+def refreshTimer(mode):
+    return timed("refresh_queue_seconds", "Upcoming-queue refreshes (catalog searches)", mode=mode)
 
 
 class User:
@@ -26,6 +40,12 @@ class User:
         self.seenQueue = deque()
         self.upcomingSet = set()
         self.upcomingQueue = deque()
+        # Score of each queued id against the query it was found with, and the basic query
+        # those scores are up to date with (see rerankQueue).
+        self.queueScores = {}
+        self.baseQuery = None
+        # Requests for the same user can run concurrently on the handler pools.
+        self.lock = threading.RLock()
 
     def chooseEvent(self) -> int:
         r = random.randint(0, 99)
@@ -36,95 +56,161 @@ class User:
         if 2 <= r < 75:
             return 0
         if 76 <= r < 85:
-            if -1 in self.tags.data:
+            if -1 in self.tags:
                 return 3
             else:
                 return 0 if random.getrandbits(1) else 3
         if 86 <= r < 95:
-            return 4 if -2 in self.tags.data else 0
+            return 4 if -2 in self.tags else (0 if random.getrandbits(1) else 4)
         if 96 <= r < 99:
-            return 5 if -3 in self.tags.data else (0 if random.getrandbits(1) else 5)
+            return 5 if -3 in self.tags else (0 if random.getrandbits(1) else 5)
         return 0
 
     def getCompTags(self, event) -> dict:
-        match event:
-            case 0:
-                return self.tags.getCompTags()
-            case 1:
-                newTags = self.tags.clone()
-                newTags.swap(newTags.getNthTag(0), newTags.getNthTag(-1))
-                newTags.swap(newTags.getNthTag(1), newTags.getNthTag(-2))
-                newTags.swap(newTags.getNthTag(2), newTags.getNthTag(-3))
-                return newTags.getCompTags()
-            case 2:
-                newTags = self.tags.clone()
-                if newTags.zeroTags:
-                    zeroed_tag = newTags.zeroTags.popleft()
-                    newTags.swap(newTags.getNthTag(0), zeroed_tag)
-                return newTags.getCompTags()
-            case 3:
-                return self.tags.getCompTags()
-            case 4:
-                return self.tags.getCompTags()
-            case 5:
-                return self.tags.getCompTags()
-        return self.tags.getCompTags()
+        # Event queries are overlays on the cached tag ranking (see models/events.py).
+        return event_comp_tags(self.tags, event)
 
     # Reaction methods
     def like(self, nonprofit):
-        self.tags.like(nonprofit)
+        with self.lock:
+            self.tags.like(nonprofit)
+            self.rerankQueue()
 
     def donate(self, nonprofit, amount):
-        self.tags.donate(nonprofit, amount)
+        with self.lock:
+            self.tags.donate(nonprofit, amount)
+            self.rerankQueue()
 
     def ignore(self, nonprofit):
-        self.tags.ignore(nonprofit)
+        with self.lock:
+            self.tags.ignore(nonprofit)
+            self.rerankQueue()
 
     def dislike(self, nonprofit):
-        self.tags.dislike(nonprofit)
+        with self.lock:
+            self.tags.dislike(nonprofit)
+            self.rerankQueue()
+
+    @timed("rerank_queue_seconds", "Incremental queue re-ranks after reactions")
+    def rerankQueue(self):
+        """
+        Re-orders upcomingQueue for the user's new tag weights without a
+        catalog scan. A reaction only moves the weights of the nonprofit's
+        tags, so the basic query changes in a few entries: each queued score
+        gets the dot product of its nonprofit's row with that sparse delta,
+        and the queue is re-sorted by the updated scores. Queued ids keep
+        the event query they were found with, shifted by the same delta.
+        """
+        with self.lock:
+            if not self.upcomingQueue:
+                # Nothing to re-score; the next fillQueue takes a fresh baseline.
+                self.baseQuery = None
+                return
+            if self.baseQuery is None:
+                return
+            query = compute_query_vectory(self.getCompTags(0))
+            changed = np.flatnonzero(query != self.baseQuery)
+            if not len(changed):
+                return
+            delta = query[changed] - self.baseQuery[changed]
+            self.baseQuery = query
+            index = nonprofit_index.ensure(context.database)
+            queued, rows = index.rows_of(self.upcomingQueue)
+            shifts = index.matrix[np.ix_(rows, changed)] @ delta
+            for charity_id, shift in zip(queued, shifts.tolist()):
+                self.queueScores[charity_id] += shift
+            # Stable, so equal scores keep their queue order
+            self.upcomingQueue = deque(sorted(self.upcomingQueue, key=lambda charity_id: -self.queueScores[charity_id]))
 
     # Scheduling / Next
+    @refreshTimer("single")
     def refreshQueue(self):
-        user_query = self.getCompTags(self.chooseEvent())
-        user_vec = compute_query_vectory(user_query)
-        candidates = []
-        # Retrieve all nonprofits from the SQLite DB.
-        all_nonprofits = database.get_all_nonprofits()  # List of (nonprofit_id, vector)
-        for charity_id, vec in all_nonprofits:
-            if charity_id in self.seenSet or charity_id in self.upcomingSet:
-                continue
-            sim = cosine_similarity(user_vec, vec)
-            candidates.append((sim, charity_id))
-        if not candidates:
-            self.seenSet.clear()
-            self.seenQueue.clear()
-            for charity_id, vec in all_nonprofits:
-                if charity_id in self.upcomingSet:
-                    continue
-                sim = cosine_similarity(user_vec, vec)
-                candidates.append((sim, charity_id))
-        candidates.sort(key=lambda x: x[0], reverse=True)
-        top_ten = candidates[:10]
-        for sim, charity_id in top_ten:
-            self.upcomingQueue.append(charity_id)
-            self.upcomingSet.add(charity_id)
+        event = self.chooseEvent()
+        user_vec = compute_query_vectory(self.getCompTags(event))
+        index = nonprofit_index.ensure(context.database)
+        self.fillQueue(index, user_vec, eventSearch(index, user_vec, event, self.seenSet | self.upcomingSet))
+
+    def seedQueue(self, ranked):
+        """Queues a precomputed ranking (see models/prerank.py) for the basic query, without searching the catalog."""
+        if ranked:
+            index = nonprofit_index.ensure(context.database)
+            self.fillQueue(index, compute_query_vectory(self.getCompTags(0)), ranked)
+
+    def fillQueue(self, index, user_vec, top_ten):
+        with self.lock:
+            if not top_ten:
+                # Everything unseen is exhausted: start over, skipping only what's already queued.
+                self.seenSet.clear()
+                self.seenQueue.clear()
+                top_ten = index.search(user_vec, 10, self.upcomingSet)
+            # A background refill may overlap a serve; don't queue what was just sent or queued.
+            top_ten = [charity_id for charity_id in top_ten
+                       if charity_id not in self.upcomingSet and charity_id not in self.seenSet]
+            # Rows are unit length, so the dot product ranks like the cosine the search used.
+            top_ten, rows = index.rows_of(top_ten)
+            scores = (index.matrix[rows] @ np.asarray(user_vec, dtype=np.float32)).tolist()
+            for charity_id, score in zip(top_ten, scores):
+                self.upcomingQueue.append(charity_id)
+                self.upcomingSet.add(charity_id)
+                self.queueScores[charity_id] = score
+            if self.baseQuery is None:
+                self.baseQuery = compute_query_vectory(self.getCompTags(0))
 
     def getNextN(self, n):
-        sending = []
-        while len(sending) < n:
-            if not self.upcomingQueue:
-                self.refreshQueue()
+        with self.lock:
+            sending = []
+            while len(sending) < n:
                 if not self.upcomingQueue:
-                    break
-            charity = self.upcomingQueue.popleft()
-            sending.append(charity)
-            self.upcomingSet.remove(charity)
-            self.seenQueue.append(charity)
-            self.seenSet.add(charity)
-            if len(self.seenQueue) > 50:
-                byebye = self.seenQueue.popleft()
-                self.seenSet.remove(byebye)
-        return sending
+                    self.refreshQueue()
+                    if not self.upcomingQueue:
+                        break
+                charity = self.upcomingQueue.popleft()
+                sending.append(charity)
+                self.upcomingSet.remove(charity)
+                self.queueScores.pop(charity, None)
+                self.seenQueue.append(charity)
+                self.seenSet.add(charity)
+                if len(self.seenQueue) > 50:
+                    byebye = self.seenQueue.popleft()
+                    self.seenSet.remove(byebye)
+            popularity.record_many(sending, exposure=1)
+            return sending
 
     def getFullVector(self):
-        return self.tags.getFullVector()
+        with self.lock:
+            return self.tags.getFullVector()
+
+
+def eventSearch(index, user_vec, event, exclude, k=10):
+    """Top-k for one user: from the event's candidate pool when it has one, topped up from the whole catalog."""
+    pool = event_pool(event)
+    if not pool:
+        return index.search(user_vec, k, exclude)
+    found = index.search_among(user_vec, pool, k, exclude)
+    if len(found) < k:
+        found += index.search(user_vec, k - len(found), exclude | set(found))
+    return found
+
+
+@refreshTimer("batch")
+def refreshQueues(users):
+    """Refreshes the upcoming queues of several users with a single scoring pass."""
+    if not users:
+        return
+    index = nonprofit_index.ensure(context.database)
+    events, queries, excludes = [], [], []
+    for user in users:
+        # Users may be reacting or being served on other threads meanwhile (see QueueRefiller).
+        with user.lock:
+            events.append(user.chooseEvent())
+            queries.append(compute_query_vectory(user.getCompTags(events[-1])))
+            excludes.append(user.seenSet | user.upcomingSet)
+    queries = np.stack(queries)
+    # Users on a pooled event are served from the pool; everyone else shares one batch search.
+    pooled = [i for i, event in enumerate(events) if event in POOLS]
+    batched = [i for i, event in enumerate(events) if event not in POOLS]
+    results = dict(zip(batched, index.search_batch(queries[batched], 10, [excludes[i] for i in batched]))) if batched else {}
+    for i in pooled:
+        results[i] = eventSearch(index, queries[i], events[i], excludes[i])
+    for i, user in enumerate(users):
+        user.fillQueue(index, queries[i], results[i])
@@ -1,131 +1,131 @@
-from sortedcontainers import SortedList
 from collections import deque
-from copy import deepcopy
 import numpy as np
-import json
-import os
 
-json_path = os.path.join(os.path.dirname(__file__), "..", "data", "tags.json")
-with open(json_path, "r") as f:
-    Tags = json.load(f)
+from models.appcontext import context
 
 class UserTagTable:
-    def __init__(self, userID, vector=None):
-        self.sorted_list = SortedList()  # stored as (value, tag)
+    """
+    A user's weight for every tag, as one float32 array indexed by tag id.
+
+    Tags are ranked by (weight, tag) ascending, leaving out zero weights and
+    removed tags. The ranking is an argsort computed on first use after a
+    change and cached until the next one, so getNthTag/getCompTags are
+    slices of it. Reactions update all of a nonprofit's tags in one
+    vectorized step.
+    """
+
+    def __init__(self, userID, vector=None, total_tags=100):
         self.zeroTags = deque()
+        self._rank = None
         if vector is None:
-            self.data = {int(tag): 0.5 for tag in Tags}  # assume Tags can be cast to int keys
+            self.weights = np.zeros(total_tags, dtype=np.float32)
+            self.present = np.zeros(total_tags, dtype=bool)
+            tags = np.fromiter((int(tag) for tag in context.tags), dtype=np.intp)  # assume tags.json can be cast to int keys
+            self.weights[tags] = 0.5
+            self.present[tags] = True
         else:
-            self.data = {}
-            for i in range(len(vector)):
-                self.data[i] = float(vector[i])
-                if vector[i] == 0:
-                    self.zeroTags.append(i)
-        for tag, val in self.data.items():
-            self.sorted_list.add((val, tag))
-
-    def set(self, tag, val):
-        if tag in self.data:
-            old_val = self.data[tag]
-            try:
-                self.sorted_list.remove((old_val, tag))
-            except ValueError:
-                pass
-        self.data[tag] = val
-        self.sorted_list.add((val, tag))
-        if val == 0:
-            self.zeroTags.append(tag)
-            try:
-                self.sorted_list.remove((val, tag))
-            except ValueError:
-                pass
+            self.weights = np.array(vector, dtype=np.float32)
+            self.present = np.ones(len(self.weights), dtype=bool)
+            self.zeroTags.extend(np.flatnonzero(self.weights == 0).tolist())
+
+    def __contains__(self, tag):
+        return 0 <= tag < len(self.weights) and bool(self.present[tag])
+
+    def rank(self):
+        """Tags with a nonzero weight, lowest (weight, tag) first."""
+        if self._rank is None:
+            tags = np.flatnonzero(self.present & (self.weights != 0))
+            self._rank = tags[np.lexsort((tags, self.weights[tags]))]
+        return self._rank
+
+    def setMany(self, tags, vals):
+        """Sets several tags at once. A tag that drops to 0 joins zeroTags; past 25 zeroed tags, the oldest is reset to 10."""
+        tags = np.asarray(tags, dtype=np.intp)
+        vals = np.asarray(vals, dtype=np.float32)
+        # Only newly zeroed tags: re-zeroing one (e.g. disliking the same nonprofit again) mustn't queue it twice.
+        zeroed = tags[(vals == 0) & ((self.weights[tags] != 0) | ~self.present[tags])]
+        self.weights[tags] = vals
+        self.present[tags] = True
+        self.zeroTags.extend(zeroed.tolist())
         while len(self.zeroTags) > 25:
             bumped_tag = self.zeroTags.popleft()
-            if bumped_tag in self.data:
-                old_val = self.data[bumped_tag]
-                try:
-                    self.sorted_list.remove((old_val, bumped_tag))
-                except ValueError:
-                    pass
-            self.data[bumped_tag] = 10.0
-            self.sorted_list.add((10.0, bumped_tag))
+            self.weights[bumped_tag] = 10.0
+            self.present[bumped_tag] = True
+        self._rank = None
+
+    def set(self, tag, val):
+        self.setMany([tag], [val])
 
     def remove(self, tag):
-        if tag in self.data:
-            old_val = self.data[tag]
-            del self.data[tag]
-            self.sorted_list.remove((old_val, tag))
+        if tag in self:
+            self.weights[tag] = 0
+            self.present[tag] = False
+            self._rank = None
 
     def getVal(self, tag):
-        return self.data[tag]
+        if tag not in self:
+            raise KeyError(tag)
+        return float(self.weights[tag])
 
     def getNthTag(self, n):
-        if 0 <= abs(n) < len(self.sorted_list):
-            return self.sorted_list[n][1]
+        rank = self.rank()
+        if 0 <= abs(n) < len(rank):
+            return int(rank[n])
         raise IndexError("Tag index out of range")
 
     def swap(self, tag1, tag2):
-        self.data[tag1], self.data[tag2] = self.data[tag2], self.data[tag1]
-        self.sorted_list = SortedList(((v, t) for t, v in self.data.items()))
+        self.weights[[tag1, tag2]] = self.weights[[tag2, tag1]]
+        self._rank = None
 
     def clone(self):
-        clone = UserTagTable(-1)
-        clone.data = deepcopy(self.data)
-        clone.sorted_list = SortedList(self.sorted_list)
-        clone.zeroTags = deepcopy(self.zeroTags)
+        clone = UserTagTable.__new__(UserTagTable)
+        clone.weights = self.weights.copy()
+        clone.present = self.present.copy()
+        clone.zeroTags = deque(self.zeroTags)
+        clone._rank = self._rank
         return clone
 
     def getCompTags(self):
-        query = {}
-        for i in range(min(20, len(self.sorted_list))):
-            tag = self.getNthTag(i)
-            query[tag] = self.getVal(tag)
-        return query
+        tags = self.rank()[:20]
+        return dict(zip(tags.tolist(), self.weights[tags].tolist()))
 
     def getFullVector(self, total_tags=100):
-        dictVersion = {}
-        for i in range(len(self.data)):
-            tag = self.getNthTag(i)
-            dictVersion[tag] = self.getVal(tag)
-        for i in self.zeroTags:
-            dictVersion[i] = 0.0
+        if total_tags == len(self.weights):
+            return self.weights.copy()
         vec = np.zeros(total_tags, dtype=np.float32)
-        for tag, weight in dictVersion.items():
-            if tag < total_tags:
-                vec[tag] = weight
+        size = min(total_tags, len(self.weights))
+        vec[:size] = self.weights[:size]
         return vec
 
     # Behaviors
+    def reactionTags(self, nonprofit, primary_rate, secondary_rate):
+        """The nonprofit's tags, primary first, with the rate each one gets. A tag listed as both counts as primary."""
+        primary = nonprofit.tags["primary"]
+        secondary = [tag for tag in nonprofit.tags["secondary"] if tag not in primary]
+        rates = np.full(len(primary) + len(secondary), secondary_rate, dtype=np.float32)
+        rates[:len(primary)] = primary_rate
+        return np.array(list(primary) + secondary, dtype=np.intp), rates
+
+    def moveTowardsOne(self, nonprofit, primary_rate, secondary_rate):
+        tags, rates = self.reactionTags(nonprofit, primary_rate, secondary_rate)
+        vals = self.weights[tags]
+        self.setMany(tags, vals + (1 - vals) * rates)
+
+    def decay(self, nonprofit, primary_factor, secondary_factor):
+        tags, factors = self.reactionTags(nonprofit, primary_factor, secondary_factor)
+        new_vals = self.weights[tags] * factors
+        new_vals[new_vals < 0.0005] = 0
+        self.setMany(tags, new_vals)
+
     def like(self, nonprofit):
-        for tag in nonprofit.tags["primary"]:
-            val = self.getVal(tag)
-            self.set(tag, val + (1 - val) * 0.1)
-        for tag in nonprofit.tags["secondary"]:
-            val = self.getVal(tag)
-            self.set(tag, val + (1 - val) * 0.01)
-
-    def donate(self, nonprofit):
-        for tag in nonprofit.tags["primary"]:
-            val = self.getVal(tag)
-            self.set(tag, val + (1 - val) * 0.25)
-        for tag in nonprofit.tags["secondary"]:
-            val = self.getVal(tag)
-            self.set(tag, val + (1 - val) * 0.025)
+        self.moveTowardsOne(nonprofit, 0.1, 0.01)
+
+    def donate(self, nonprofit, amount=0.0):
+        # The update doesn't depend on the amount (yet); the ledger records it.
+        self.moveTowardsOne(nonprofit, 0.25, 0.025)
 
     def ignore(self, nonprofit):
-        for tag in nonprofit.tags["primary"]:
-            new_val = self.getVal(tag) * 0.9
-            self.set(tag, new_val if new_val >= 0.0005 else 0)
-        for tag in nonprofit.tags["secondary"]:
-            new_val = self.getVal(tag) * 0.99
-            self.set(tag, new_val if new_val >= 0.0005 else 0)
+        self.decay(nonprofit, 0.9, 0.99)
 
     def dislike(self, nonprofit):
-        for tag in nonprofit.tags["primary"]:
-            new_val = self.getVal(tag) * 0.75
-            self.set(tag, new_val if new_val >= 0.0005 else 0)
-        for tag in nonprofit.tags["secondary"]:
-            new_val = self.getVal(tag) * 0.975
-            self.set(tag, new_val if new_val >= 0.0005 else 0)
-
-
+        self.decay(nonprofit, 0.75, 0.975)
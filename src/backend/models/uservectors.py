@@ -0,0 +1,154 @@
+"""
+Every user vector as one memory-mapped float32 matrix, for offline jobs
+that score all users at once (chunked matrix products instead of a
+get_vector query per user).
+
+The store is a directory of .npy files, mapped with np.load(mmap_mode):
+
+    matrix.npy   float32 (capacity, VECTOR_SIZE); row i is the vector of ids[i]
+    ids.npy      the user ids, in row order
+    order.npy    argsort of the ids, for lookups (see sharedcatalog.SharedRows)
+    STATE        {"revision": r, "count": n}: rows [0, n) hold every user
+                 written up to revision r of the users table
+
+sync() copies only the users written since the last sync, using the revision
+column that every write to users bumps (see migrations.USER_REVISION_TRIGGERS):
+changed users are rewritten in place, new ones appended, and STATE replaced
+last. A sync that stops halfway leaves STATE at the previous revision, and
+the next one writes those rows again. Users are never deleted from the users
+table, so the store doesn't track deletions; rebuild() starts over.
+"""
+
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+from models.sharedcatalog import SharedRows
+from models.sqlite_db import VECTOR_SIZE
+
+MIN_CAPACITY = 1024
+
+
+class UserVectorStore:
+    """
+    The store in `directory`, mapped read-only as of the last load(). Readers
+    see rows change in place while another process syncs; run offline jobs
+    after the sync rather than during it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def lock(self):
+        """Exclusive across processes, so two syncs don't interleave."""
+        with open(self._path(".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _state(self):
+        try:
+            with open(self._path("STATE")) as f:
+                state = json.load(f)
+            return state["revision"], state["count"]
+        except FileNotFoundError:
+            return 0, 0
+
+    def _map(self, mode):
+        """(ids, order, matrix) of the first `count` users; the matrix keeps its spare rows."""
+        if not self.count:
+            return np.empty(0, dtype=str), np.empty(0, dtype=np.int64), None
+        ids = np.load(self._path("ids.npy"), mmap_mode="r").view(np.ndarray)
+        order = np.load(self._path("order.npy"), mmap_mode="r").view(np.ndarray)
+        if len(ids) != self.count:
+            # ids of a sync that stopped before writing STATE
+            ids = ids[:self.count]
+            order = np.argsort(ids, kind="stable")
+        return ids, order, np.load(self._path("matrix.npy"), mmap_mode=mode)
+
+    def load(self):
+        """Maps the store as of its last completed sync."""
+        self.revision, self.count = self._state()
+        ids, order, matrix = self._map("r")
+        self.ids = ids
+        self.rows = SharedRows(ids, order)
+        self.matrix = np.empty((0, VECTOR_SIZE), dtype=np.float32) if matrix is None else matrix[:self.count].view(np.ndarray)
+        return self
+
+    def chunks(self, size):
+        """(ids, vectors) of consecutive blocks of `size` users."""
+        for start in range(0, self.count, size):
+            yield self.ids[start:start + size], self.matrix[start:start + size]
+
+    def sync(self, database, chunk_size=10000):
+        """
+        Brings the store up to date with `database`'s users table and maps the
+        result. Returns (users rewritten, users added).
+        """
+        with self.lock():
+            self.revision, self.count = self._state()
+            ids, order, matrix = self._map("r+")
+            rows = SharedRows(ids, order)
+            revision, count, added, updated = self.revision, self.count, [], 0
+            for chunk_ids, vectors, revision in database.iter_user_vectors(self.revision, chunk_size):
+                found, found_rows = rows.lookup(chunk_ids)
+                positions = {userID: i for i, userID in enumerate(chunk_ids)}
+                for userID in found:
+                    del positions[userID]
+                new = list(positions.values())
+                if count + len(new) > (0 if matrix is None else len(matrix)):
+                    matrix = self._grow(matrix, count, count + len(new))
+                # Rows changed since the last sync in place, new users after the last row
+                matrix[found_rows] = vectors[np.setdiff1d(np.arange(len(chunk_ids)), new)]
+                matrix[count:count + len(new)] = vectors[new]
+                added += [chunk_ids[i] for i in new]
+                count += len(new)
+                updated += len(found)
+            if matrix is not None:
+                matrix.flush()
+            if added:
+                ids = np.concatenate([ids, np.asarray(added, dtype=str)])
+                self._save("ids.npy", ids)
+                self._save("order.npy", np.argsort(ids, kind="stable").astype(np.int64))
+            with open(self._path("STATE.tmp"), "w") as f:
+                json.dump({"revision": revision, "count": count}, f)
+            os.replace(self._path("STATE.tmp"), self._path("STATE"))
+            del matrix
+        self.load()
+        return updated, len(added)
+
+    def _grow(self, matrix, count, needed):
+        """A matrix file with room for `needed` rows (at least double the old one), holding the first `count` rows."""
+        capacity = max(needed, MIN_CAPACITY, 2 * (0 if matrix is None else len(matrix)))
+        grown = np.lib.format.open_memmap(self._path("matrix.npy.tmp"), mode="w+", dtype=np.float32,
+                                          shape=(capacity, VECTOR_SIZE))
+        if count:
+            grown[:count] = matrix[:count]
+        grown.flush()
+        # Mappings of the old file, in this process or a reader's, stay valid
+        os.replace(self._path("matrix.npy.tmp"), self._path("matrix.npy"))
+        return grown
+
+    def _save(self, name, array):
+        with open(self._path(name + ".tmp"), "wb") as f:
+            np.save(f, array)
+        os.replace(self._path(name + ".tmp"), self._path(name))
+
+    def rebuild(self, database, chunk_size=10000):
+        """Discards the store and copies every user again."""
+        with self.lock():
+            for name in os.listdir(self.directory):
+                if name != ".lock":
+                    os.remove(self._path(name))
+        return self.sync(database, chunk_size)
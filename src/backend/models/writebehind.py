@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindFlusher:
+    """
+    Batches dirty users and writes their vectors back in the background.
+
+    `mark` records a user whose tag weights changed. A daemon thread flushes
+    every dirty user through `persist(rows)` (rows are (userID, vector)
+    pairs) at most `interval` seconds after the first mark, or as soon as
+    `max_batch` users are dirty. `drain` flushes whatever is left and stops
+    the thread; call it on shutdown.
+    """
+
+    def __init__(self, persist, interval=5.0, max_batch=256):
+        self.persist = persist
+        self.interval = interval
+        self.max_batch = max_batch
+        self.dirty = {}     # userID -> User, in first-marked order
+        self.inflight = {}  # the batch currently being written
+        self.first_dirty = None
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    def mark(self, user):
+        with self.cond:
+            if not self.dirty:
+                self.first_dirty = time.monotonic()
+            self.dirty[user.id] = user
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self._run, name="user-write-behind", daemon=True)
+                self.thread.start()
+            if len(self.dirty) >= self.max_batch:
+                self.cond.notify()
+
+    def pending(self, userID):
+        """The not-yet-written User for `userID`, if there is one."""
+        with self.cond:
+            return self.dirty.get(userID) or self.inflight.get(userID)
+
+    def flush(self):
+        """Writes every dirty user in one batch. Returns how many were written."""
+        with self.cond:
+            batch, self.dirty = self.dirty, {}
+            self.inflight = batch
+            self.first_dirty = None
+        if not batch:
+            return 0
+        try:
+            self.persist([(userID, user.getFullVector()) for userID, user in batch.items()])
+        except Exception:
+            logger.exception("Failed to flush %d users; will retry", len(batch))
+            with self.cond:
+                # Re-queue the batch; entries marked again meanwhile are the same objects.
+                batch.update(self.dirty)
+                self.dirty = batch
+                self.inflight = {}
+                self.first_dirty = time.monotonic()
+            return 0
+        with self.cond:
+            self.inflight = {}
+        return len(batch)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stopping:
+                    if len(self.dirty) >= self.max_batch:
+                        break
+                    if self.dirty:
+                        remaining = self.first_dirty + self.interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+                stopping = self.stopping
+            self.flush()
+            if stopping:
+                return
+
+    def drain(self, timeout=None):
+        """Flushes every pending user and stops the background thread."""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+        self.flush()
@@ -0,0 +1,307 @@
+"""
+router.py
+
+Runs the API on several worker processes and keeps every user on one of
+them. `uvicorn main:app --workers N` would let the kernel hand a user's
+requests to any worker, each with its own CachedUsers, so their
+UserTagTable would diverge between workers and the last write-back would
+win.
+
+Instead, this starts N workers of main.py on unix sockets (SHARD_INDEX
+0..N-1, SHARD_COUNT N) and serves a small front app that forwards each
+request:
+    userID=...       to the user's owner on the models/sharding.py ring
+    userIDs=...      (/nextNBatch) split by owner, sent concurrently, merged
+    shard=i          to worker i (e.g. /metrics or /profiler of one worker)
+    anything else    round-robin (ledger, exports; those only touch SQLite)
+Workers refuse users they don't own (421), so a request that bypasses the
+router can't fork a user's state. A worker that exits is restarted on the
+same socket and owns the same users as before.
+
+Unless SHARED_CATALOG_DIR is set, the workers share the nonprofit catalog
+through SHARD_SOCKET_DIR/catalog (see models/sharedcatalog.py).
+
+Usage (from src/backend):
+    python router.py --workers 4 --port 8080
+"""
+
+import argparse
+import asyncio
+import http.client
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+from models.sharding import HashRing
+from config import SHARD_COUNT, SHARD_SOCKET_DIR
+
+# Request headers passed on to the worker, and response headers passed back; the
+# rest (length, framing, connection) belong to each hop.
+REQUEST_HEADERS = (b"content-type", b"accept-encoding")
+RESPONSE_HEADERS = (b"content-type", b"content-encoding")
+
+# Threads running the blocking http.client calls of every ShardClient, i.e. the
+# most requests the router has in flight to workers at once
+MAX_IN_FLIGHT = 64
+# Read size while streaming a chunked body through
+STREAM_READ = 64 * 1024
+
+
+def socketPath(directory, shard):
+    return os.path.join(directory, f"shard-{shard}.sock")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """http.client.HTTPConnection to a unix socket instead of a TCP port."""
+
+    def __init__(self, socket_path):
+        super().__init__("shard")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class ShardClient:
+    """
+    HTTP/1.1 to one worker's unix socket with http.client, reusing idle
+    keep-alive connections. http.client blocks, so requests run on the
+    `executor` threads.
+    """
+
+    def __init__(self, path, max_idle=64, executor=None):
+        self.path = path
+        self.max_idle = max_idle
+        self.executor = executor or ThreadPoolExecutor(MAX_IN_FLIGHT, thread_name_prefix="shard-client")
+        self.idle = []  # open connections; list.append/pop are atomic, so no lock
+
+    async def request(self, method, target, headers=(), body=b""):
+        """
+        Sends one request; returns (status, headers, body). headers are
+        (lowercase name, value) byte pairs. body is bytes, or for a chunked
+        response an async iterator of chunks, to be consumed or closed.
+        """
+        connection, response, content = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._send, method, target.decode("latin-1"),
+            {name.decode("latin-1"): value.decode("latin-1") for name, value in headers}, body)
+        response_headers = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                            for name, value in response.getheaders()]
+        if content is None:
+            return response.status, response_headers, self._chunks(connection, response)
+        return response.status, response_headers, content
+
+    def _send(self, method, target, headers, body):
+        """(connection, response, body) on an executor thread; body is None for a chunked response, left to _chunks."""
+        while True:
+            reused = bool(self.idle)
+            try:
+                connection = self.idle.pop()
+            except IndexError:
+                connection, reused = UnixHTTPConnection(self.path), False
+            try:
+                connection.request(method, target, body, headers)
+                response = connection.getresponse()
+                if response.chunked:
+                    return connection, response, None
+                content = response.read()
+                self._release(connection, response)
+                return connection, response, content
+            except ConnectionError:
+                connection.close()
+                # An idle connection the worker closed meanwhile; anything else is a real failure
+                if not reused:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+
+    async def _chunks(self, connection, response):
+        loop = asyncio.get_running_loop()
+        try:
+            while chunk := await loop.run_in_executor(self.executor, response.read1, STREAM_READ):
+                yield chunk
+        except BaseException:
+            connection.close()
+            raise
+        self._release(connection, response)
+
+    def _release(self, connection, response):
+        if not response.will_close and len(self.idle) < self.max_idle:
+            self.idle.append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+def shardClients(directory, shards):
+    executor = ThreadPoolExecutor(MAX_IN_FLIGHT, thread_name_prefix="shard-client")
+    return [ShardClient(socketPath(directory, shard), executor=executor) for shard in range(shards)]
+
+
+class Router:
+    """The front, as a bare ASGI app: routing needs a query parameter, not FastAPI's request handling."""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.ring = HashRing(len(clients))
+        self.nextShard = itertools.cycle(range(len(clients)))
+
+    def shardFor(self, params):
+        if "shard" in params:
+            return int(params["shard"]) % len(self.clients)
+        if "userID" in params:
+            return self.ring.owner(params["userID"])
+        return next(self.nextShard)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    for client in self.clients:
+                        client.close()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        body, more = b"", True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+        query = scope["query_string"]
+        params = parse_qsl(query.decode("latin-1"), keep_blank_values=True)
+        headers = [(name, value) for name, value in scope["headers"] if name in REQUEST_HEADERS]
+        path = scope.get("raw_path") or scope["path"].encode()
+        named = dict(params)
+        # Without userIDs the request goes to one worker as is, which refuses it (422)
+        if scope["path"] == "/nextNBatch" and "shard" not in named and "userIDs" in named:
+            status, response_headers, content = await self.nextNBatch(scope["method"], path, params, headers)
+        else:
+            # The target goes to the worker byte for byte; only the shard is chosen here
+            target = path + b"?" + query if query else path
+            status, response_headers, content = await self.clients[self.shardFor(named)].request(
+                scope["method"], target, headers, body)
+        response_headers = [(name, value) for name, value in response_headers if name in RESPONSE_HEADERS]
+        if isinstance(content, bytes):
+            response_headers.append((b"content-length", str(len(content)).encode()))
+            await send({"type": "http.response.start", "status": status, "headers": response_headers})
+            await send({"type": "http.response.body", "body": content})
+            return
+        # Chunked bodies (the /getDatabase export) are streamed through as they arrive
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        try:
+            async for chunk in content:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await content.aclose()
+        await send({"type": "http.response.body", "body": b""})
+
+    async def nextNBatch(self, method, path, params, headers):
+        """Each owner gets its users' part of the batch; their arrays are merged into one response."""
+        groups = self.ring.split(dict.fromkeys(value for key, value in params if key == "userIDs"))
+        others = [(key, value) for key, value in params if key != "userIDs"]
+        parts = await asyncio.gather(*(
+            self.clients[shard].request(method, path + b"?" + urlencode(others + [("userIDs", userID) for userID in userIDs]).encode(),
+                                        headers)
+            for shard, userIDs in groups.items()))
+        arrays = {}
+        for status, response_headers, content in parts:
+            if status != 200 or not content.startswith(b"{"):
+                return status, response_headers, content
+            arrays.update(json.loads(content)["arrays"])
+        return 200, [(b"content-type", b"application/json")], json.dumps({"arrays": arrays}).encode()
+
+
+# For `uvicorn router:app` next to workers started some other way
+app = Router(shardClients(SHARD_SOCKET_DIR, SHARD_COUNT))
+
+
+# -----------------
+#   Workers
+# -----------------
+class Workers:
+    """Runs `uvicorn main:app` once per shard and restarts any that exits."""
+
+    def __init__(self, shards, directory):
+        self.shards = shards
+        self.directory = directory
+        self.processes = [None] * shards
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()  # no respawn once stop() has begun
+
+    def spawn(self, shard):
+        path = socketPath(self.directory, shard)
+        if os.path.exists(path):
+            os.remove(path)
+        env = dict(os.environ, SHARD_COUNT=str(self.shards), SHARD_INDEX=str(shard))
+        if not env.get("SHARED_CATALOG_DIR"):
+            env["SHARED_CATALOG_DIR"] = os.path.join(self.directory, "catalog")
+        self.processes[shard] = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--uds", path],
+                                                 cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for shard in range(self.shards):
+            self.spawn(shard)
+        threading.Thread(target=self.watch, name="worker-watch", daemon=True).start()
+
+    def watch(self):
+        while not self.stopping.wait(1.0):
+            with self.lock:
+                for shard, process in enumerate(self.processes):
+                    if process.poll() is not None and not self.stopping.is_set():
+                        print(f"Worker {shard} exited with {process.returncode}; restarting", file=sys.stderr)
+                        self.spawn(shard)
+
+    def wait_ready(self, timeout=60.0):
+        """Blocks until every worker listens on its socket."""
+        deadline = time.monotonic() + timeout
+        while not all(os.path.exists(socketPath(self.directory, shard)) for shard in range(self.shards)):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Workers did not start")
+            time.sleep(0.1)
+
+    def stop(self):
+        with self.lock:
+            self.stopping.set()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket-dir", default=SHARD_SOCKET_DIR)
+    args = parser.parse_args()
+
+    workers = Workers(args.workers, args.socket_dir)
+    workers.start()
+    try:
+        workers.wait_ready()
+        uvicorn.run(Router(shardClients(args.socket_dir, args.workers)), host=args.host, port=args.port)
+    finally:
+        workers.stop()
+
+
+if __name__ == "__main__":
+    main()
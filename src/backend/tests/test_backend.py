@@ -1,5 +1,10 @@
 # tests/test_system.py
+import functools
+import json
 import sqlite3
+import threading
+import time
+from collections import deque
 import numpy as np
 import pytest
 
@@ -7,6 +12,8 @@ import pytest
 from models.sqlite_db import SQLiteDatabase, vector_to_blob, blob_to_vector
 # Import the User class (which uses the global `database` instance from models.user)
 from models.user import User
+# Shared resources (database, ledger, tags) of the process; fixtures swap them on it
+from models.appcontext import AppContext, context
 # Import the FastAPI app and the global database variable from main.
 from fastapi.testclient import TestClient
 from main import app
@@ -61,6 +68,51 @@ def test_get_all_nonprofits(db):
         assert matches, f"Nonprofit {np_id} not found"
         np.testing.assert_array_equal(vec, matches[0])
 
+def test_nonprofit_tags_stored_binary(db):
+    db.add_nonprofit("np_1", [7, 3, 42], [0, 99])
+    primary, secondary, vector = db.reader().execute(
+        "SELECT primary_tags, secondary_tags, vector FROM nonprofits WHERE id='np_1'").fetchone()
+    assert primary == bytes([7, 3, 42]) and secondary == bytes([0, 99])
+    assert db.get_nonprofit("np_1").tags == {"primary": [7, 3, 42], "secondary": [0, 99]}
+    ids, matrix = db.get_nonprofit_matrix()
+    assert ids.tolist() == ["np_1"]
+    np.testing.assert_allclose(matrix[0], blob_to_vector(vector))
+    assert matrix[0, 7] > matrix[0, 0] > 0 and np.isclose(np.linalg.norm(matrix[0]), 1)
+
+def test_legacy_json_nonprofits_migrated_on_open(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE nonprofits (id TEXT PRIMARY KEY, primary_tags TEXT, secondary_tags TEXT)")
+    conn.execute("INSERT INTO nonprofits VALUES ('np_1', '[1, 2, 3]', '[4, 5]')")
+    conn.commit()
+    conn.close()
+    database = SQLiteDatabase(path)
+    assert database.get_all_nonprofits() == [("np_1", [1, 2, 3], [4, 5])]
+    ids, matrix = database.get_nonprofit_matrix()
+    np.testing.assert_allclose(matrix[0], nonprofit_index.vector([1, 2, 3], [4, 5]))
+    database.close()
+
+def test_legacy_name_tags_migrated_on_open(tmp_path, caplog):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE nonprofits (id TEXT PRIMARY KEY, primary_tags TEXT, secondary_tags TEXT)")
+    conn.executemany("INSERT INTO nonprofits VALUES (?, ?, ?)", [
+        ("np_1", "Education, Mental Health", "children"),
+        ("np_2", "[1, 2]", ""),
+        # No tag is named just "health"
+        ("np_3", "Education, Health", "children"),
+    ])
+    conn.commit()
+    conn.close()
+    database = SQLiteDatabase(path)
+    assert database.get_nonprofit("np_1").tags == {"primary": [21, 5], "secondary": [0]}
+    assert database.get_nonprofit("np_2").tags == {"primary": [1, 2], "secondary": []}
+    assert "np_3" in caplog.text and "'health'" in caplog.text
+    ids, matrix = database.get_nonprofit_matrix()
+    assert ids.tolist() == ["np_1", "np_2"]
+    np.testing.assert_allclose(matrix[0], nonprofit_index.vector([21, 5], [0]))
+    database.close()
+
 # -----------------------------------------------------------------------------
 # Tests for the User class (unit tests)
 # -----------------------------------------------------------------------------
@@ -80,14 +132,15 @@ def override_helpers(monkeypatch):
         return 1 / (1 + diff)
     
     monkeypatch.setattr("models.user.compute_query_vectory", dummy_compute_query_vectory)
-    monkeypatch.setattr("models.user.cosine_similarity", dummy_cosine_similarity)
+    # models.user no longer imports cosine_similarity (ranking is a dot product on unit rows)
+    monkeypatch.setattr("models.user.cosine_similarity", dummy_cosine_similarity, raising=False)
 
 @pytest.fixture
 def test_db(tmp_path, monkeypatch):
     # Create a SQLiteDatabase in memory for testing the User class.
     test_db_instance = SQLiteDatabase(":memory:")
-    # Override the global database used in the User class (from models/user.py)
-    monkeypatch.setattr("models.user.database", test_db_instance)
+    # Override the shared database the User class scores against
+    monkeypatch.setattr(context, "database", test_db_instance)
     return test_db_instance
 
 def test_user_refresh_queue(test_db):
@@ -113,6 +166,701 @@ def test_user_refresh_queue(test_db):
     for charity in next_n:
         assert charity in nonprofit_ids
 
+from models.usertagtable import UserTagTable
+from models.nonprofit import NonProfit
+
+def test_user_tag_table_reactions():
+    tags = UserTagTable("user")
+    nonprofit = NonProfit("np", [1, 2, 3], [4, 5])
+    tags.like(nonprofit)
+    assert tags.getVal(1) == pytest.approx(0.55) and tags.getVal(4) == pytest.approx(0.505)
+    tags.donate(nonprofit, 10.0)
+    assert tags.getVal(1) == pytest.approx(0.6625)
+    # Lowest weight first, ties by tag id.
+    assert list(tags.getCompTags())[:3] == [0, 6, 7]
+    assert tags.getNthTag(-1) == 3
+    for _ in range(100):
+        tags.dislike(nonprofit)
+    assert tags.getVal(1) == 0 and list(tags.zeroTags) == [1, 2, 3]
+    assert 1 not in tags.getCompTags()
+    vector = tags.getFullVector()
+    assert vector[1] == 0 and vector[0] == pytest.approx(0.5)
+    assert -1 not in tags and 0 in tags
+    clone = tags.clone()
+    clone.swap(0, 1)
+    assert clone.getVal(1) == pytest.approx(0.5) and tags.getVal(1) == 0
+
+def test_user_tag_table_bumps_oldest_zeroed_tag():
+    tags = UserTagTable("user")
+    for tag in range(26):
+        tags.set(tag, 0)
+    assert tags.getVal(0) == 10.0 and len(tags.zeroTags) == 25
+    assert tags.getNthTag(-1) == 0
+
+from models.events import EVENTS, event_comp_tags, register_event
+
+def test_event_overlays_match_swapped_clone():
+    rng = np.random.default_rng(0)
+    vector = rng.random(100).astype(np.float32)
+    vector[rng.random(100) < 0.2] = 0
+    tags = UserTagTable("user", vector=vector)
+    before = tags.getFullVector()
+    rank = tags.rank()
+    disrupted = tags.clone()
+    for i in range(3):
+        disrupted.swap(int(rank[i]), int(rank[-1 - i]))
+    assert event_comp_tags(tags, 1) == disrupted.getCompTags()
+    returned = tags.clone()
+    returned.swap(int(rank[0]), tags.zeroTags[0])
+    assert event_comp_tags(tags, 2) == returned.getCompTags()
+    # Overlays never touch the user's own table.
+    np.testing.assert_array_equal(tags.getFullVector(), before)
+
+def test_register_event(monkeypatch):
+    monkeypatch.setitem(EVENTS, 9, None)
+    register_event(9, "top")(lambda tags: {tags.getNthTag(-1): 1.0})
+    tags = UserTagTable("user")
+    tags.set(42, 0.9)
+    assert EVENTS[9][0] == "top" and event_comp_tags(tags, 9) == {42: 1.0}
+    assert event_comp_tags(tags, 99) == tags.getCompTags()
+
+# -----------------------------------------------------------------------------
+# Tests for the in-memory NonprofitIndex
+# -----------------------------------------------------------------------------
+
+from helpers import compute_nonprofit_vector, cosine_similarity
+from models.nonprofitindex import NonprofitIndex, nonprofit_index
+
+def test_nonprofit_index_matches_cosine(db):
+    db.add_nonprofit("np_a", [0, 1, 2], [10, 11])
+    db.add_nonprofit("np_b", [5, 6, 7], [0, 1])
+    db.add_nonprofit("np_c", [], [])
+    index = NonprofitIndex()
+    index.ensure(db)
+    query = np.random.rand(100).astype(np.float32)
+    scores = index.score(query)
+    for nonprofit_id, primary, secondary in db.get_all_nonprofits():
+        expected = cosine_similarity(query, compute_nonprofit_vector({"primary": primary, "secondary": secondary}))
+        assert scores[index.rows[nonprofit_id]] == pytest.approx(expected, abs=1e-5)
+
+def test_nonprofit_index_search_excludes_and_orders(db):
+    for i in range(20):
+        db.add_nonprofit(f"np_{i}", [i], [])
+    index = NonprofitIndex().ensure(db)
+    query = np.zeros(100, dtype=np.float32)
+    query[:5] = [5, 4, 3, 2, 1]
+    assert index.search(query, 3) == ["np_0", "np_1", "np_2"]
+    assert index.search(query, 3, exclude={"np_0", "np_2"}) == ["np_1", "np_3", "np_4"]
+
+def test_add_nonprofits_in_bulk(db):
+    nonprofit_index.ensure(db)
+    db.add_nonprofits([("np_a", [1, 2], [3]), ("np_b", [4], [])])
+    assert db.get_nonprofit("np_a").tags == {"primary": [1, 2], "secondary": [3]}
+    assert nonprofit_index.stale
+    assert set(nonprofit_index.ensure(db).ids) == {"np_a", "np_b"}
+    with pytest.raises(sqlite3.IntegrityError):
+        db.add_nonprofits([("np_a", [], [])])
+
+def test_nonprofit_index_follows_writes(db):
+    db.add_nonprofit("np_1", [1], [])
+    nonprofit_index.ensure(db)
+    assert len(nonprofit_index) == 1
+    db.add_nonprofit("np_2", [2], [])
+    assert not nonprofit_index.stale
+    assert len(nonprofit_index.ensure(db)) == 2
+    query = np.zeros(100, dtype=np.float32)
+    query[2] = 1
+    assert nonprofit_index.search(query, 1) == ["np_2"]
+    db.update_nonprofit_tags("np_1", [2], [])
+    assert nonprofit_index.search(query, 2) == ["np_1", "np_2"]
+    # Writes through a database the index wasn't built from just invalidate it.
+    SQLiteDatabase(":memory:").add_nonprofit("np_3", [3], [])
+    assert nonprofit_index.stale
+
+def test_shared_catalog_between_workers(tmp_path):
+    from models.sharedcatalog import SharedCatalog
+    database = SQLiteDatabase(str(tmp_path / "shared.db"))
+    for i in range(5):
+        database.add_nonprofit(f"np_{i}", [i], [])
+    # Two workers' indexes on the same catalog directory
+    first, second = (NonprofitIndex(shared=SharedCatalog(str(tmp_path / "catalog"), poll_interval=0)) for _ in range(2))
+    first.ensure(database)
+    second.ensure(database)
+    assert first.version == second.version == 1
+    assert not second.matrix.flags.owndata and not second.matrix.flags.writeable
+    query = np.zeros(100, dtype=np.float32)
+    query[4] = 1
+    assert second.search(query, 2, exclude={"np_0"})[0] == "np_4"
+    assert second.rows_of(["np_3", "missing", "np_1"])[0] == ["np_3", "np_1"]
+    # A change in one worker is a new version, which the other maps on its next ensure
+    database.add_nonprofit("np_new", [7], [])
+    first.add(database, "np_new", [7], [])
+    database.update_nonprofit_tags("np_0", [4], [])
+    first.update(database, "np_0", [4], [])
+    assert first.version == 3 and second.ensure(database).version == 3
+    assert second.search(query, 2) == ["np_0", "np_4"] and "np_new" in second.rows
+    # Bulk writes invalidate; the next ensure republishes from the database
+    database.add_nonprofits([("np_bulk", [9], [])])
+    second.invalidate()
+    assert "np_bulk" in second.ensure(database).rows and first.ensure(database).version == 4
+    database.close()
+
+def test_shared_catalog_batch_publishes_once(tmp_path):
+    from models.sharedcatalog import SharedCatalog
+    from models.postings import TagPostings
+    database = SQLiteDatabase(str(tmp_path / "shared.db"))
+    random_catalog(database, 30)
+    first = NonprofitIndex(backend=TagPostings(), shared=SharedCatalog(str(tmp_path / "catalog"), poll_interval=0))
+    second = NonprofitIndex(shared=SharedCatalog(str(tmp_path / "catalog"), poll_interval=0))
+    first.ensure(database)
+    rng = np.random.default_rng(1)
+    with first.batch():
+        for i in range(20):
+            tags = rng.choice(100, 3, replace=False).tolist()
+            database.add_nonprofit(f"new_{i}", tags[:2], tags[2:])
+            first.add(database, f"new_{i}", tags[:2], tags[2:])
+        database.update_nonprofit_tags("np_0", [4], [])
+        first.update(database, "np_0", [4], [])
+        database.update_nonprofit_tags("new_3", [5], [])
+        first.update(database, "new_3", [5], [])
+        # Held back until the block ends
+        assert first.version == 1 and len(first) == 30
+    assert first.version == 2 and len(first) == 50
+    assert second.ensure(database).version == 2
+    expected = NonprofitIndex()
+    expected.ensure(database)
+    for index in (first, second):
+        np.testing.assert_allclose(index.matrix[index.rows_of(expected.ids.tolist())[1]], expected.matrix)
+    for query in rng.random((5, 100)).astype(np.float32):
+        assert first.search(query, 10) == expected.search(query, 10)
+    database.close()
+
+def test_refresh_queue_skips_seen(test_db):
+    for i in range(15):
+        test_db.add_nonprofit(f"np_{i}", [i], [])
+    user = User("user_test", new=True)
+    first = user.getNextN(10)
+    user.refreshQueue()
+    assert not set(first) & set(user.upcomingQueue)
+    assert len(user.upcomingQueue) == 5
+
+def test_refresh_queues_batch_matches_sequential(test_db, monkeypatch):
+    from models.user import refreshQueues
+    from helpers import compute_query_vectory
+    # Use the real query vectors so each user's ranking actually differs.
+    monkeypatch.setattr("models.user.compute_query_vectory", compute_query_vectory)
+    monkeypatch.setattr(User, "chooseEvent", lambda self: 0)
+    for i in range(30):
+        test_db.add_nonprofit(f"np_{i}", [i % 10, (i * 7) % 100], [(i * 3) % 100])
+    batch_users = [User(f"user_{i}", vector=np.random.rand(100).astype(np.float32)) for i in range(4)]
+    solo_users = [User(u.id, vector=u.getFullVector()) for u in batch_users]
+    batch_users[0].seenSet.add("np_0")
+    solo_users[0].seenSet.add("np_0")
+    refreshQueues(batch_users)
+    for batch_user, solo_user in zip(batch_users, solo_users):
+        solo_user.refreshQueue()
+        assert list(batch_user.upcomingQueue) == list(solo_user.upcomingQueue)
+    assert "np_0" not in batch_users[0].upcomingSet
+
+def test_reaction_reranks_queue_like_a_full_rescore(test_db, monkeypatch):
+    from helpers import compute_query_vectory
+    from models.nonprofit import NonProfit
+    monkeypatch.setattr("models.user.compute_query_vectory", compute_query_vectory)
+    monkeypatch.setattr(User, "chooseEvent", lambda self: 0)
+    for i in range(60):
+        test_db.add_nonprofit(f"np_{i}", [i % 30, (i * 7) % 100], [(i * 3) % 100])
+    user = User("user", vector=np.random.default_rng(1).random(100).astype(np.float32))
+    user.refreshQueue()
+    user.refreshQueue()
+    for reaction in (user.like, user.dislike, user.like):
+        reaction(NonProfit("np_x", [5, 6, 7], [8, 9]))
+    index = nonprofit_index.ensure(test_db)
+    query = compute_query_vectory(user.getCompTags(0))
+    for charity_id in user.upcomingQueue:
+        assert user.queueScores[charity_id] == pytest.approx(float(index.matrix[index.rows[charity_id]] @ query), abs=1e-4)
+    scores = [user.queueScores[charity_id] for charity_id in user.upcomingQueue]
+    assert scores == sorted(scores, reverse=True) and len(scores) == 20
+    user.getNextN(20)
+    assert user.queueScores == {}
+
+# -----------------------------------------------------------------------------
+# Tests for the IVF approximate retrieval backend
+# -----------------------------------------------------------------------------
+
+from models.ann import IVFIndex
+
+def random_catalog(db, count, seed=0):
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        tags = rng.choice(100, 23, replace=False).tolist()
+        db.add_nonprofit(f"np_{i}", tags[:3], tags[3:])
+
+def test_ivf_full_probe_matches_exact(db):
+    random_catalog(db, 300)
+    index = NonprofitIndex(backend=IVFIndex(nlist=16, nprobe=16)).ensure(db)
+    for _ in range(10):
+        query = np.random.rand(100).astype(np.float32)
+        assert index.search(query, 10) == index.exact_search(query, 10)
+
+def test_ivf_incremental_insert_and_exclusion(db):
+    random_catalog(db, 200)
+    index = NonprofitIndex(backend=IVFIndex(nlist=16, nprobe=1)).ensure(db)
+    index.add(db, "np_new", [7, 8, 9], [])
+    query = np.zeros(100, dtype=np.float32)
+    query[[7, 8, 9]] = 1
+    assert index.search(query, 1) == ["np_new"]
+    # Excluding nearly everything widens the probe instead of returning too few.
+    exclude = {f"np_{i}" for i in range(195)}
+    assert len(index.search(query, 10, exclude)) == 6
+
+def test_ivf_persistence_round_trip(db, tmp_path):
+    random_catalog(db, 200)
+    path = str(tmp_path / "ann_index.npz")
+    first = NonprofitIndex(backend=IVFIndex(nlist=8, path=path)).ensure(db)
+    second = NonprofitIndex(backend=IVFIndex(nlist=8, path=path)).ensure(db)
+    np.testing.assert_array_equal(first.backend.centroids, second.backend.centroids)
+    assert first.backend.assign == second.backend.assign
+
+# -----------------------------------------------------------------------------
+# Tests for the sparse tag-postings retrieval backend
+# -----------------------------------------------------------------------------
+
+from models.postings import TagPostings
+
+def test_postings_match_exact(db):
+    random_catalog(db, 400)
+    index = NonprofitIndex(backend=TagPostings()).ensure(db)
+    rng = np.random.default_rng(5)
+    for active in (20, 5, 1):
+        query = np.zeros(100, dtype=np.float32)
+        query[rng.choice(100, active, replace=False)] = rng.uniform(0.05, 1.0, active)
+        exclude = set(index.exact_search(query, 3))
+        assert index.search(query, 10) == index.exact_search(query, 10)
+        assert index.search(query, 10, exclude) == index.exact_search(query, 10, exclude)
+
+def test_postings_incremental_updates(db, monkeypatch):
+    random_catalog(db, 100)
+    monkeypatch.setattr(nonprofit_index, "backend", TagPostings())
+    nonprofit_index.invalidate()
+    nonprofit_index.ensure(db)
+    db.add_nonprofit("np_new", [40, 41, 42], [1, 2])
+    db.update_nonprofit_tags("np_0", [40, 41, 42], [])
+    query = np.zeros(100, dtype=np.float32)
+    query[[40, 41, 42]] = 1
+    assert nonprofit_index.search(query, 2) == ["np_0", "np_new"]
+    assert nonprofit_index.search(query, 10) == nonprofit_index.exact_search(query, 10)
+    nonprofit_index.invalidate()
+
+def concurrent_results(function, args):
+    """function(arg) for every arg, each on its own thread, all released at once."""
+    start = threading.Barrier(len(args))
+    results, errors = [None] * len(args), []
+
+    def run(i):
+        start.wait()
+        try:
+            results[i] = function(args[i])
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(args))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    return results
+
+def test_postings_concurrent_searches_after_add(db, monkeypatch):
+    random_catalog(db, 100)
+    postings = TagPostings()
+    monkeypatch.setattr(nonprofit_index, "backend", postings)
+    nonprofit_index.invalidate()
+    nonprofit_index.ensure(db)
+    rng = np.random.default_rng(5)
+    # Every tag active, so each search reads the postings every add touched
+    queries = [rng.random(100).astype(np.float32) for _ in range(8)]
+    for trial in range(20):
+        db.add_nonprofit(f"np_new_{trial}", rng.choice(100, 3, replace=False).tolist(), rng.choice(100, 20).tolist())
+        before = {key: tuple(id(array) for array in arrays) for key, arrays in postings.tiers.items()}
+        results = concurrent_results(lambda query: nonprofit_index.search(query, 5), queries)
+        assert results == [nonprofit_index.exact_search(query, 5) for query in queries]
+        # Searches run on the scoring pool without NonprofitIndex.lock, so they must only read
+        assert {key: tuple(id(array) for array in arrays) for key, arrays in postings.tiers.items()} == before
+    nonprofit_index.invalidate()
+
+# -----------------------------------------------------------------------------
+# Tests for write-behind user persistence
+# -----------------------------------------------------------------------------
+
+from models.writebehind import WriteBehindFlusher
+
+def test_upsert_users(db):
+    first = np.random.rand(100).astype(np.float32)
+    second = np.random.rand(100).astype(np.float32)
+    db.add_user("existing", first)
+    db.upsert_users([("existing", second), ("new", first)])
+    np.testing.assert_array_equal(db.get_user("existing"), second)
+    np.testing.assert_array_equal(db.get_user("new"), first)
+
+def test_flusher_batches_and_drains(db):
+    flusher = WriteBehindFlusher(db.upsert_users, interval=60, max_batch=3)
+    users = [User(f"user_{i}", new=True) for i in range(4)]
+    for user in users[:3]:
+        flusher.mark(user)
+    # Hitting max_batch wakes the flusher well before the interval.
+    for _ in range(100):
+        if db.get_user("user_2") is not None:
+            break
+        time.sleep(0.01)
+    assert all(db.get_user(u.id) is not None for u in users[:3])
+    flusher.mark(users[3])
+    assert flusher.pending("user_3") is users[3]
+    flusher.drain()
+    np.testing.assert_array_equal(db.get_user("user_3"), users[3].getFullVector())
+    assert not flusher.thread.is_alive()
+
+# -----------------------------------------------------------------------------
+# Tests for the session cache
+# -----------------------------------------------------------------------------
+
+from models.sessioncache import SessionCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_session_cache_lru_and_idle_ttl():
+    clock = FakeClock()
+    evicted = []
+    cache = SessionCache(lambda userID: User(userID, new=True), evicted.append,
+                         max_users=2, idle_ttl=10, clock=clock)
+    a = cache.get("a")
+    cache.get("b")
+    clock.now = 5
+    assert cache.get("a") is a  # "a" is now more recently active than "b"
+    clock.now = 8
+    cache.get("c")
+    assert [u.id for u in evicted] == ["b"]
+    # Activity, not login time, drives expiry: "a" was seen at t=5.
+    clock.now = 14
+    cache.expire()
+    assert "a" in cache
+    clock.now = 16
+    cache.expire()
+    assert "a" not in cache and "c" in cache
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["expirations"]) == (1, 3, 1, 1)
+
+def test_session_cache_evict_and_clear():
+    evicted = []
+    cache = SessionCache(lambda userID: User(userID, new=True), evicted.append)
+    cache.get("a")
+    cache.get("b")
+    assert cache.evict("a") and not cache.evict("a")
+    cache.clear()
+    assert [u.id for u in evicted] == ["a", "b"] and len(cache) == 0
+
+def test_session_cache_loads_and_evicts_outside_the_lock():
+    from concurrent.futures import ThreadPoolExecutor
+    release_load, release_evict = threading.Event(), threading.Event()
+    loads, evicted = [], []
+
+    def loader(userID):
+        loads.append(userID)
+        if userID == "slow":
+            assert release_load.wait(5)
+        return User(userID, new=True)
+
+    def on_evict(user):
+        assert release_evict.wait(5)
+        evicted.append(user)
+    cache = SessionCache(loader, on_evict)
+    fast = cache.get("fast")
+    with ThreadPoolExecutor(4) as pool:
+        slow = [pool.submit(cache.get, "slow") for _ in range(3)]
+        # A miss in progress doesn't hold up other users
+        assert pool.submit(cache.get, "fast").result(timeout=5) is fast
+        release_load.set()
+        assert len({id(future.result(timeout=5)) for future in slow}) == 1 and loads.count("slow") == 1
+        # Nor does an eviction; a user still being handed over comes back as the same object
+        leaving = pool.submit(cache.evict, "fast")
+        time.sleep(0.05)
+        assert cache.get("slow") is slow[0].result() and cache.get("fast") is fast
+        release_evict.set()
+        assert leaving.result(timeout=5) and evicted == [fast] and loads.count("fast") == 1
+
+# -----------------------------------------------------------------------------
+# Tests for background queue refills
+# -----------------------------------------------------------------------------
+
+from models.queuerefill import QueueRefiller
+from models.user import refreshQueues
+
+def test_queue_refiller_serves_most_recent_first():
+    class QueuedUser:
+        def __init__(self, id_val):
+            self.id = id_val
+            self.upcomingQueue = deque()
+    users = {name: QueuedUser(name) for name in "abcd"}
+    started, release, batches = threading.Event(), threading.Event(), []
+    def refresh(batch):
+        batches.append([user.id for user in batch])
+        started.set()
+        release.wait(5)
+        for user in batch:
+            user.upcomingQueue.extend(range(10))
+    refiller = QueueRefiller(refresh, low_water=10, max_batch=2)
+    refiller.request(users["a"])
+    assert started.wait(5)
+    for name in "bcdb":
+        refiller.request(users[name])
+    users["d"].upcomingQueue.extend(range(10))  # filled meanwhile: skipped
+    release.set()
+    assert refiller.wait_idle(5)
+    assert batches == [["a"], ["b", "c"]]
+    refiller.request(users["a"])  # already above the mark
+    assert refiller.wait_idle(5) and refiller.refills == 3
+    refiller.close()
+    assert not refiller.thread.is_alive()
+
+# -----------------------------------------------------------------------------
+# Tests for the popularity counters and pools
+# -----------------------------------------------------------------------------
+
+from models.popularity import Popularity
+
+def test_popularity_trending_pool_is_exact():
+    clock = FakeClock()
+    popularity = Popularity(half_life=10.0, pool_size=5, clock=clock)
+    rng = np.random.default_rng(0)
+    for step in range(500):
+        clock.now = step * 0.5
+        popularity.record(f"np_{rng.integers(40)}", likes=1, amount=float(rng.integers(3)))
+    decayed = {i: popularity.counters(i) for i in popularity.slots}
+    scores = {i: c["likes"] + 0.1 * c["amount"] for i, c in decayed.items()}
+    assert popularity.trending_ids() == sorted(scores, key=scores.get, reverse=True)[:5]
+
+def test_popularity_decay_and_gems():
+    clock = FakeClock()
+    popularity = Popularity(half_life=10.0, pool_size=2, gem_max_exposure=5.0, clock=clock)
+    popularity.record("np_a", likes=4)
+    clock.now = 10.0
+    assert popularity.counters("np_a")["likes"] == pytest.approx(2.0)
+    popularity.record("np_b", likes=1)
+    popularity.record_many(["np_a", "np_b", "np_c"], exposure=1)
+    assert popularity.gem_ids() == ["np_a", "np_b"]
+    # Shown too often to be a gem any more.
+    popularity.record_many(["np_a"] * 5, exposure=1)
+    assert popularity.gem_ids() == ["np_b"]
+
+def test_trending_event_serves_from_pool(test_db, monkeypatch):
+    for i in range(20):
+        test_db.add_nonprofit(f"np_{i}", [i], [])
+    fresh = Popularity(pool_size=3)
+    for nonprofit_id in ("np_5", "np_9", "np_13"):
+        fresh.record(nonprofit_id, likes=1)
+    monkeypatch.setattr("models.events.popularity", fresh)
+    monkeypatch.setattr(User, "chooseEvent", lambda self: 4)
+    user = User("user_test", new=True)
+    user.refreshQueue()
+    assert set(list(user.upcomingQueue)[:3]) == {"np_5", "np_9", "np_13"}
+    assert len(user.upcomingQueue) == 10
+
+# -----------------------------------------------------------------------------
+# Tests for the shared connection pool
+# -----------------------------------------------------------------------------
+
+from models.coinledger import CoinLedger
+
+def test_pool_shared_between_ledger_and_database(tmp_path):
+    path = str(tmp_path / "pool.db")
+    ledger = CoinLedger(path)
+    database = SQLiteDatabase(path)
+    assert ledger.pool is database.pool
+    assert database.pool.writer.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    tx_id = ledger.add("user", 5.0, "np")
+    seen = []
+    reader = threading.Thread(target=lambda: seen.append(
+        database.reader().execute("SELECT amount FROM coin_ledger WHERE transactionID = ?", (tx_id,)).fetchone()))
+    reader.start()
+    reader.join()
+    assert seen == [(5.0,)]
+    database.close()
+    del ledger
+    assert SQLiteDatabase(path).pool is not database.pool
+
+def test_app_context_creates_shared_resources_lazily():
+    app_context = AppContext(":memory:")
+    assert app_context.created() == []
+    databases = []
+    readers = [threading.Thread(target=lambda: databases.append(app_context.database)) for _ in range(4)]
+    for thread in readers:
+        thread.start()
+    for thread in readers:
+        thread.join()
+    assert all(database is databases[0] for database in databases)
+    # Same in-memory database for the ledger, instead of one of its own
+    tx_id = app_context.ledger.add("user", 5.0, "np_1")
+    assert app_context.database.reader().execute(
+        "SELECT amount FROM coin_ledger WHERE transactionID = ?", (tx_id,)).fetchone() == (5.0,)
+    app_context.database.add_nonprofit("np_1", [1, 2], [3])
+    index = app_context.warm_up()
+    assert list(index.ids) == ["np_1"] and index.source is app_context.database
+    assert "0" in app_context.tags and sorted(app_context.created()) == ["database", "ledger", "ledger_analytics", "tags"]
+    database = app_context.database
+    app_context.close()
+    assert app_context.created() == [] and app_context.database is not database
+
+from models.groupcommit import GroupCommitter
+from models.ledgeranalytics import LedgerAnalytics
+
+def test_group_committer_batches_concurrent_submits():
+    batches = []
+    def commit(items):
+        batches.append(list(items))
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+    committer = GroupCommitter(commit, max_batch=100, max_delay=0.05)
+    futures = [committer.submit(f"tx{i}") for i in range(20)]
+    assert [f.result(timeout=5) for f in futures] == [f"TX{i}" for i in range(20)]
+    assert len(batches) < 20
+    failed = committer.submit("bad")
+    with pytest.raises(ValueError):
+        failed.result(timeout=5)
+    last = committer.submit("last")
+    committer.close()
+    assert last.result(timeout=0) == "LAST" and not committer.thread.is_alive()
+
+from models import migrations
+from models.migrations import legacy_transaction_id, unify_coin_ledger
+
+def legacy_ledger(path, rows):
+    # coin_ledger as SQLiteDatabase used to create it
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE coin_ledger (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                 "timestamp TEXT, userID TEXT, amount REAL, nonprofitID TEXT)")
+    conn.executemany("INSERT INTO coin_ledger (timestamp, userID, amount, nonprofitID) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    return conn
+
+def test_migrations_bring_new_and_legacy_files_to_latest(tmp_path, monkeypatch):
+    db = SQLiteDatabase(":memory:")
+    assert migrations.schema_version(db.pool.writer) == migrations.latest_version()
+    assert migrations.migrate(db.pool) == []
+    path = str(tmp_path / "legacy.db")
+    legacy_ledger(path, [("2024-05-01T10:00:00", "u", float(i), "np") for i in range(1, 8)]).close()
+    monkeypatch.setattr(migrations, "LEDGER_MIGRATION_BATCH", 3)
+    database = SQLiteDatabase(path)
+    assert migrations.schema_version(database.pool.writer) == migrations.latest_version()
+    ledger = CoinLedger(path)
+    ledger.add("u", 10.0, "np")
+    assert LedgerAnalytics(ledger).nonprofit_total("np") == {"total": 38.0, "count": 8}
+    assert len(database.get_json()["coin_ledger"]) == 8
+    database.close()
+
+def test_migrations_from_version_0_with_legacy_name_tags(tmp_path, monkeypatch):
+    path = str(tmp_path / "legacy.db")
+    conn = legacy_ledger(path, [("2024-05-01T10:00:00", "u", 5.0, "np_1")])
+    conn.execute("CREATE TABLE users (id TEXT PRIMARY KEY, vector BLOB)")
+    conn.execute("INSERT INTO users VALUES ('u', ?)", (vector_to_blob(np.ones(100)),))
+    conn.execute("CREATE TABLE nonprofits (id TEXT PRIMARY KEY, primary_tags TEXT, secondary_tags TEXT)")
+    conn.executemany("INSERT INTO nonprofits VALUES (?, ?, ?)",
+                     [(f"np_{i}", "Education, Mental Health", "[0]") for i in range(1, 6)]
+                     + [("np_6", "Education, Health", "children")])
+    conn.commit()
+    assert migrations.schema_version(conn) == 0
+    conn.close()
+    # Small batches, so the undecodable row is met between converted ones
+    monkeypatch.setattr(migrations, "convert_nonprofits", functools.partial(migrations.convert_nonprofits, batch_size=2))
+    database = SQLiteDatabase(path)
+    assert migrations.schema_version(database.pool.writer) == migrations.latest_version()
+    assert database.get_nonprofit("np_5").tags == {"primary": [21, 5], "secondary": [0]}
+    ids, _ = database.get_nonprofit_matrix()
+    assert sorted(ids.tolist()) == [f"np_{i}" for i in range(1, 6)]
+    assert LedgerAnalytics(CoinLedger(path)).nonprofit_total("np_1") == {"total": 5.0, "count": 1}
+    database.close()
+
+def test_ledger_migration_catches_up_with_writes_between_batches(tmp_path):
+    conn = legacy_ledger(str(tmp_path / "legacy.db"), [("2024-05-01", "u", float(i), "np") for i in range(1, 6)])
+    batches = unify_coin_ledger(conn, batch_size=2)
+    assert next(batches) == 2
+    # Between batches the app keeps using the old table.
+    conn.execute("INSERT INTO coin_ledger (timestamp, userID, amount, nonprofitID) VALUES ('2024-05-02', 'v', 6.0, 'np')")
+    conn.execute("DELETE FROM coin_ledger WHERE id = 1")
+    assert list(batches) == [2, 2]
+    rows = conn.execute("SELECT transactionID, amount FROM coin_ledger ORDER BY amount").fetchall()
+    assert [amount for _, amount in rows] == [2.0, 3.0, 4.0, 5.0, 6.0]
+    assert rows[-1][0] == legacy_transaction_id(6, "2024-05-02", "v", 6.0, "np")
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert "coin_ledger_copied" not in tables and "coin_ledger_unified" not in tables
+
+def test_user_revisions_number_existing_and_new_writes(tmp_path):
+    path = str(tmp_path / "users.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id TEXT PRIMARY KEY, vector BLOB)")
+    conn.executemany("INSERT INTO users VALUES (?, ?)", [(f"u{i}", vector_to_blob(np.full(100, i))) for i in range(5)])
+    conn.execute("PRAGMA user_version = 4")
+    conn.commit()
+    batches = migrations.add_user_revisions(conn, batch_size=2)
+    assert list(batches) == [0, 2, 2, 1]
+    revisions = lambda: dict(conn.execute("SELECT id, revision FROM users").fetchall())
+    assert revisions() == {f"u{i}": i + 1 for i in range(5)}
+    conn.execute("UPDATE users SET vector = ? WHERE id = 'u1'", (vector_to_blob(np.zeros(100)),))
+    conn.execute("INSERT INTO users (id, vector) VALUES ('u5', NULL)")
+    assert revisions()["u1"] == 6 and revisions()["u5"] == 7
+    conn.commit()
+    conn.close()
+    # Opening the file reruns the migration (user_version is still 4), which changes nothing
+    database = SQLiteDatabase(path)
+    database.upsert_users([("u0", np.ones(100)), ("u6", np.ones(100))])
+    chunks = list(database.iter_user_vectors(since=6, chunk_size=2))
+    assert [(ids, revision) for ids, _, revision in chunks] == [(["u5", "u0"], 8), (["u6"], 9)]
+    assert not chunks[0][1][0].any() and chunks[0][1][1].sum() == 100
+    database.close()
+
+def test_ledger_add_many_returns_distinct_ids():
+    ledger = CoinLedger(":memory:")
+    tx_ids = ledger.add_many([("user", 5.0, "np")] * 3)
+    assert len(set(tx_ids)) == 3
+    rows = ledger.pool.reader().execute("SELECT COUNT(*), SUM(amount) FROM coin_ledger").fetchone()
+    assert rows == (3, 15.0)
+
+# -----------------------------------------------------------------------------
+# Tests for metrics and the sampling profiler
+# -----------------------------------------------------------------------------
+
+from models import metrics as metrics_module
+from models.metrics import Metrics, SamplingProfiler
+
+def test_metrics_timers_counters_and_callbacks(monkeypatch):
+    registry = Metrics()
+    monkeypatch.setattr(metrics_module, "metrics", registry)
+    double = metrics_module.timed("work_seconds", "Work", op="double")(lambda x: 2 * x)
+    assert double(4) == 8 and double(5) == 10
+    registry.counter("jobs", "Jobs run").inc(3)
+    registry.callback("queue_depth", "Depth", lambda: 7)
+    text = registry.render()
+    assert '# TYPE work_seconds histogram' in text
+    assert 'work_seconds_count{op="double"} 2' in text
+    assert 'work_seconds_bucket{le="+Inf",op="double"} 2' in text
+    assert 'jobs_total 3' in text and 'queue_depth 7.0' in text
+    monkeypatch.setattr(metrics_module, "METRICS_ENABLED", False)
+    fn = lambda: None
+    assert metrics_module.timed("off_seconds")(fn) is fn
+
+def test_sampling_profiler_collects_stacks():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    deadline = time.time() + 5
+    while profiler.samples < 5 and time.time() < deadline:
+        sum(range(10000))
+    profiler.stop()
+    assert profiler.samples >= 5 and "test_sampling_profiler_collects_stacks" in profiler.collapsed()
+
 # -----------------------------------------------------------------------------
 # Integration tests for the FastAPI API endpoints
 # -----------------------------------------------------------------------------
@@ -187,3 +935,390 @@ def test_reaction_endpoint(client):
     assert response.status_code == 200
     assert response.text.strip('"') == "success"
 
+@pytest.fixture
+def api(monkeypatch):
+    import main
+    test_context = AppContext(":memory:")
+    test_db_instance = test_context.database
+    for name in ("database", "ledger", "ledger_analytics"):
+        monkeypatch.setattr(context, name, getattr(test_context, name))
+    monkeypatch.setattr("main.flusher", WriteBehindFlusher(test_db_instance.upsert_users, interval=60))
+    monkeypatch.setattr("main.CachedUsers", SessionCache(main.loadUser, main.flusher.mark))
+    monkeypatch.setattr("main.ledgerCommits", GroupCommitter(main.commitPayments))
+    monkeypatch.setattr("main.queueRefiller", QueueRefiller(refreshQueues))
+    yield TestClient(app), test_db_instance
+    main.queueRefiller.close()
+
+def test_api_first_request_logs_user_on(api):
+    client, database = api
+    for i in range(5):
+        database.add_nonprofit(f"np_{i}", [i], [])
+    response = client.get("/nextN", params={"userID": "fresh_user", "n": 2})
+    assert response.status_code == 200
+    assert len(response.json()["array"]) == 2
+    response = client.get("/reaction", params={"userID": "fresh_user", "reactionNum": 0, "nonprofitID": "np_1"})
+    assert response.text == "success"
+    import main
+    main.logOut("fresh_user")
+    main.flusher.drain()
+    assert database.get_user("fresh_user") is not None
+
+
+def test_api_nextN_served_from_refilled_queue(api, monkeypatch):
+    client, database = api
+    import main
+    for i in range(40):
+        database.add_nonprofit(f"np_{i}", [i], [])
+    assert len(client.get("/nextN", params={"userID": "u", "n": 3}).json()["array"]) == 3
+    assert main.queueRefiller.wait_idle(5)
+    user = main.CachedUsers.peek("u")
+    assert len(user.upcomingQueue) >= main.queueRefiller.low_water
+    monkeypatch.setattr(User, "refreshQueue", lambda self: pytest.fail("refilled inline"))
+    served = client.get("/nextN", params={"userID": "u", "n": 3}).json()["array"]
+    assert len(served) == 3 and not set(served) & user.upcomingSet
+
+def test_api_metrics_and_profiler(api):
+    client, database = api
+    database.add_nonprofit("np_0", [0], [])
+    client.get("/nextN", params={"userID": "u", "n": 1})
+    client.get("/nextN", params={"userID": "u", "n": 1})
+    text = client.get("/metrics").text
+    assert 'handler_seconds_count{endpoint="nextN"}' in text
+    assert "session_cache_hit_ratio 0.5" in text
+    assert 'sqlite_call_seconds_count{op="get_vector"}' in text
+    client.get("/ledgerTotal", params={"userID": "u"})
+    client.get("/topNonprofits")
+    text = client.get("/metrics").text
+    assert 'handler_seconds_count{endpoint="ledgerTotal"}' in text
+    assert 'handler_seconds_count{endpoint="topNonprofits"}' in text
+    assert client.get("/profiler", params={"password": "wrong", "enable": True}).text.startswith("FAIL")
+    from main import DB_GET_PASSWORD, profiler
+    assert client.get("/profiler", params={"password": DB_GET_PASSWORD, "enable": True}).status_code == 200
+    assert profiler.running
+    client.get("/profiler", params={"password": DB_GET_PASSWORD, "enable": False})
+    assert not profiler.running
+
+from models.dbexecutor import DatabaseExecutor
+
+def test_database_executor_pools_and_shutdown():
+    import asyncio
+    executor = DatabaseExecutor(readers=2, scorers=1)
+    both_reading = threading.Barrier(2, timeout=5)
+    active, overlaps = [0], []
+
+    def write(i):
+        active[0] += 1
+        overlaps.append(active[0])
+        time.sleep(0.001)
+        active[0] -= 1
+        return threading.current_thread().name, i
+
+    async def scenario():
+        # Two reads only get past the barrier if the reader pool runs them side by side
+        reads = await asyncio.gather(*(executor.read(lambda: (both_reading.wait(), threading.current_thread().name)[1])
+                                       for _ in range(2)))
+        writes = await asyncio.gather(*(executor.write(write, i) for i in range(20)))
+        computed = await executor.compute(threading.current_thread)
+        return reads, writes, computed.name
+    reads, writes, computed = asyncio.run(scenario())
+    assert all(name.startswith("sqlite-reader") for name in reads) and len(set(reads)) == 2
+    assert [i for _, i in writes] == list(range(20)) and {name for name, _ in writes} == {"sqlite-writer_0"}
+    assert max(overlaps) == 1 and computed.startswith("scoring")
+    # From plain threads (the flusher, the ledger committer), on the same writer thread
+    assert executor.write_sync(write, 99) == ("sqlite-writer_0", 99)
+    # Shutdown lets queued writes finish, then refuses new ones
+    queued = executor.writer.submit(time.sleep, 0.05)
+    executor.shutdown()
+    assert queued.done()
+    with pytest.raises(RuntimeError):
+        executor.write_sync(write, 100)
+
+def test_api_writes_stay_on_the_writer_thread(api, monkeypatch):
+    client, database = api
+    import main
+    from concurrent.futures import ThreadPoolExecutor
+    for i in range(5):
+        database.add_nonprofit(f"np_{i}", [i], [])
+    monkeypatch.setattr("main.flusher", WriteBehindFlusher(main.persistUsers, interval=60))
+    monkeypatch.setattr("main.CachedUsers", SessionCache(main.loadUser, main.flusher.mark))
+    lock, active, calls = threading.Lock(), {"read": 0, "write": 0}, []
+
+    def tracked(kind, fn):
+        def run(*args, **kwargs):
+            with lock:
+                active[kind] += 1
+                calls.append((kind, threading.current_thread().name, active[kind]))
+            try:
+                time.sleep(0.001)
+                return fn(*args, **kwargs)
+            finally:
+                with lock:
+                    active[kind] -= 1
+        return run
+    monkeypatch.setattr(main.ledger, "add_many", tracked("write", main.ledger.add_many))
+    monkeypatch.setattr(database, "upsert_users", tracked("write", database.upsert_users))
+    monkeypatch.setattr(database, "get_nonprofit", tracked("read", database.get_nonprofit))
+
+    def call(i):
+        if i % 3 == 0:
+            return client.get("/addLedger", params={"userID": f"u{i}", "amount": 1, "nonprofitID": "np_1"}).status_code
+        if i % 3 == 1:
+            return client.post("/addLedgerBatch", json=[{"userID": f"u{i}", "amount": 2, "nonprofitID": "np_2"}]).status_code
+        return client.get("/reaction", params={"userID": f"u{i}", "reactionNum": 0, "nonprofitID": "np_1"}).status_code
+    with ThreadPoolExecutor(8) as pool:
+        assert set(pool.map(call, range(24))) == {200}
+    main.flusher.drain()
+    writes = [call for call in calls if call[0] == "write"]
+    reads = [call for call in calls if call[0] == "read"]
+    assert len(reads) == 8 and all(name.startswith("sqlite-reader") for _, name, _ in reads)
+    # Ledger batches, group commits and the user flush all ran on the one writer thread, one at a time
+    assert writes and {name for _, name, _ in writes} == {"sqlite-writer_0"}
+    assert max(concurrent for _, _, concurrent in writes) == 1
+    assert len(database.get_json()["coin_ledger"]) == 16 and database.get_user("u2") is not None
+
+def test_api_get_database_streams_export(api):
+    client, database = api
+    import main
+    database.add_user("user_1", np.arange(100, dtype=np.float32))
+    database.add_nonprofit("np_1", [1, 2, 3], [4])
+    expected = database.get_json()
+    chunks = list(database.iter_json(chunk_size=1))
+    assert len(chunks) > 4 and json.loads("".join(chunks)) == expected
+    response = client.get("/getDatabase", params={"password": main.DB_GET_PASSWORD})
+    assert response.json() == expected
+    response = client.get("/getDatabase", params={"password": main.DB_GET_PASSWORD, "gzip": True})
+    # The client undoes the gzip Content-Encoding itself.
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json() == expected
+
+def test_api_ledger_single_and_batch(api):
+    client, _ = api
+    import main
+    tx_id = client.get("/addLedger", params={"userID": "u", "amount": 5, "nonprofitID": "np_1"}).json()["tx_id"]
+    response = client.post("/addLedgerBatch", json=[
+        {"userID": "u", "amount": 1, "nonprofitID": "np_1"},
+        {"userID": "v", "amount": 2.5, "nonprofitID": "np_2"},
+    ])
+    tx_ids = response.json()["tx_ids"]
+    assert len(set(tx_ids + [tx_id])) == 3
+    rows = main.ledger.pool.reader().execute(
+        "SELECT transactionID, amount FROM coin_ledger ORDER BY amount").fetchall()
+    assert rows == [(tx_ids[0], 1.0), (tx_ids[1], 2.5), (tx_id, 5.0)]
+
+def test_api_ledger_analytics(api):
+    client, _ = api
+    import main
+    tx_ids = main.ledger.add_many([("u", 5.0, "np_1"), ("u", 2.0, "np_2"), ("v", 1.0, "np_1")])
+    main.ledger.remove(tx_ids[1])
+    assert client.get("/ledgerTotal", params={"userID": "u"}).json() == {"total": 5.0, "count": 1}
+    assert client.get("/ledgerTotal", params={"nonprofitID": "np_1"}).json() == {"total": 6.0, "count": 2}
+    assert client.get("/ledgerTotal").text.startswith("FAIL")
+    top = client.get("/topNonprofits", params={"limit": 1}).json()
+    assert top == [{"nonprofitID": "np_1", "total": 6.0, "count": 2}]
+    today = time.strftime("%Y-%m-%d")
+    daily = client.get("/ledgerDaily", params={"start": today, "end": today, "nonprofitID": "np_1"}).json()
+    assert daily == {"days": [{"day": today, "total": 6.0, "count": 2}], "total": 6.0, "count": 2}
+
+def test_ledger_summaries_backfilled_from_existing_rows(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    conn = sqlite3.connect(path)
+    CoinLedger.create_table(conn)
+    conn.execute("INSERT INTO coin_ledger VALUES ('tx', '2024-05-01T10:00:00', 'u', 3.0, 'np')")
+    conn.commit()
+    conn.close()
+    analytics = LedgerAnalytics(CoinLedger(path))
+    assert analytics.nonprofit_total("np") == {"total": 3.0, "count": 1}
+    assert analytics.daily("2024-05-01", "2024-05-31")["total"] == 3.0
+    plan = analytics.pool.reader().execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM coin_ledger WHERE userID = 'u'").fetchall()
+    assert "coin_ledger_user" in str(plan)
+
+from models.sharding import HashRing
+
+def test_hash_ring_is_stable_and_balanced():
+    users = [f"user_{i}" for i in range(4000)]
+    ring = HashRing(4)
+    owners = [ring.owner(userID) for userID in users]
+    assert owners == [HashRing(4).owner(userID) for userID in users]
+    counts = np.bincount(owners, minlength=4)
+    assert counts.min() > 500
+    # A fifth shard takes users only from the others, about a fifth of them
+    grown = HashRing(5)
+    moved = [userID for userID, owner in zip(users, owners) if grown.owner(userID) != owner]
+    assert all(grown.owner(userID) == 4 for userID in moved)
+    assert 0.1 < len(moved) / len(users) < 0.3
+    assert HashRing(1).owner("anyone") == 0
+    groups = ring.split(users[:20])
+    assert sorted(sum(groups.values(), [])) == sorted(users[:20])
+    assert all(ring.owner(userID) == shard for shard, ids in groups.items() for userID in ids)
+
+def test_api_refuses_users_of_other_shards(api, monkeypatch):
+    client, database = api
+    import main
+    ring = HashRing(2)
+    monkeypatch.setattr("main.SHARD_COUNT", 2)
+    monkeypatch.setattr("main.SHARD_INDEX", 0)
+    monkeypatch.setattr("main.shardRing", ring)
+    database.add_nonprofit("np_1", [1], [])
+    ours, theirs = (next(f"u{i}" for i in range(100) if ring.owner(f"u{i}") == shard) for shard in (0, 1))
+    assert client.get("/nextN", params={"userID": ours}).status_code == 200
+    response = client.get("/nextN", params={"userID": theirs})
+    assert response.status_code == 421 and theirs in response.text
+    assert client.get("/nextNBatch", params={"userIDs": [ours, theirs]}).status_code == 421
+    assert client.get("/reaction", params={"userID": theirs, "reactionNum": 0, "nonprofitID": "np_1"}).status_code == 421
+    assert main.CachedUsers.peek(theirs) is None
+
+def test_router_sends_users_to_their_owner():
+    import asyncio
+    from urllib.parse import parse_qsl
+    from router import Router
+
+    class FakeShard:
+        def __init__(self, shard):
+            self.shard = shard
+            self.targets = []
+
+        async def request(self, method, target, headers=(), body=b""):
+            self.targets.append(target)
+            if target.startswith(b"/nextNBatch"):
+                userIDs = [value for key, value in parse_qsl(target.split(b"?")[1].decode()) if key == "userIDs"]
+                if not userIDs:
+                    return 422, [(b"content-type", b"application/json")], b'{"detail": "missing userIDs"}'
+                content = json.dumps({"arrays": {userID: [self.shard] for userID in userIDs}}).encode()
+            else:
+                content = str(self.shard).encode()
+            return 200, [(b"content-type", b"application/json")], content
+
+    async def get(router, target):
+        path, _, query = target.partition("?")
+        scope = {"type": "http", "method": "GET", "path": path, "raw_path": path.encode(),
+                 "query_string": query.encode(), "headers": []}
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            sent.append(message)
+        await router(scope, receive, send)
+        return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+    shards = [FakeShard(shard) for shard in range(3)]
+    router = Router(shards)
+    users = [f"u{i}" for i in range(12)]
+    for userID in users:
+        assert asyncio.run(get(router, f"/nextN?userID={userID}&n=2")) == (200, str(router.ring.owner(userID)).encode())
+    # The target reaches the worker unchanged
+    assert shards[router.ring.owner("u0")].targets[0] == b"/nextN?userID=u0&n=2"
+    status, body = asyncio.run(get(router, "/nextNBatch?n=2&" + "&".join(f"userIDs={userID}" for userID in users)))
+    assert status == 200 and json.loads(body)["arrays"] == {userID: [router.ring.owner(userID)] for userID in users}
+    # An empty batch gets the worker's validation error, not an empty 200
+    assert asyncio.run(get(router, "/nextNBatch?n=2")) == (422, b'{"detail": "missing userIDs"}')
+    assert asyncio.run(get(router, "/metrics?shard=2")) == (200, b"2")
+    assert {asyncio.run(get(router, "/ledgerTotal"))[1] for _ in range(3)} == {b"0", b"1", b"2"}
+    assert TestClient(app).get("/nextNBatch", params={"n": 2}).status_code == 422
+
+def test_shard_client_reuses_connections_and_reads_chunked(tmp_path):
+    import asyncio
+    from router import ShardClient
+    path = str(tmp_path / "shard.sock")
+    connections = []
+
+    async def serve(reader, writer):
+        connections.append(writer)
+        while (line := await reader.readline()):
+            target = line.split()[1]
+            while await reader.readline() != b"\r\n":
+                pass
+            if target == b"/chunked":
+                writer.write(b"HTTP/1.1 200 OK\r\ntransfer-encoding: chunked\r\n\r\n"
+                             b"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n")
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\ncontent-type: text/plain\r\ncontent-length: %d\r\n\r\n%s"
+                             % (len(target), target))
+            await writer.drain()
+        writer.close()
+
+    async def scenario():
+        server = await asyncio.start_unix_server(serve, path)
+        client = ShardClient(path)
+        status, headers, body = await client.request("GET", b"/a?x=1")
+        assert (status, body) == (404, b"/a?x=1") and (b"content-type", b"text/plain") in headers
+        status, _, chunks = await client.request("GET", b"/chunked")
+        assert status == 200 and b"".join([chunk async for chunk in chunks]) == b"abcde"
+        assert (await client.request("GET", b"/b"))[2] == b"/b"
+        assert len(connections) == 1
+        # A worker restart closes the idle connection; the request goes out on a new one
+        connections[0].close()
+        await asyncio.sleep(0.01)
+        assert (await client.request("GET", b"/c"))[2] == b"/c"
+        assert len(connections) == 2
+        client.close()
+        server.close()
+        await server.wait_closed()
+    asyncio.run(scenario())
+
+from models import uservectors
+from models.uservectors import UserVectorStore
+
+def test_user_vector_store_syncs_only_changed_users(tmp_path, monkeypatch):
+    monkeypatch.setattr(uservectors, "MIN_CAPACITY", 4)
+    database = SQLiteDatabase(str(tmp_path / "users.db"))
+    database.upsert_users([(f"u{i}", np.full(100, i, dtype=np.float32)) for i in range(6)])
+    store = UserVectorStore(str(tmp_path / "vectors"))
+    assert store.count == 0 and store.sync(database, chunk_size=4) == (0, 6)
+    assert list(store.ids) == [f"u{i}" for i in range(6)] and store.matrix[store.rows["u3"]][0] == 3
+    # One changed and two new users: the rest of the matrix isn't rewritten
+    database.update_user_vector("u2", np.full(100, 20))
+    database.upsert_users([("u6", np.full(100, 6)), ("u7", np.full(100, 7))])
+    assert store.sync(database, chunk_size=2) == (1, 2) and store.sync(database) == (0, 0)
+    reader = UserVectorStore(str(tmp_path / "vectors"))
+    assert reader.count == 8 and reader.revision == store.revision
+    assert {userID: float(vector[0]) for ids, vectors in reader.chunks(3) for userID, vector in zip(ids, vectors)} == \
+        {**{f"u{i}": float(i) for i in range(8)}, "u2": 20.0}
+    assert not reader.matrix.flags.writeable
+    assert store.rebuild(database) == (0, 8)
+    assert np.array_equal(store.matrix[store.rows.lookup(reader.ids)[1]], reader.matrix)
+    database.close()
+
+from models.prerank import basic_queries, rank_users, init_worker, rank_rows
+
+def test_prerank_matches_live_ranking(tmp_path):
+    from helpers import compute_query_vectory
+    rng = np.random.default_rng(3)
+    weights = np.where(rng.random((40, 100)) < 0.3, 0, rng.choice([0.25, 0.5, 0.75], (40, 100))).astype(np.float32)
+    weights[0] = 0
+    weights[1, 5:] = 0
+    for row, query in zip(weights, basic_queries(weights)):
+        assert np.array_equal(query, compute_query_vectory(UserTagTable("u", vector=row).getCompTags()))
+    database = SQLiteDatabase(str(tmp_path / "prerank.db"))
+    database.add_nonprofits([(f"np_{i}", [i % 100, (7 * i) % 100], [(3 * i) % 100]) for i in range(300)])
+    index = NonprofitIndex().ensure(database)
+    ranked = rank_users(weights, *database.get_nonprofit_matrix(), 10)
+    assert ranked == index.search_batch(basic_queries(weights), 10, [()] * 40)
+    # The pool workers rank the store's rows the same way
+    database.upsert_users([(f"u{i}", row) for i, row in enumerate(weights)])
+    store = UserVectorStore(str(tmp_path / "vectors"))
+    store.sync(database)
+    init_worker(str(tmp_path / "prerank.db"), str(tmp_path / "vectors"))
+    userIDs, rankings = rank_rows((2, 7, 10))
+    assert userIDs == [f"u{i}" for i in range(2, 7)] and rankings == ranked[2:7]
+    database.close()
+
+def test_login_seeds_queue_from_current_recommendations(api, monkeypatch):
+    client, database = api
+    import main
+    for i in range(40):
+        database.add_nonprofit(f"np_{i}", [i], [])
+    database.add_user("u", np.full(100, 0.5, dtype=np.float32))
+    database.add_user("v", np.full(100, 0.5, dtype=np.float32))
+    revision = database.reader().execute("SELECT MAX(revision) FROM users").fetchone()[0]
+    ranking = [f"np_{i}" for i in range(39, 9, -1)]
+    database.put_user_recommendations([("u", ranking), ("v", ranking)], revision)
+    # v changed after the ranking was computed, so it isn't used
+    database.update_user_vector("v", np.full(100, 0.25, dtype=np.float32))
+    assert database.get_user_recommendations("u") == ranking and database.get_user_recommendations("v") == []
+    monkeypatch.setattr(User, "refreshQueue", lambda self: pytest.fail("searched the catalog"))
+    assert client.get("/nextN", params={"userID": "u", "n": 3}).json()["array"] == ranking[:3]
+    user = main.CachedUsers.peek("u")
+    assert list(user.upcomingQueue) == ranking[3:] and user.baseQuery is not None
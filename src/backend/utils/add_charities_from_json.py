@@ -1,41 +1,38 @@
 import json
-import sqlite3
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.sqlite_db import SQLiteDatabase
 
 # Define the database and JSON file paths
 DB_FILE = "data/data.db"          # Update if your database file has a different name
 JSON_FILE = "output.json"  # Update with the actual JSON file path
+TAGS_FILE = "data/tags.json"
 
-# Connect to the SQLite database
-conn = sqlite3.connect(DB_FILE)
-cursor = conn.cursor()
+# Open the database (creates the nonprofits table if it doesn't exist)
+database = SQLiteDatabase(DB_FILE)
 
-# Create the Nonprofits table if it doesn't exist
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS Nonprofits (
-    id TEXT PRIMARY KEY,
-    primary_tags TEXT,
-    secondary_tags TEXT
-)
-""")
+# Tag names in the JSON are stored as tag ids
+with open(TAGS_FILE, "r", encoding="utf-8") as file:
+    tag_ids = {name.lower(): int(tag_id) for tag_id, name in json.load(file).items()}
 
 # Load JSON data from file
 with open(JSON_FILE, "r", encoding="utf-8") as file:
     nonprofits_data = json.load(file)
 
-# Insert data into the Nonprofits table
+# Insert or replace each entry in the nonprofits table
 for entry in nonprofits_data:
     nonprofit_id = entry["id"]
-    primary_tags = ", ".join(entry["primaryTags"])
-    secondary_tags = ", ".join(entry["secondaryTags"])
-    
-    cursor.execute("""
-    INSERT OR REPLACE INTO Nonprofits (id, primary_tags, secondary_tags)
-    VALUES (?, ?, ?)
-    """, (nonprofit_id, primary_tags, secondary_tags))
-
-# Commit changes and close the database connection
-conn.commit()
-conn.close()
+    primary_tags = [tag_ids[name.lower()] for name in entry["primaryTags"]]
+    secondary_tags = [tag_ids[name.lower()] for name in entry["secondaryTags"]]
+
+    try:
+        database.add_nonprofit(nonprofit_id, primary_tags, secondary_tags)
+    except ValueError:
+        database.update_nonprofit_tags(nonprofit_id, primary_tags, secondary_tags)
+
+database.close()
 
 print("Data successfully inserted into the Nonprofits table.")
 
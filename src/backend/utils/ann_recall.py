@@ -0,0 +1,105 @@
+"""
+ann_recall.py
+
+Measures how closely the IVF retrieval backend tracks the exact top-10 that
+User.refreshQueue returns today, for a range of nprobe settings.
+
+Queries are built like UserTagTable.getCompTags: a random weight for each of
+20 tags. Recall@k is the share of the exact top-k that the approximate search
+also returns.
+
+Usage (from src/backend):
+    python utils/ann_recall.py --nlist 1024 --nprobe 1 2 4 8 16 32
+    python utils/ann_recall.py --synthetic 1000000 --queries 200
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.ann import IVFIndex
+from models.nonprofitindex import NonprofitIndex
+from models.sqlite_db import SQLiteDatabase
+from config import DATABASE_PATH
+
+
+def synthetic_index(count, seed=0):
+    """An in-memory catalog of `count` nonprofits with 3 primary and 20 secondary tags each."""
+    rng = np.random.default_rng(seed)
+    index = NonprofitIndex()
+    matrix = np.zeros((count, index.total_tags), dtype=np.float32)
+    tags = np.argsort(rng.random((count, index.total_tags)), axis=1)[:, :23]
+    rows = np.arange(count)[:, None]
+    matrix[rows, tags[:, 3:]] = 1
+    matrix[rows, tags[:, :3]] = 10
+    index.matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    index.ids = np.array([f"np_{i}" for i in range(count)], dtype=object)
+    index.rows = {nonprofit_id: row for row, nonprofit_id in enumerate(index.ids)}
+    index.stale = False
+    return index
+
+
+def random_queries(count, total_tags=100, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = np.zeros((count, total_tags), dtype=np.float32)
+    for query in queries:
+        query[rng.choice(total_tags, 20, replace=False)] = rng.uniform(0.05, 1.0, 20)
+    return queries
+
+
+def evaluate(index, queries, nprobe, k):
+    index.backend.nprobe = nprobe
+    recalls = []
+    start = time.perf_counter()
+    results = [index.search(query, k) for query in queries]
+    elapsed = time.perf_counter() - start
+    for query, approx in zip(queries, results):
+        exact = index.exact_search(query, k)
+        recalls.append(len(set(exact) & set(approx)) / max(1, len(exact)))
+    return float(np.mean(recalls)), elapsed / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs exact search for the IVF retrieval backend.")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Use a random catalog of this many nonprofits instead of the database")
+    parser.add_argument("--nlist", type=int, default=0,
+                        help="Number of IVF lists (default: 4 * sqrt(catalog size))")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32],
+                        help="nprobe values to evaluate")
+    parser.add_argument("--queries", type=int, default=500, help="Number of random user queries")
+    parser.add_argument("-k", type=int, default=10, help="Cut-off for recall@k (default: 10)")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        index = synthetic_index(args.synthetic)
+    else:
+        index = NonprofitIndex().ensure(SQLiteDatabase(DATABASE_PATH))
+    if len(index) == 0:
+        print("No nonprofits to evaluate.")
+        return
+
+    index.backend = IVFIndex(nlist=args.nlist or None)
+    start = time.perf_counter()
+    index.backend.build(index.matrix, index.ids)
+    print(f"Built {len(index.backend.lists)} lists over {len(index)} nonprofits "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    queries = random_queries(args.queries, index.total_tags)
+    start = time.perf_counter()
+    for query in queries:
+        index.exact_search(query, args.k)
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"exact: {exact_ms:.3f} ms/query")
+    print(f"{'nprobe':>8} {'recall@' + str(args.k):>10} {'ms/query':>10}")
+    for nprobe in args.nprobe:
+        recall, ms = evaluate(index, queries, nprobe, args.k)
+        print(f"{nprobe:>8} {recall:>10.4f} {ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+cold_start_bench.py
+
+How long a fresh backend process takes to serve its first /nextN, split
+into the steps a worker goes through:
+    import_ms    importing main.py (FastAPI, numpy and the models)
+    startup_ms   the lifespan hook: with warm-up, opening and migrating the
+                 database and loading the nonprofit catalog
+    first_ms     the first nextCharity call (handler only, no HTTP)
+    second_ms    the next one, for a user never seen before either
+    ready_ms     import + startup + first, i.e. process start to first page
+
+Each size is measured with WARM_UP on ("warm", the default) and off
+("lazy", everything opened by the first request), each run in a fresh
+process on a fresh copy of the catalog. Catalogs are the cached ones of
+recommendation_bench.py (generated there with faker if missing), or
+--database to measure an existing file. Every metric is the median of
+--repeat runs.
+
+Usage (from src/backend):
+    python utils/cold_start_bench.py --sizes 1000 100000
+    python utils/cold_start_bench.py --database data/data.db --repeat 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(BACKEND_DIR)
+
+STEPS = ("import_ms", "startup_ms", "first_ms", "second_ms", "ready_ms")
+
+
+def measure(db_path, mode):
+    """One cold start, in this process."""
+    os.environ["DATABASE_PATH"] = db_path
+    os.environ["WARM_UP"] = "1" if mode == "warm" else "0"
+    start = time.perf_counter()
+    import main as api
+    imported = time.perf_counter()
+
+    async def serve():
+        async with api.lifespan(api.app):
+            started = time.perf_counter()
+            await api.nextCharity("cold-start-user-0")
+            first = time.perf_counter()
+            await api.nextCharity("cold-start-user-1")
+            return started, first, time.perf_counter()
+
+    started, first, second = asyncio.run(serve())
+    return {"import_ms": 1000 * (imported - start), "startup_ms": 1000 * (started - imported),
+            "first_ms": 1000 * (first - started), "second_ms": 1000 * (second - first),
+            "ready_ms": 1000 * (first - start)}
+
+
+def run_child(catalog, mode, workdir):
+    with tempfile.TemporaryDirectory(dir=workdir) as run_dir:
+        db_path = os.path.join(run_dir, "data.db")
+        shutil.copy(catalog, db_path)
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", db_path, "--mode", mode],
+                               capture_output=True, text=True, cwd=BACKEND_DIR)
+    if child.returncode != 0:
+        sys.exit(f"Cold start ({mode}) on {catalog} failed:\n{child.stderr}")
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100_000])
+    parser.add_argument("--database", help="measure this file instead of generated catalogs")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh processes per size and mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "recommendation_bench"))
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="processes generating catalogs")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)  # internal: one cold start on this database
+    parser.add_argument("--mode", choices=("warm", "lazy"), default="warm", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.mode)))
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    if args.database:
+        catalogs = [os.path.abspath(args.database)]
+    else:
+        from recommendation_bench import catalog_path
+        catalogs = [catalog_path(args.workdir, size, args.seed, args.jobs) for size in args.sizes]
+
+    results = []
+    for catalog in catalogs:
+        for mode in ("warm", "lazy"):
+            runs = [run_child(catalog, mode, args.workdir) for _ in range(args.repeat)]
+            result = {"catalog": os.path.basename(catalog), "mode": mode,
+                      **{step: float(np.median([run[step] for run in runs])) for step in STEPS}}
+            results.append(result)
+            print(f"{result['catalog']:>24} {mode}: " + ", ".join(f"{step} {result[step]:.1f}" for step in STEPS))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+ledger_tps.py
+
+Ledger write throughput before and after the shared connection pool.
+
+"per-request" reproduces the old /addLedger path: every request opens a new
+connection with default pragmas, runs CREATE TABLE IF NOT EXISTS and commits
+in rollback-journal mode. "pooled" goes through CoinLedger, which reuses the
+pool's WAL writer connection and its prepared statements.
+
+The concurrent modes run --threads clients adding one payment at a time, as
+simultaneous /addLedger requests would: "concurrent" commits each payment on
+its own, "group-commit" submits them through a GroupCommitter like main.py
+does. "bulk" is /addLedgerBatch: add_many with --batch payments per call.
+
+Set SQLITE_SYNCHRONOUS=FULL to measure with a sync on every commit.
+
+Usage (from src/backend):
+    python utils/ledger_tps.py --transactions 2000
+    SQLITE_SYNCHRONOUS=FULL python utils/ledger_tps.py --transactions 20000 --threads 32
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.coinledger import CoinLedger
+from models.groupcommit import GroupCommitter
+from config import LEDGER_COMMIT_BATCH, LEDGER_COMMIT_DELAY
+
+
+def per_request(db_path, count):
+    for i in range(count):
+        ledger = sqlite3.connect(db_path)
+        ledger.execute('''
+            CREATE TABLE IF NOT EXISTS coin_ledger (
+                transactionID TEXT PRIMARY KEY,
+                timestamp TEXT,
+                userID TEXT,
+                amount REAL,
+                nonprofitID TEXT
+            )
+        ''')
+        ledger.commit()
+        ledger.execute(
+            "INSERT INTO coin_ledger (transactionID, timestamp, userID, amount, nonprofitID) VALUES (?, ?, ?, ?, ?)",
+            (f"tx_{i}", "2024-01-01T00:00:00", f"user_{i % 100}", 1.0, f"np_{i % 50}"))
+        ledger.commit()
+        ledger.close()
+
+
+def pooled(db_path, count):
+    ledger = CoinLedger(db_path)
+    for i in range(count):
+        ledger.add(f"user_{i % 100}", 1.0, f"np_{i % 50}")
+
+
+def run_clients(count, threads, add):
+    """Splits `count` single-payment adds across `threads` client threads."""
+    def client(first):
+        for i in range(first, count, threads):
+            add(f"user_{i % 100}", 1.0, f"np_{i % 50}")
+    workers = [threading.Thread(target=client, args=(first,)) for first in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def concurrent(db_path, count, threads, batch):
+    run_clients(count, threads, CoinLedger(db_path).add)
+
+
+def group_commit(db_path, count, threads, batch):
+    committer = GroupCommitter(CoinLedger(db_path).add_many, LEDGER_COMMIT_BATCH, LEDGER_COMMIT_DELAY)
+    run_clients(count, threads, lambda *payment: committer.submit(payment).result())
+    committer.close()
+    print(f"{'':>12}  ({committer.items / max(committer.batches, 1):.1f} payments per commit)")
+
+
+def bulk(db_path, count, threads, batch):
+    ledger = CoinLedger(db_path)
+    for first in range(0, count, batch):
+        ledger.add_many([(f"user_{i % 100}", 1.0, f"np_{i % 50}") for i in range(first, min(first + batch, count))])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    modes = (
+        ("per-request", lambda db_path: per_request(db_path, args.transactions)),
+        ("pooled", lambda db_path: pooled(db_path, args.transactions)),
+        ("concurrent", lambda db_path: concurrent(db_path, args.transactions, args.threads, args.batch)),
+        ("group-commit", lambda db_path: group_commit(db_path, args.transactions, args.threads, args.batch)),
+        ("bulk", lambda db_path: bulk(db_path, args.transactions, args.threads, args.batch)),
+    )
+    for name, fn in modes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "ledger.db")
+            start = time.perf_counter()
+            fn(db_path)
+            elapsed = time.perf_counter() - start
+        print(f"{name:>12}: {args.transactions / elapsed:10.0f} tx/s")
+
+
+if __name__ == "__main__":
+    main()
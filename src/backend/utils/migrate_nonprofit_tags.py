@@ -0,0 +1,72 @@
+"""
+migrate_nonprofit_tags.py
+
+Converts the nonprofits table of an existing database from JSON text tag
+columns to the binary layout SQLiteDatabase uses now: primary/secondary tags
+packed one byte per tag id and a precomputed float32 vector per nonprofit.
+
+Text columns may hold either a JSON list of tag ids (what SQLiteDatabase used
+to write) or comma-separated tag names (what add_charities_from_json.py used
+to write); names are mapped to ids with tags.json (config.TAGS_PATH). Rows
+whose tags can't be decoded are reported and left as they are. The table is
+rebuilt with BLOB columns, then the file is vacuumed. Safe to run more than once.
+
+Usage (from src/backend):
+    python utils/migrate_nonprofit_tags.py [path/to/data.db]
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.sqlite_db import SQLiteDatabase
+from models.migrations import TABLES, convert_nonprofits
+from config import DATABASE_PATH
+
+
+def rebuild_with_blob_columns(conn):
+    """Recreates nonprofits with the BLOB column types of SQLiteDatabase, keeping every row."""
+    conn.execute("ALTER TABLE nonprofits RENAME TO nonprofits_legacy")
+    conn.execute(TABLES["nonprofits"])
+    conn.execute('''
+        INSERT INTO nonprofits (id, primary_tags, secondary_tags, vector)
+        SELECT id, primary_tags, secondary_tags, vector FROM nonprofits_legacy
+    ''')
+    conn.execute("DROP TABLE nonprofits_legacy")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db_path", nargs="?", default=DATABASE_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s %(message)s")
+
+    if not os.path.exists(args.db_path):
+        sys.exit(f"{args.db_path} does not exist")
+
+    conn = sqlite3.connect(args.db_path)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='nonprofits'").fetchone() is None:
+        sys.exit(f"{args.db_path} has no nonprofits table")
+    start = time.perf_counter()
+    with conn:
+        migrated = sum(convert_nonprofits(conn))
+        types = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(nonprofits)")}
+        if types.get("primary_tags") != "BLOB" or types.get("secondary_tags") != "BLOB":
+            rebuild_with_blob_columns(conn)
+    conn.execute("VACUUM")
+    conn.close()
+    print(f"Migrated {migrated} nonprofits in {time.perf_counter() - start:.2f}s")
+
+    database = SQLiteDatabase(args.db_path)
+    start = time.perf_counter()
+    ids, _ = database.get_nonprofit_matrix()
+    print(f"Catalog of {len(ids)} nonprofits now loads in {1000 * (time.perf_counter() - start):.1f} ms")
+    database.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+prerank_users.py
+
+Nightly pre-ranking of every stored user, so a returning user's first pages
+are served without a catalog search:
+
+1. syncs the user vector store (models/uservectors.py) with the database;
+2. ranks its users against the nonprofit catalog --chunk at a time, one
+   matrix product per chunk (models/prerank.py), in a pool of --workers
+   processes that each map the store and load the catalog once;
+3. writes each chunk's top --top nonprofits to user_recommendations as it
+   arrives, one transaction per chunk.
+
+loadUser queues a user's ranking only while their vector is unchanged since
+the sync of step 1, so users who react after the run are ranked live as
+before. Rankings are for the basic event; later refills still pick events
+at random.
+
+Usage (from src/backend):
+    python utils/prerank_users.py [path/to/data.db] [--workers 4] [--top 30]
+    # crontab: 0 4 * * *  cd /path/to/src/backend && python utils/prerank_users.py
+"""
+
+import argparse
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.sqlite_db import SQLiteDatabase
+from models.uservectors import UserVectorStore
+from models.prerank import init_worker, rank_rows
+from config import DATABASE_PATH, USER_VECTORS_DIR, PRERANK_TOP_N, PRERANK_CHUNK
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database", nargs="?", default=DATABASE_PATH)
+    parser.add_argument("--directory", default=USER_VECTORS_DIR, help="user vector store (USER_VECTORS_DIR)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--top", type=int, default=PRERANK_TOP_N, help="nonprofits stored per user")
+    parser.add_argument("--chunk", type=int, default=PRERANK_CHUNK, help="users per matrix product")
+    args = parser.parse_args()
+    if not args.directory:
+        sys.exit("No store directory: set USER_VECTORS_DIR or pass --directory")
+
+    start = time.perf_counter()
+    database = SQLiteDatabase(args.database)
+    store = UserVectorStore(args.directory)
+    updated, added = store.sync(database)
+    print(f"Synced the user store: {updated} changed, {added} new, {store.count} users "
+          f"({time.perf_counter() - start:.2f}s)")
+
+    tasks = [(row, min(row + args.chunk, store.count), args.top) for row in range(0, store.count, args.chunk)]
+    ranked = 0
+    # Spawned, not forked: a forked worker would inherit this process's SQLite connections
+    spawn = multiprocessing.get_context("spawn")
+    with spawn.Pool(args.workers, initializer=init_worker, initargs=(args.database, args.directory)) as pool:
+        for ids, rankings in pool.imap(rank_rows, tasks):
+            database.put_user_recommendations(zip(ids, rankings), store.revision)
+            ranked += len(ids)
+    database.close()
+    print(f"Ranked {ranked} users, top {args.top} each, with {args.workers} workers "
+          f"({time.perf_counter() - start:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+publish_catalog.py
+
+Publishes the nonprofit catalog of a database as a new shared snapshot
+(see models/sharedcatalog.py), for running several uvicorn workers with
+SHARED_CATALOG_DIR set. Run it as the loader before starting the workers,
+and again after changing nonprofits outside the API (e.g. with
+add_charities_from_json.py): workers switch to the new version within
+SHARED_CATALOG_POLL seconds. Workers publish a snapshot themselves if
+none exists, so this is only needed to pick up offline changes.
+
+Usage (from src/backend):
+    SHARED_CATALOG_DIR=/dev/shm/catalog python utils/publish_catalog.py [path/to/data.db]
+    uvicorn main:app --workers 4   # same SHARED_CATALOG_DIR
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.sqlite_db import SQLiteDatabase
+from models.sharedcatalog import SharedCatalog
+from config import DATABASE_PATH, SHARED_CATALOG_DIR
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database", nargs="?", default=DATABASE_PATH)
+    parser.add_argument("--directory", default=SHARED_CATALOG_DIR, help="catalog directory (SHARED_CATALOG_DIR)")
+    args = parser.parse_args()
+    if not args.directory:
+        sys.exit("No catalog directory: set SHARED_CATALOG_DIR or pass --directory")
+
+    start = time.perf_counter()
+    database = SQLiteDatabase(args.database)
+    catalog = SharedCatalog(args.directory)
+    ids, matrix = database.get_nonprofit_matrix()
+    with catalog.lock():
+        version = catalog.publish(ids, matrix)
+    database.close()
+    print(f"Published {len(ids)} nonprofits as version {version} in {args.directory} "
+          f"({time.perf_counter() - start:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
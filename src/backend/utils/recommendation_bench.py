@@ -0,0 +1,317 @@
+"""
+recommendation_bench.py
+
+Latency, throughput, memory and ranking-quality benchmark of the swipe path
+(the nextCharity and reaction handlers of main.py), driven by synthetic
+users, so changes to refreshQueue, UserTagTable or the database layer can be
+compared run against run.
+
+Catalogs: each of --sizes nonprofits is generated with
+faker_json_script.generate_record (src/util) and firebase-style ids from
+faker_h5_script, in parallel, and cached in --workdir as
+catalog_<size>_<seed>.db, so a size is only generated once. Every run works
+on a copy of the cached catalog.
+
+Sessions: each size is measured in a fresh process, with main.py imported
+against that copy. --users synthetic users, --concurrency at a time, each
+swipe through --swipes nonprofits, --page at a time. Every user has a hidden
+preference vector (faker_h5_script.random_user_vector). Their affinity for a
+nonprofit is that vector's dot product with the nonprofit's unit vector.
+They react to what they are served by where its affinity falls in their
+affinity over the whole catalog:
+    donate (1 coin)   top 1%
+    like              top 10%
+    dislike           bottom 40%
+    ignore            otherwise
+
+Reported per size:
+    nextCharity / reaction latency p50, p95, p99 (ms, handler only, no HTTP)
+    throughput in swipes/s over the whole simulation
+    peak RSS of the measuring process (MB)
+    quality: mean affinity of everything served divided by the mean affinity
+    of each user's ideal picks (their --swipes best nonprofits); 1.0 is
+    perfect. quality_late covers the second half of each session, i.e.
+    after the user's reactions had a chance to take effect.
+
+Each size is run --repeat times and every metric is the median of those
+runs. Results are written to --output as JSON. --compare takes an earlier results
+file and reports every size present in both. The exit status is 1 if
+latency, throughput, memory or quality got worse by more than --tolerance.
+
+Needs faker and h5py, which the src/util scripts import.
+
+Usage (from src/backend):
+    python utils/recommendation_bench.py --sizes 1000 100000 --output bench.json
+    python utils/recommendation_bench.py --sizes 100000 --compare bench.json
+    python utils/recommendation_bench.py --sizes 1000000 --users 500 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(BACKEND_DIR)
+sys.path.append(os.path.abspath(os.path.join(BACKEND_DIR, '..', 'util')))
+from faker import Faker
+from faker_json_script import generate_record, tags as TAG_NAMES
+from faker_h5_script import generate_firebase_id, random_user_vector
+
+TAG_IDS = {name: tag_id for tag_id, name in enumerate(TAG_NAMES)}
+CHUNK = 10_000
+
+# (metric, True if higher is better); compared by --compare
+COMPARED = (
+    ("nextCharity.p50_ms", False), ("nextCharity.p95_ms", False), ("nextCharity.p99_ms", False),
+    ("reaction.p50_ms", False), ("reaction.p95_ms", False), ("reaction.p99_ms", False),
+    ("swipes_per_s", True), ("peak_rss_mb", False), ("quality", True), ("quality_late", True),
+)
+
+
+# -----------------
+#   Catalogs
+# -----------------
+def generate_chunk(job):
+    """(id, primary tag ids, secondary tag ids) for `count` nonprofits, reproducible per (seed, start)."""
+    start, count, seed = job
+    random.seed(seed * 1_000_003 + start)
+    fake = Faker()
+    fake.seed_instance(seed * 1_000_003 + start)
+    rows = []
+    for _ in range(count):
+        record = generate_record(fake)
+        rows.append((generate_firebase_id(),
+                     [TAG_IDS[name] for name in record["primaryTags"]],
+                     [TAG_IDS[name] for name in record["secondaryTags"]]))
+    return rows
+
+
+def catalog_path(workdir, size, seed, jobs):
+    """The cached catalog of `size` nonprofits, generating it first if needed."""
+    from models.sqlite_db import SQLiteDatabase
+
+    path = os.path.join(workdir, f"catalog_{size}_{seed}.db")
+    if os.path.exists(path):
+        return path
+    start = time.perf_counter()
+    partial = path + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    database = SQLiteDatabase(partial)
+    chunks = [(first, min(CHUNK, size - first), seed) for first in range(0, size, CHUNK)]
+    with Pool(jobs) as pool:
+        for rows in pool.imap(generate_chunk, chunks):
+            database.add_nonprofits(rows)
+    database.pool.writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    database.close()
+    os.replace(partial, path)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(partial + suffix):
+            os.remove(partial + suffix)
+    print(f"Generated {size} nonprofits in {time.perf_counter() - start:.1f}s -> {path}", file=sys.stderr)
+    return path
+
+
+# -----------------
+#   Sessions
+# -----------------
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {"count": len(samples), "mean_ms": float(samples.mean()),
+            "p50_ms": float(np.percentile(samples, 50)), "p95_ms": float(np.percentile(samples, 95)),
+            "p99_ms": float(np.percentile(samples, 99))}
+
+
+async def session(api, index, userID, preference, args, stats):
+    # The user's taste over the whole catalog: reaction thresholds and their ideal picks
+    affinity = index.matrix @ preference
+    dislike_below, like_above, donate_above = np.quantile(affinity, [0.4, 0.9, 0.99])
+    ideal = float(np.sort(affinity)[-args.swipes:].mean())
+    served = []
+    while len(served) < args.swipes:
+        start = time.perf_counter()
+        response = await api.nextCharity(userID, min(args.page, args.swipes - len(served)))
+        stats["nextCharity"].append(time.perf_counter() - start)
+        page = response["array"]
+        if not page:
+            break
+        for nonprofitID in page:
+            score = float(affinity[index.rows[nonprofitID]])
+            served.append(score)
+            if score >= donate_above:
+                reactionNum, amount = 3, 1.0
+            elif score >= like_above:
+                reactionNum, amount = 0, 0.0
+            elif score < dislike_below:
+                reactionNum, amount = 1, 0.0
+            else:
+                reactionNum, amount = 2, 0.0
+            start = time.perf_counter()
+            await api.reaction(userID, reactionNum, nonprofitID, amount)
+            stats["reaction"].append(time.perf_counter() - start)
+            stats["likes"] += reactionNum in (0, 3)
+    half = len(served) // 2
+    stats["quality"].append(np.mean(served) / ideal if served else 0.0)
+    stats["quality_late"].append(np.mean(served[half:]) / ideal if served[half:] else 0.0)
+
+
+async def simulate(api, index, args):
+    stats = {"nextCharity": [], "reaction": [], "quality": [], "quality_late": [], "likes": 0}
+    random.seed(args.seed)
+    users = [(generate_firebase_id(), random_user_vector()) for _ in range(args.users)]
+    gate = asyncio.Semaphore(args.concurrency)
+
+    async def run(userID, preference):
+        async with gate:
+            await session(api, index, userID, preference, args, stats)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(userID, preference) for userID, preference in users))
+    elapsed = time.perf_counter() - start
+    swipes = len(stats["reaction"])
+    return {
+        "nextCharity": percentiles(stats["nextCharity"]),
+        "reaction": percentiles(stats["reaction"]),
+        "swipes": swipes,
+        "swipes_per_s": swipes / elapsed,
+        "like_rate": stats["likes"] / max(swipes, 1),
+        "quality": float(np.mean(stats["quality"])),
+        "quality_late": float(np.mean(stats["quality_late"])),
+    }
+
+
+def measure(db_path, args):
+    """One size, in this process: imports main.py against `db_path` and runs every session."""
+    os.environ["DATABASE_PATH"] = db_path
+    import main as api
+    from models.appcontext import context
+
+    start = time.perf_counter()
+    # What main.py's lifespan does before serving
+    index = context.warm_up()
+    load_s = time.perf_counter() - start
+    result = asyncio.run(simulate(api, index, args))
+    api.exitApp()
+    result.update({"catalog": len(index), "catalog_load_s": load_s,
+                   "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+    return result
+
+
+# -----------------
+#   Reporting
+# -----------------
+def metric(result, name):
+    for key in name.split("."):
+        result = result[key]
+    return result
+
+
+def compare(baseline, current, tolerance):
+    """Prints each compared metric; returns the regressions beyond `tolerance`."""
+    regressions = []
+    before = {run["catalog"]: run for run in baseline["runs"]}
+    for run in current["runs"]:
+        old = before.get(run["catalog"])
+        if old is None:
+            continue
+        print(f"\n{run['catalog']} nonprofits vs {baseline['meta'].get('commit', '?')[:10]}:")
+        for name, higher_is_better in COMPARED:
+            was, now = metric(old, name), metric(run, name)
+            change = (now - was) / was if was else 0.0
+            worse = -change if higher_is_better else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            print(f"  {name:>20}: {was:10.3f} -> {now:10.3f} ({100 * change:+6.1f}%){flag}")
+            if flag:
+                regressions.append((run["catalog"], name))
+    return regressions
+
+
+def median_run(runs):
+    """Per-metric median of repeated runs of one size."""
+    if isinstance(runs[0], dict):
+        return {key: median_run([run[key] for run in runs]) for key in runs[0]}
+    return float(np.median(runs))
+
+
+def summary(run):
+    return (f"{run['catalog']:>9} nonprofits: nextCharity p50/p95/p99 "
+            f"{run['nextCharity']['p50_ms']:.3f}/{run['nextCharity']['p95_ms']:.3f}/{run['nextCharity']['p99_ms']:.3f} ms, "
+            f"reaction p50/p99 {run['reaction']['p50_ms']:.3f}/{run['reaction']['p99_ms']:.3f} ms, "
+            f"{run['swipes_per_s']:.0f} swipes/s, {run['peak_rss_mb']:.0f} MB, "
+            f"quality {run['quality']:.3f} (late {run['quality_late']:.3f})")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100_000])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--swipes", type=int, default=60, help="nonprofits served per user")
+    parser.add_argument("--page", type=int, default=3, help="n of each nextCharity call")
+    parser.add_argument("--concurrency", type=int, default=16, help="sessions running at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "recommendation_bench"))
+    parser.add_argument("--repeat", type=int, default=3, help="fresh runs per size; each metric is their median")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="processes generating catalogs")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change counted as a regression")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)  # internal: run one size against this database
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args)))
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {"meta": {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "args": {key: value for key, value in vars(args).items()
+                                 if key not in ("measure", "output", "compare", "workdir", "jobs")}},
+               "runs": []}
+    for size in args.sizes:
+        catalog = catalog_path(args.workdir, size, args.seed, args.jobs)
+        repeats = []
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory(dir=args.workdir) as run_dir:
+                db_path = os.path.join(run_dir, "data.db")
+                shutil.copy(catalog, db_path)
+                child = subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--measure", db_path],
+                                       capture_output=True, text=True, cwd=BACKEND_DIR)
+                if child.returncode != 0:
+                    sys.exit(f"Run with {size} nonprofits failed:\n{child.stderr}")
+                repeats.append(json.loads(child.stdout.strip().splitlines()[-1]))
+        run = median_run(repeats)
+        run["catalog"] = int(run["catalog"])
+        results["runs"].append(run)
+        print(summary(run))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            sys.exit(f"\n{len(regressions)} regression(s) beyond {100 * args.tolerance:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+sync_user_vectors.py
+
+Copies the user vectors of a database into the memory-mapped store offline
+jobs read (see models/uservectors.py). Only users written since the last
+sync are copied, so it's cheap to run before every job; --rebuild copies
+everyone again.
+
+Usage (from src/backend):
+    python utils/sync_user_vectors.py [path/to/data.db] [--directory DIR] [--rebuild]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models.sqlite_db import SQLiteDatabase
+from models.uservectors import UserVectorStore
+from config import DATABASE_PATH, USER_VECTORS_DIR
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database", nargs="?", default=DATABASE_PATH)
+    parser.add_argument("--directory", default=USER_VECTORS_DIR, help="store directory (USER_VECTORS_DIR)")
+    parser.add_argument("--rebuild", action="store_true", help="copy every user, not only the changed ones")
+    args = parser.parse_args()
+    if not args.directory:
+        sys.exit("No store directory: set USER_VECTORS_DIR or pass --directory")
+
+    start = time.perf_counter()
+    database = SQLiteDatabase(args.database)
+    store = UserVectorStore(args.directory)
+    updated, added = (store.rebuild if args.rebuild else store.sync)(database)
+    database.close()
+    print(f"Synced {updated} changed and {added} new users; {store.count} users at revision {store.revision} "
+          f"in {args.directory} ({time.perf_counter() - start:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()